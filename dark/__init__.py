@@ -9,6 +9,79 @@
 #  Software Foundation. See the file README for copying conditions.
 #
 
-from aggregates import *
-from discovery import *
-from shaping import *
+"""
+Dark
+====
+
+Public names of all submodules are available from the package itself, but
+a submodule is only imported when one of its names is first accessed. So
+``import dark.aggregates`` (or ``from dark import Avg``) does not import
+the rest of the package, let alone optional backends such as doqu.
+"""
+
+import sys
+from types import ModuleType
+
+
+# public names by submodule; keep in sync with `__all__` of the submodules
+EXPORTS = (
+    ('aggregates', ['Accumulator', 'Aggregate', 'Avg', 'CoMomentAggregate',
+                    'CorrMatrix', 'Correlation', 'Count', 'CountNA',
+                    'Covariance', 'CumSum', 'DenseAccumulator', 'Histogram',
+                    'Max', 'Median', 'Min', 'Mode', 'MovingAvg', 'MovingSum',
+                    'Sum', 'Qu1', 'Qu3', 'TopK', 'NA', 'SpaceSaving',
+                    'WeightedAggregate', 'WindowAggregate', 'EXACT', 'FAST',
+                    'set_numeric_mode', 'set_precision']),
+    ('binning', ['Bin', 'Bins', 'to_bins']),
+    ('concurrency', ['AsyncCast', 'cast_async']),
+    ('discovery', ['suggest_document_class', 'field_frequency',
+                   'print_field_frequency', 'suggest_structures',
+                   'print_suggest_structures', 'document_factory']),
+    ('grouping', ['MISSING', 'VOID', 'Grouper', 'group_sorted', 'group_tree',
+                  'stream_tree']),
+    ('indexes', ['DistinctValuesIndex', 'Index', 'IndexedQuery', 'KeyStats',
+                 'QuantileSketch', 'StatsIndex']),
+    ('joins', ['Joined', 'Lookup']),
+    ('memory', ['Dataset']),
+    ('predicates', ['AllOf', 'AnyOf', 'Filtered', 'Not', 'Predicate',
+                    'Where']),
+    ('rendering', ['format_cell', 'render', 'render_ascii', 'render_csv',
+                   'render_jsonl', 'render_rotated']),
+    ('shaping', ['BinnedFactor', 'CastPlan', 'Explanation', 'Factor', 'cast',
+                 'cast_cons', 'compile_cast', 'stdev', 'summary']),
+    ('snapshots', ['Snapshot', 'build', 'load', 'save']),
+    ('timeseries', ['UTC', 'FixedOffset', 'Period', 'TimeBucket']),
+)
+
+
+class LazyPackage(ModuleType):
+    "A package which imports submodules on first access to their names."
+    def __init__(self, package, exports):
+        ModuleType.__init__(self, package.__name__, package.__doc__)
+        for attr in '__file__', '__path__', '__package__':
+            setattr(self, attr, getattr(package, attr, None))
+        # the original module must live on: its globals are cleared when it
+        # is garbage-collected
+        self._package = package
+        self.EXPORTS = exports
+        self._origins = dict((name, module) for module, names in exports
+                             for name in names)
+        self.__all__ = [name for module, names in exports for name in names]
+
+    def __getattr__(self, name):
+        # only called if the name was not accessed yet
+        try:
+            module = self._origins[name]
+        except KeyError:
+            raise AttributeError('module "{0}" has no attribute "{1}"'.format(
+                self.__name__, name))
+        module = __import__(self.__name__ + '.' + module, fromlist=[name])
+        value = getattr(module, name)
+        setattr(self, name, value)
+        return value
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(self._origins))
+
+
+sys.modules[__name__] = LazyPackage(sys.modules[__name__], EXPORTS)
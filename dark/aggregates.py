@@ -21,13 +21,65 @@ Aggregates
 ==========
 """
 
+from bisect import bisect_left
 from decimal import Decimal
+import heapq
+import math
 
+from binning import to_bins
 
-__all__ = ['Aggregate', 'Avg', 'Count', 'Max', 'Median', 'Min', 'Sum', 'Qu1', 'Qu3', 'NA']
 
+__all__ = [
+    'Accumulator', 'Aggregate', 'Avg', 'CoMomentAggregate', 'CorrMatrix',
+    'Correlation', 'Count', 'CountNA', 'Covariance', 'CumSum',
+    'DenseAccumulator', 'Histogram', 'Max', 'Median', 'Min', 'Mode',
+    'MovingAvg', 'MovingSum', 'Sum', 'Qu1', 'Qu3', 'TopK', 'NA',
+    'SpaceSaving', 'WeightedAggregate', 'WindowAggregate', 'EXACT', 'FAST',
+    'set_numeric_mode', 'set_precision',
+]
 
-DECIMAL_EXPONENT = Decimal('.01')    # XXX let user change this
+
+# Numeric modes. In the "exact" mode every result is converted to `Decimal`
+# and quantized to given precision. In the "fast" mode native ints and floats
+# are kept as is and rounding is only done when the table is printed.
+EXACT, FAST = 'exact', 'fast'
+
+NUMERIC_MODE = EXACT
+PRECISION = 2
+DECIMAL_EXPONENT = Decimal('.01')
+
+
+def set_numeric_mode(mode):
+    """
+    Switches between :data:`EXACT` (default) and :data:`FAST` numeric modes.
+    The mode is applied when a lazy calculation is actually performed.
+    """
+    global NUMERIC_MODE
+    if mode not in (EXACT, FAST):
+        raise ValueError('Unknown numeric mode "%s"' % mode)
+    NUMERIC_MODE = mode
+
+def set_precision(places):
+    """
+    Sets the number of decimal places. In the exact mode results are quantized
+    to it; in the fast mode it only affects presentation.
+    """
+    global PRECISION, DECIMAL_EXPONENT
+    if places < 0:
+        raise ValueError('Precision must not be negative')
+    PRECISION = places
+    DECIMAL_EXPONENT = Decimal(1).scaleb(-places)
+
+def to_decimal(value):
+    "Converts an int, long, float or Decimal to a `Decimal` instance."
+    if isinstance(value, float):
+        # Decimal(float) is not supported by older Pythons
+        return Decimal(repr(value))
+    return Decimal(value)
+
+def _is_number(value):
+    return (isinstance(value, (int, long, float, Decimal))
+            and not isinstance(value, bool))
 
 
 class AggregationError(Exception):
@@ -43,17 +95,19 @@ class LazyCalculation(object):
     def get_result(self):
         if len(self.values) == 0:
             return None
+        if self.result is not None:
+            return self.result
         try:
-            self.result = self.result or self.agg.calc(self.values)
+            result = self.agg.calc(self.values)
         except TypeError, e:
             raise AggregationError('Could not perform %s aggregation on key '
                                    '"%s" data contains a non-numeric value. '
                                    'Original message: %s' % (self.agg.name(),
                                    self.agg.key, e.message))
-        #if isinstance(self.result, Decimal):
-        #    # we don't want tens of zeroes, do we
-        #    self.result = Decimal(self.result).quantize(DECIMAL_EXPONENT)
-        self.result = Decimal(self.result).quantize(DECIMAL_EXPONENT)
+        if NUMERIC_MODE == EXACT and _is_number(result):
+            # we don't want tens of zeroes, do we
+            result = to_decimal(result).quantize(DECIMAL_EXPONENT)
+        self.result = result
         return self.result
 
     def __int__(self):
@@ -65,6 +119,9 @@ class LazyCalculation(object):
     def __str__(self):
         return str(self.get_result())
 
+    def __unicode__(self):
+        return unicode(self.get_result())
+
     def __repr__(self):
         return '<lazy {name} by {values}>'.format(
             name = self.agg.name,
@@ -80,8 +137,20 @@ class NA(object):
 
         Min('key', NA.skip).
 
+    An instance stands for an empty cell. There is only one: `NA()` always
+    returns the same object (even after unpickling), so sparse tables do not
+    allocate an object per empty cell.
     """
     skip, reject = 1, 2
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = object.__new__(cls)
+        return cls._instance
+
+    def __reduce__(self):
+        return NA, ()
 
     def __str__(self):
         return 'N/A'
@@ -91,11 +160,27 @@ class NA(object):
 
 
 class Aggregate(object):
+    # whether accumulators of this aggregate can be merged (see Accumulator)
+    mergeable = False
+    # what accumulators keep instead of all values (see Summary)
+    summary_class = None
+    # only items matching this predicate are aggregated (see dark.predicates)
+    where = None
+
     def __init__(self):
         self.key = None
 
     def __str__(self):
-        return '%s(%s)' % (self.__class__.__name__, self.key or 'all')
+        name = self.__class__.__name__
+        if self.where is None:
+            return '%s(%s)' % (name, self.arguments())
+        if not self.key:
+            return '%s(where %s)' % (name, self.where)
+        return '%s(%s, where %s)' % (name, self.arguments(), self.where)
+
+    def arguments(self):
+        "Returns the arguments as shown in the column heading."
+        return self.key or 'all'
 
     def __repr__(self):
         return '<%s>' % str(self)
@@ -104,58 +189,406 @@ class Aggregate(object):
         return self.__class__.__name__
 
 
+class Accumulator(object):
+    """
+    Collects values for an aggregate one item at a time. Accumulators of the
+    same aggregate can be merged, so partial results (e.g. per level or per
+    chunk of data) are combined without scanning the data again.
+
+    :meth:`finalize` returns the same as :meth:`AggregateManager.count_for`.
+
+    Items without a value are counted in `na_count` until the accumulator
+    is rejected (see :attr:`NA.reject`); after that items are ignored.
+    """
+    na_count = 0
+
+    def __init__(self, agg):
+        self.agg = agg
+        summary_class = getattr(agg, 'summary_class', None)
+        self.values = [] if summary_class is None else summary_class()
+        self.rejected = False
+
+    def add(self, item):
+        if self.rejected:
+            return
+        where = self.agg.where
+        if where is not None and not where(item):
+            return
+        value = item.get(self.agg.key, None)
+        if value is None:
+            self.na_count += 1
+            # decide what to do if a None is found in values (i.e. a value is not available)
+            if self.agg.na_policy == NA.reject:
+                # reset the whole calculated value to None if at least one value is N/A
+                self.rejected = True
+                return
+            elif self.agg.na_policy == NA.skip:
+                # silently ignore items with empty values, count only existing integers; same as "rm.na" in R (?)
+                return
+        self.append(value)
+
+    def append(self, value):
+        self.values.append(value)
+
+    def merge(self, other):
+        "Adds values collected by another accumulator of the same aggregate."
+        self.rejected = self.rejected or other.rejected
+        self.na_count += other.na_count
+        self.values.extend(other.values)
+
+    def finalize(self):
+        if self.rejected:
+            return None
+        if self.values:
+            return LazyCalculation(self.agg, self.values)
+        else:
+            return NA()
+
+
+class DenseAccumulator(Accumulator):
+    """
+    Accumulator for a key known to have a value in every item (e.g. according
+    to a :class:`dark.indexes.StatsIndex`). Skips N/A policy checks.
+    """
+    def add(self, item):
+        where = self.agg.where
+        if where is not None and not where(item):
+            return
+        self.values.append(item.get(self.agg.key))
+
+
+class ItemCounter(Accumulator):
+    "Counts items regardless of their contents."
+    def __init__(self, agg):
+        self.agg = agg
+        self.values = 0
+        self.rejected = False
+
+    def add(self, item):
+        where = self.agg.where
+        if where is None or where(item):
+            self.values += 1
+
+    def merge(self, other):
+        self.values += other.values
+
+    def finalize(self):
+        return self.values
+
+
+class Summary(object):
+    """
+    Replaces the list of values collected by an :class:`Accumulator` if the
+    aggregate only needs a summary of them (e.g. the sum), so that memory
+    does not grow with the number of items. The length is the number of
+    values. A `TypeError` (e.g. a value is not a number) is kept until the
+    result is requested, as it would be raised by `calc()` for a list.
+    """
+    __slots__ = ('count', 'value', 'error')
+
+    def __init__(self):
+        self.count = 0
+        self.value = None
+        self.error = None
+
+    def __getstate__(self):
+        return self.count, self.value, self.error
+
+    def __setstate__(self, state):
+        self.count, self.value, self.error = state
+
+    def __len__(self):
+        return self.count
+
+    def __repr__(self):
+        return '<{0} of {1} values>'.format(self.__class__.__name__,
+                                            self.count)
+
+    def first(self, value):
+        "Returns the summary of a single value."
+        return value
+
+    def combine(self, summary, value):
+        "Returns the summary with one more value."
+        raise NotImplementedError
+
+    def union(self, summary, other):
+        "Returns the combination of two summaries."
+        return self.combine(summary, other)
+
+    def copy(self, summary):
+        "Returns a summary that can be changed without affecting this one."
+        return summary
+
+    def append(self, value):
+        self.count += 1
+        if self.error is None:
+            try:
+                if self.count == 1:
+                    self.value = self.first(value)
+                else:
+                    self.value = self.combine(self.value, value)
+            except TypeError, e:
+                self.error = e
+
+    def extend(self, other):
+        if not other.count:
+            return
+        self.error = self.error or other.error
+        if self.error is None:
+            try:
+                if self.count:
+                    self.value = self.union(self.value, other.value)
+                else:
+                    self.value = self.copy(other.value)
+            except TypeError, e:
+                self.error = e
+        self.count += other.count
+
+    def result(self):
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class RunningSum(Summary):
+    "The sum of values, same as ``sum(values, 0)``."
+    __slots__ = ()
+
+    def first(self, value):
+        return 0 + value
+
+    def combine(self, summary, value):
+        return summary + value
+
+
+class RunningMin(Summary):
+    "The smallest value, same as ``min(values)``."
+    __slots__ = ()
+
+    def combine(self, summary, value):
+        return value if value < summary else summary
+
+
+class RunningMax(Summary):
+    "The largest value, same as ``max(values)``."
+    __slots__ = ()
+
+    def combine(self, summary, value):
+        return value if value > summary else summary
+
+
+class DistinctValues(Summary):
+    "The set of distinct values; the result is its size."
+    __slots__ = ()
+
+    def first(self, value):
+        return set([value])
+
+    def combine(self, summary, value):
+        summary.add(value)
+        return summary
+
+    def union(self, summary, other):
+        return summary | other
+
+    def copy(self, summary):
+        return set(summary)
+
+    def result(self):
+        return len(super(DistinctValues, self).result())
+
+
+class WeightedValues(list):
+    "A list of (value, weight) pairs collected for a weighted aggregate."
+
+    def total(self):
+        "Returns the sum of weights."
+        return sum((weight for value, weight in self), 0)
+
+    def runs(self):
+        """
+        Returns sorted values and the cumulative weights up to and including
+        each of them.
+        """
+        values, bounds, passed = [], [], 0
+        for value, weight in sorted(self):
+            passed += weight
+            values.append(value)
+            bounds.append(passed)
+        return values, bounds
+
+
+class WeightedAccumulator(Accumulator):
+    """
+    Collects (value, weight) pairs. An item without a weight is treated as
+    an item without a value.
+    """
+    def __init__(self, agg):
+        super(WeightedAccumulator, self).__init__(agg)
+        self.values = WeightedValues()
+
+    def add(self, item):
+        if self.rejected:
+            return
+        where = self.agg.where
+        if where is not None and not where(item):
+            return
+        value = item.get(self.agg.key, None)
+        weight = item.get(self.agg.weight, None)
+        if value is None or weight is None:
+            self.na_count += 1
+            if self.agg.na_policy == NA.reject:
+                self.rejected = True
+            return
+        if not _is_number(weight) or weight < 0:
+            raise AggregationError('Could not perform %s aggregation on key '
+                                   '"%s": weight %r is not a non-negative '
+                                   'number' % (self.agg.name(), self.agg.key,
+                                               weight))
+        if weight:
+            # an item with zero weight stands for no observations at all
+            self.values.append((value, weight))
+
+
 class AggregateManager(Aggregate):
-    "TODO factory?"
+    """
+    Base class for aggregates calculated from values of a key. If `where`
+    is given (a :class:`dark.predicates.Predicate` or another picklable
+    callable), only the items it accepts are aggregated. Conditional
+    aggregates share the pass over the data with other aggregates of the
+    cell, so several conditions cost no more than one::
+
+        cast(requests, ['day'], [], Count(), Count(where=Where(status=404)),
+             Sum('bytes', where=Where(status__gte=500)))
+    """
+
+    accumulator_class = Accumulator
+    mergeable = True
 
-    def __init__(self, key, na_policy=NA.skip):
+    def __init__(self, key, na_policy=NA.skip, where=None):
+        if na_policy not in (NA.skip, NA.reject):
+            raise ValueError('Unknown N/A policy {0!r}'.format(na_policy))
+        if where is not None and not callable(where):
+            raise ValueError('Condition {0!r} is not callable'.format(where))
         self.key = key
         self.na_policy = na_policy
+        self.where = where
+
+    def accumulator(self):
+        "Returns a new :class:`Accumulator` for this aggregate."
+        return self.accumulator_class(self)
 
     def count_for(self, dictionaries):
-        values = []
+        if (self.na_policy == NA.reject and self.key and self.where is None
+            and hasattr(dictionaries, 'na_count')
+            and dictionaries.na_count(self.key)):
+            # the index of the dataset tells that some value is missing
+            return None
+        accumulator = self.accumulator()
         for item in dictionaries:
-            value = item.get(self.key, None)
-            if value is None:
-                # decide what to do if a None is found in values (i.e. a value is not available)
-                if self.na_policy == NA.reject:
-                    # reset the whole calculated value to None if at least one value is N/A
-                    return None
-                elif self.na_policy == NA.skip:
-                    # silently ignore items with empty values, count only existing integers; same as "rm.na" in R (?)
-                    continue
-            values.append(value)
-        if values:
-            return LazyCalculation(self, values)
-        else:
-            return NA()
+            accumulator.add(item)
+            if accumulator.rejected:
+                break
+        return accumulator.finalize()
 
     def calc(self, values):
         raise NotImplementedError
 
 
+class WeightedAggregate(AggregateManager):
+    """
+    Base class for aggregates that accept a `weight`: the key which value is
+    the number of observations represented by the item (e.g. in data that
+    is already aggregated). The result is the same as if each item was
+    repeated that many times, but the items are not expanded::
+
+        Avg('price', weight='quantity')
+    """
+    weight = None
+
+    def __init__(self, key, na_policy=NA.skip, where=None, weight=None):
+        super(WeightedAggregate, self).__init__(key, na_policy, where)
+        self.weight = weight
+
+    def arguments(self):
+        if self.weight is None:
+            return super(WeightedAggregate, self).arguments()
+        return '%s, weight=%s' % (self.key, self.weight)
+
+    def accumulator(self):
+        if self.weight is not None:
+            return WeightedAccumulator(self)
+        return super(WeightedAggregate, self).accumulator()
+
+
 # CLASSES THAT INHERIT TO AggregateManager
 
-class Avg(AggregateManager):
+class Avg(WeightedAggregate):
+    summary_class = RunningSum
+
     @staticmethod
     def calc(values):
-        return Decimal(sum(values, 0)) / len(values)
+        if isinstance(values, WeightedValues):
+            total = sum((value * weight for value, weight in values), 0)
+            count = values.total()
+            if not count:
+                return None
+            if NUMERIC_MODE == EXACT:
+                return to_decimal(total) / to_decimal(count)
+            return float(total) / count
+        if isinstance(values, Summary):
+            total = values.result()
+        else:
+            total = sum(values, 0)
+        if NUMERIC_MODE == EXACT:
+            return to_decimal(total) / len(values)
+        return float(total) / len(values)
 
 
 class Max(AggregateManager):
+    summary_class = RunningMax
+
     @staticmethod
     def calc(values):
-        return str(max(values))  # str for later conversion to decimal
+        if isinstance(values, Summary):
+            return values.result()
+        return max(values)
 
 
-class Median(AggregateManager):
+class Median(WeightedAggregate):
     """
     Given a vector V of length N, the median of V is the middle value of a sorted
     copy of V, V_sorted - i.e., V_sorted[(N-1)/2], when N is odd. When N is even,
     it is the average of the two middle values of V_sorted.
     """
     @staticmethod
-    def calc(values):
-        # TODO: force Decimal
+    def calc_weighted(values, start=0, stop=None):
+        """
+        Same as :meth:`calc` for the part of the sorted values between
+        positions `start` and `stop`, each value repeated as many times as
+        its weight says.
+        """
+        values, bounds = values.runs()
+        if stop is None:
+            stop = bounds[-1] if bounds else 0
+        if not stop > start:
+            return 0 / 2.0
+        # the middle of the range; weights may be fractional
+        middle = start + stop
+        middle = middle / 2.0 if isinstance(middle, (int, long)) else middle / 2
+        index = bisect_left(bounds, middle)
+        if bounds[index] != middle or index + 1 == len(values):
+            return values[index]
+        # the middle falls between two values
+        _sum = values[index] + values[index + 1]
+        if isinstance(_sum, Decimal):
+            return _sum / Decimal('2.0')
+        return _sum / 2.0
+
+    def calc(self, values):
+        if isinstance(values, WeightedValues):
+            return self.calc_weighted(values)
         values = sorted(values)
         middle = len(values)>>1
         # when length is odd
@@ -186,9 +619,18 @@ folded first at the median, and the quartiles.
 """
 
 
+def _quarter(total):
+    # integral weights give the same result as repeated items
+    if total == int(total):
+        return int(total) / 4
+    return total / 4
+
+
 class Qu1(Median):
     "Calculates the q0.25."
     def calc(self, values):
+        if isinstance(values, WeightedValues):
+            return self.calc_weighted(values, 0, _quarter(values.total()))
         values = sorted(values)
         l = len(values) / 4
         return super(Qu1, self).calc(values[:l])
@@ -197,20 +639,33 @@ class Qu1(Median):
 class Qu3(Median):
     "Calculates the q0.75."
     def calc(self, values):
+        if isinstance(values, WeightedValues):
+            total = values.total()
+            return self.calc_weighted(values, _quarter(total) * 3, total)
         values = sorted(values)
         l = (len(values) / 4) * 3
         return super(Qu3, self).calc(values[l:])
 
 
 class Min(AggregateManager):
+    summary_class = RunningMin
+
     @staticmethod
     def calc(values):
+        if isinstance(values, Summary):
+            return values.result()
         return min(values)
 
 
-class Sum(AggregateManager):
+class Sum(WeightedAggregate):
+    summary_class = RunningSum
+
     @staticmethod
     def calc(values):
+        if isinstance(values, WeightedValues):
+            return sum((value * weight for value, weight in values), 0)
+        if isinstance(values, Summary):
+            return values.result()
         return sum(values, 0)
 
 
@@ -219,13 +674,524 @@ class Count(AggregateManager):
     Counts distinct values for given key. If key is not specified, simply counts
     all items in the query.
     """
-    def __init__(self, key=None, na_policy=NA.skip):        # TODO: err_policy (skip, raise, set N/A, set 0)
-        self.key = key
-        self.na_policy = na_policy
-        # overload resource-consuming parent method if we can do without it
-        if not key:
-            self.count_for = self.calc
+    summary_class = DistinctValues
+
+    def __init__(self, key=None, na_policy=NA.skip, where=None):        # TODO: err_policy (skip, raise, set N/A, set 0)
+        super(Count, self).__init__(key, na_policy, where)
+
+    def accumulator(self):
+        # no need to collect values if we only count items
+        if not self.key:
+            return ItemCounter(self)
+        return super(Count, self).accumulator()
 
     @staticmethod
     def calc(values):
+        if isinstance(values, Summary):
+            return values.result()
         return len(set(values))
+
+
+class NACounter(Accumulator):
+    "Only counts items without a value (see :class:`CountNA`)."
+    def append(self, value):
+        pass
+
+    def finalize(self):
+        return self.na_count
+
+
+class CountNA(AggregateManager):
+    """
+    Counts items without a value for given key (`None` or missing). Values
+    are not collected.
+    """
+    accumulator_class = NACounter
+
+    def __init__(self, key, where=None):
+        super(CountNA, self).__init__(key, NA.skip, where)
+
+
+
+# FREQUENT VALUES
+
+
+def _most_frequent(pairs, k):
+    # ties are broken by value, so that the result does not depend on the
+    # order of a dictionary
+    return heapq.nsmallest(k, pairs, key=lambda pair: (-pair[1], pair[0]))
+
+
+class SpaceSaving(object):
+    """
+    Space-Saving sketch (Metwally, Agrawal, El Abbadi, 2005). Finds the most
+    frequent values of a stream using at most `capacity` counters. A value's
+    count is never underestimated and is overestimated by at most its `error`.
+    If the number of distinct values does not exceed `capacity`, the counts
+    are exact.
+    """
+    def __init__(self, capacity):
+        assert capacity > 0
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        self._heap = []    # (count, value) pairs, may contain stale entries
+
+    def __len__(self):
+        return len(self.counts)
+
+    def add(self, value, count=1):
+        counts = self.counts
+        if value in counts:
+            counts[value] += count
+        elif len(counts) < self.capacity:
+            counts[value] = count
+            self.errors[value] = 0
+        else:
+            # evict the value with the smallest count; the newcomer inherits
+            # its count as the maximum possible error
+            victim, floor = self._pop_min()
+            del counts[victim], self.errors[victim]
+            counts[value] = floor + count
+            self.errors[value] = floor
+        heapq.heappush(self._heap, (counts[value], value))
+        if len(self._heap) > 4 * self.capacity:
+            self._heap = [(c, v) for v, c in counts.iteritems()]
+            heapq.heapify(self._heap)
+
+    def _pop_min(self):
+        while True:
+            count, value = heapq.heappop(self._heap)
+            if self.counts.get(value) == count:
+                return value, count
+
+    def merge(self, other):
+        "Adds counts from another sketch (the result is also approximate)."
+        for value, count in other.counts.iteritems():
+            self.add(value, count)
+
+    def top(self, k):
+        "Returns `k` most frequent values as a list of (value, count) pairs."
+        return _most_frequent(self.counts.iteritems(), k)
+
+
+class TopValues(list):
+    "A list of (value, count) pairs with a compact string representation."
+    def __unicode__(self):
+        return u', '.join(u'{0}\xd7{1}'.format(v, c) for v, c in self)
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+
+def _iter_hashable(values):
+    # list values (e.g. several occupations) are unwrapped
+    for value in values:
+        if isinstance(value, (list, tuple)):
+            for subvalue in value:
+                yield subvalue
+        else:
+            yield value
+
+
+class SketchAccumulator(Accumulator):
+    "Feeds values to a :class:`SpaceSaving` sketch instead of keeping them."
+    def __init__(self, agg):
+        super(SketchAccumulator, self).__init__(agg)
+        self.values = SpaceSaving(agg.capacity)
+
+    def append(self, value):
+        for subvalue in _iter_hashable([value]):
+            self.values.add(subvalue)
+
+    def merge(self, other):
+        self.rejected = self.rejected or other.rejected
+        self.na_count += other.na_count
+        self.values.merge(other.values)
+
+
+class TopK(AggregateManager):
+    """
+    Finds `k` most frequent values for given key. The result is a list of
+    (value, count) pairs, most frequent value first.
+
+    By default the values are counted exactly and the top is picked with a
+    heap. If `approximate` is `True`, a :class:`SpaceSaving` sketch with
+    `capacity` counters (ten per requested value by default) is used instead
+    so that memory does not grow with the number of distinct values.
+    """
+    def __init__(self, key, k=5, na_policy=NA.skip, approximate=False,
+                 capacity=None, where=None):
+        super(TopK, self).__init__(key, na_policy, where)
+        self.k = k
+        self.approximate = approximate
+        self.capacity = capacity or k * 10
+
+    def arguments(self):
+        return '%s, %d' % (self.key, self.k)
+
+    def accumulator(self):
+        if self.approximate:
+            return SketchAccumulator(self)
+        return super(TopK, self).accumulator()
+
+    def calc(self, values):
+        if isinstance(values, SpaceSaving):
+            return TopValues(values.top(self.k))
+        if self.approximate:
+            sketch = SpaceSaving(self.capacity)
+            for value in _iter_hashable(values):
+                sketch.add(value)
+            return TopValues(sketch.top(self.k))
+        counts = {}
+        for value in _iter_hashable(values):
+            counts[value] = counts.get(value, 0) + 1
+        return TopValues(_most_frequent(counts.iteritems(), self.k))
+
+
+class Mode(TopK):
+    "Finds the most frequent value for given key."
+    def __init__(self, key, na_policy=NA.skip, approximate=False,
+                 capacity=None, where=None):
+        super(Mode, self).__init__(key, 1, na_policy, approximate, capacity,
+                                   where)
+
+    def arguments(self):
+        return Aggregate.arguments(self)
+
+    def calc(self, values):
+        top = super(Mode, self).calc(values)
+        return top[0][0] if top else None
+
+
+class Histogram(AggregateManager):
+    """
+    Counts values for given key per bin. The result is a list of (bin, count)
+    pairs including empty bins. `bins` is a list of edges or a
+    :class:`dark.binning.Bins` instance with `edges` or `width`.
+
+    Each cell is counted separately, so bins that depend on the values
+    (`count` or `quantiles`) would differ from cell to cell and are not
+    accepted. Bins of given `width` are aligned to multiples of the width.
+    """
+    def __init__(self, key, bins, na_policy=NA.skip, where=None):
+        super(Histogram, self).__init__(key, na_policy, where)
+        self.bins = to_bins(bins)
+        if self.bins.edges is None and self.bins.width is None:
+            raise ValueError('Histogram bins must not depend on the data: '
+                             'give edges or a width, not {0!r}'
+                             .format(self.bins))
+
+    def calc(self, values):
+        values = list(values)
+        edges, closed = self.bins.get_edges(values)
+        return TopValues(self.bins.split(values, edges, closed))
+
+
+# ROLLING WINDOWS
+
+
+class WindowAccumulator(Accumulator):
+    """
+    Keeps the sum and the number of values instead of the values. States of
+    consecutive rows are combined by :meth:`dark.shaping.CastPlan.apply_windows`.
+    """
+    def __init__(self, agg):
+        self.agg = agg
+        self.values = None
+        self.total = 0
+        self.count = 0
+        self.rejected = False
+
+    def append(self, value):
+        self.total += value
+        self.count += 1
+
+    def merge(self, other):
+        self.rejected = self.rejected or other.rejected
+        self.na_count += other.na_count
+        self.total += other.total
+        self.count += other.count
+
+    def finalize(self):
+        if self.rejected:
+            return None
+        if self.count:
+            return LazyCalculation(self.agg, [(self.total, self.count)])
+        return NA()
+
+
+class WindowAggregate(AggregateManager):
+    """
+    Base class for aggregates over a sliding window of rows. Within each row
+    the values of the key are aggregated as usual; then the row is combined
+    with `window` previous rows of the same group (rows that only differ in
+    the level of the last factor), or with all previous rows if `window` is
+    `None`. The rows are combined in a single ordered pass, so the cost does
+    not depend on the size of the window.
+
+    The window is measured in rows, i.e. in levels found in the data; e.g.
+    with a :class:`dark.timeseries.TimeBucket` factor, periods without any
+    items are not counted. In subtotal rows (see `rollup`) the values are
+    aggregated over the whole group.
+    """
+    accumulator_class = WindowAccumulator
+    window = None
+
+    def __init__(self, key, window=None, na_policy=NA.skip, where=None):
+        super(WindowAggregate, self).__init__(key, na_policy, where)
+        if window is not None:
+            if window < 1:
+                raise ValueError('Window must contain at least one row.')
+            self.window = window
+
+    def arguments(self):
+        if self.window is None:
+            return super(WindowAggregate, self).arguments()
+        return '%s, %d' % (self.key, self.window)
+
+
+class MovingAvg(WindowAggregate):
+    "Average of the values in the last `window` rows."
+    def __init__(self, key, window, na_policy=NA.skip, where=None):
+        super(MovingAvg, self).__init__(key, window, na_policy, where)
+
+    @staticmethod
+    def calc(states):
+        total = sum((t for t, c in states), 0)
+        count = sum(c for t, c in states)
+        if NUMERIC_MODE == EXACT:
+            return to_decimal(total) / count
+        return float(total) / count
+
+
+class MovingSum(WindowAggregate):
+    "Sum of the values in the last `window` rows."
+    def __init__(self, key, window, na_policy=NA.skip, where=None):
+        super(MovingSum, self).__init__(key, window, na_policy, where)
+
+    @staticmethod
+    def calc(states):
+        return sum((t for t, c in states), 0)
+
+
+class CumSum(MovingSum):
+    "Cumulative sum of the values in this and all previous rows of the group."
+    def __init__(self, key, na_policy=NA.skip, where=None):
+        WindowAggregate.__init__(self, key, None, na_policy, where)
+
+
+# CORRELATION
+
+
+# number of items folded into the co-moments at a time
+COMOMENT_BATCH = 512
+
+_numpy = None
+
+def _get_numpy():
+    # NumPy is optional; it is imported once, when first needed
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            numpy = False
+        _numpy = numpy
+    return _numpy or None
+
+def _comoments(rows):
+    "Returns the number of rows, the means and the co-moments of columns."
+    numpy = _get_numpy()
+    if numpy is not None:
+        data = numpy.array(rows, dtype=float)
+        means = data.mean(axis=0)
+        deviations = data - means
+        return (len(rows), means.tolist(),
+                deviations.T.dot(deviations).tolist())
+    size = len(rows[0])
+    means = [sum(float(row[i]) for row in rows) / len(rows)
+             for i in range(size)]
+    comoments = [[0.0] * size for i in range(size)]
+    for row in rows:
+        deviations = [float(x) - mean for x, mean in zip(row, means)]
+        for i, deviation in enumerate(deviations):
+            line = comoments[i]
+            for j in range(i, size):
+                line[j] += deviation * deviations[j]
+    for i in range(size):
+        for j in range(i):
+            comoments[i][j] = comoments[j][i]
+    return len(rows), means, comoments
+
+def _correlation(comoments, i, j):
+    denominator = math.sqrt(comoments[i][i] * comoments[j][j])
+    if not denominator:
+        # a key with a constant value
+        return NA()
+    return comoments[i][j] / denominator
+
+
+class CoMomentAccumulator(Accumulator):
+    """
+    Keeps the number of items, the means of the keys and the co-moments (sums
+    of products of deviations from the means) instead of the values. Items
+    are buffered and folded in batches of :data:`COMOMENT_BATCH` (with NumPy
+    if it is installed); states are combined with the pairwise formula by
+    Chan, Golub and LeVeque, so accumulators can be merged.
+
+    Items where any of the keys has no value are treated as N/A.
+    """
+    def __init__(self, agg):
+        size = len(agg.keys)
+        self.agg = agg
+        self.values = None
+        self.rejected = False
+        self.pending = []
+        self.count = 0
+        self.means = [0.0] * size
+        self.comoments = [[0.0] * size for i in range(size)]
+
+    def add(self, item):
+        if self.rejected:
+            return
+        where = self.agg.where
+        if where is not None and not where(item):
+            return
+        row = []
+        for key in self.agg.keys:
+            value = item.get(key)
+            if value is None:
+                self.na_count += 1
+                if self.agg.na_policy == NA.reject:
+                    self.rejected = True
+                return
+            if not _is_number(value):
+                raise AggregationError('Could not perform %s aggregation on '
+                                       'key "%s": %r is not a number' % (
+                                       self.agg.name(), key, value))
+            row.append(value)
+        self.pending.append(row)
+        if len(self.pending) >= COMOMENT_BATCH:
+            self.flush()
+
+    def flush(self):
+        "Folds buffered items into the co-moments."
+        if self.pending:
+            rows, self.pending = self.pending, []
+            self.combine(*_comoments(rows))
+
+    def combine(self, count, means, comoments):
+        "Adds the state of another set of items."
+        if not count:
+            return
+        if not self.count:
+            self.count = count
+            self.means = list(means)
+            self.comoments = [list(line) for line in comoments]
+            return
+        total = self.count + count
+        deltas = [b - a for a, b in zip(self.means, means)]
+        weight = self.count * count / float(total)
+        for line, other, delta in zip(self.comoments, comoments, deltas):
+            for j, value in enumerate(other):
+                line[j] += value + delta * deltas[j] * weight
+        self.means = [mean + delta * count / total
+                      for mean, delta in zip(self.means, deltas)]
+        self.count = total
+
+    def merge(self, other):
+        self.rejected = self.rejected or other.rejected
+        self.na_count += other.na_count
+        other.flush()
+        self.combine(other.count, other.means, other.comoments)
+
+    def finalize(self):
+        self.flush()
+        if self.rejected:
+            return None
+        if self.count < 2:
+            return NA()
+        state = self.count, self.means, self.comoments
+        return LazyCalculation(self.agg, [state])
+
+
+class CoMomentAggregate(AggregateManager):
+    """
+    Base class for aggregates of several numeric keys. Only items that have
+    values of all keys are used. The values are not kept: all pairs of keys
+    are summarized in a single pass (see :class:`CoMomentAccumulator`).
+    """
+    accumulator_class = CoMomentAccumulator
+
+    def __init__(self, keys, na_policy=NA.skip, where=None):
+        keys = tuple(keys)
+        if len(keys) < 2:
+            raise ValueError('At least two keys are needed.')
+        super(CoMomentAggregate, self).__init__(keys[0], na_policy, where)
+        self.keys = keys
+
+    def arguments(self):
+        return ', '.join(self.keys)
+
+
+class Covariance(CoMomentAggregate):
+    "Sample covariance of two keys."
+    def __init__(self, key_a, key_b, na_policy=NA.skip, where=None):
+        super(Covariance, self).__init__([key_a, key_b], na_policy, where)
+
+    @staticmethod
+    def calc(states):
+        count, means, comoments = states[0]
+        return comoments[0][1] / (count - 1)
+
+
+class Correlation(CoMomentAggregate):
+    "Pearson correlation coefficient of two keys."
+    def __init__(self, key_a, key_b, na_policy=NA.skip, where=None):
+        super(Correlation, self).__init__([key_a, key_b], na_policy, where)
+
+    @staticmethod
+    def calc(states):
+        count, means, comoments = states[0]
+        return _correlation(comoments, 0, 1)
+
+
+class Matrix(list):
+    "A list of rows of numbers with a compact string representation."
+    def __unicode__(self):
+        def format_value(value):
+            if isinstance(value, NA):
+                return unicode(value)
+            return u'%.*f' % (PRECISION, value)
+        return u'; '.join(u' '.join(format_value(x) for x in row)
+                          for row in self)
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+
+class CorrMatrix(CoMomentAggregate):
+    """
+    Pearson correlation coefficients of all pairs of given keys, as a
+    :class:`Matrix` (rows and columns follow the order of the keys). The
+    cost is a single pass regardless of the number of keys. The keys are
+    given as separate arguments or as a list::
+
+        CorrMatrix('height', 'weight', 'age', where=Where(age__gte=18))
+    """
+    def __init__(self, *keys, **options):
+        if len(keys) == 1 and isinstance(keys[0], (list, tuple)):
+            keys = keys[0]
+        unknown = set(options) - set(['na_policy', 'where'])
+        if unknown:
+            raise TypeError('Unexpected arguments: {0}'.format(
+                ', '.join(sorted(unknown))))
+        super(CorrMatrix, self).__init__(keys, **options)
+
+    @staticmethod
+    def calc(states):
+        count, means, comoments = states[0]
+        size = len(means)
+        return Matrix([_correlation(comoments, i, j) for j in range(size)]
+                      for i in range(size))
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright (c) 2009—2010 Andrey Mikhailenko and contributors
+#
+#  This file is part of Dark.
+#
+#  Dark is free software under terms of the GNU Lesser
+#  General Public License version 3 (LGPLv3) as published by the Free
+#  Software Foundation. See the file README for copying conditions.
+#
+
+"""
+Binning
+=======
+
+Tools to split continuous values (age, price, etc.) into a bounded number of
+intervals. They are used by :class:`dark.shaping.BinnedFactor` and
+:class:`dark.aggregates.Histogram`.
+
+Bins can be defined in a number of ways::
+
+    Bins(count=5)                 # five bins of equal width between min and max
+    Bins(width=10)                # [40, 50), [50, 60), ...
+    Bins(quantiles=4)             # quartiles: roughly same number of items
+    Bins(edges=[0, 18, 65, 150])  # explicit edges
+
+"""
+
+from bisect import bisect_right
+from decimal import Decimal
+
+
+__all__ = ['Bin', 'Bins', 'to_bins']
+
+
+class Bin(object):
+    """
+    An interval of values. The lower bound is always included; the upper bound
+    is only included if the bin is `closed` (this is the case for the last bin
+    of a bounded set).
+    """
+    __slots__ = ('lo', 'hi', 'closed')
+
+    def __init__(self, lo, hi, closed=False):
+        self.lo = lo
+        self.hi = hi
+        self.closed = closed
+
+    def __contains__(self, value):
+        if value is None:
+            return False
+        if self.closed:
+            return self.lo <= value <= self.hi
+        return self.lo <= value < self.hi
+
+    def __eq__(self, other):
+        return (isinstance(other, Bin) and
+                (self.lo, self.hi, self.closed) ==
+                (other.lo, other.hi, other.closed))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __lt__(self, other):
+        return (self.lo, self.hi) < (other.lo, other.hi)
+
+    def __hash__(self):
+        return hash((self.lo, self.hi, self.closed))
+
+    def __getstate__(self):
+        return self.lo, self.hi, self.closed
+
+    def __setstate__(self, state):
+        self.lo, self.hi, self.closed = state
+
+    def __unicode__(self):
+        return u'[{0}, {1}{2}'.format(self.lo, self.hi,
+                                     ']' if self.closed else ')')
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+    def __repr__(self):
+        return '<Bin %s>' % self
+
+    def conditions(self, key):
+        "Returns query conditions (lookups) selecting items in this bin."
+        upper = '__lte' if self.closed else '__lt'
+        return {key + '__gte': self.lo, key + upper: self.hi}
+
+
+def _floor_div(value, divisor):
+    # the native type is kept; Decimal division rounds towards zero
+    quotient = value // divisor
+    if quotient * divisor > value:
+        quotient -= 1
+    return quotient
+
+
+class Bins(object):
+    """
+    Specification of bins. Exactly one of the arguments must be given:
+
+    :param count:
+        number of bins of equal width between the minimum and the maximum.
+    :param width:
+        width of each bin. The edges are multiples of the width, so that
+        bins are the same across datasets.
+    :param quantiles:
+        number of bins with roughly the same number of items in each.
+    :param edges:
+        a sorted list of edges. Values outside of them are ignored.
+
+    """
+    def __init__(self, count=None, width=None, quantiles=None, edges=None):
+        given = [x for x in (count, width, quantiles, edges) if x is not None]
+        if len(given) != 1:
+            raise TypeError('Bins expect exactly one of: count, width, '
+                            'quantiles, edges.')
+        if edges is not None and list(edges) != sorted(edges):
+            raise ValueError('Bin edges must be sorted.')
+        self.count = count
+        self.width = width
+        self.quantiles = quantiles
+        self.edges = list(edges) if edges is not None else None
+
+    def __repr__(self):
+        for name in 'count', 'width', 'quantiles', 'edges':
+            if getattr(self, name) is not None:
+                return '<Bins {0}={1}>'.format(name, getattr(self, name))
+
+    @property
+    def needs_all_values(self):
+        "`True` if duplicate values affect the edges (i.e. for quantiles)."
+        return self.quantiles is not None
+
+    def get_edges(self, values):
+        """
+        Returns a pair `(edges, closed)` for given values. If `closed` is
+        `True`, the last edge belongs to the last bin.
+        """
+        if self.edges is not None:
+            return self.edges, True
+        values = sorted(v for v in values if v is not None)
+        if not values:
+            return [], True
+        lowest, highest = values[0], values[-1]
+        if self.width is not None:
+            width = self.width
+            # Decimal and float cannot be mixed
+            if isinstance(width, float) and isinstance(lowest, Decimal):
+                width = Decimal(repr(width))
+            elif isinstance(width, Decimal) and isinstance(lowest, float):
+                width = float(width)
+            start = _floor_div(lowest, width) * width
+            if isinstance(width, (int, long)):
+                start = int(start)
+            num = int(_floor_div(highest - start, width)) + 1
+            return [start + i * width for i in range(num + 1)], False
+        if lowest == highest:
+            return [lowest, highest], True
+        if self.count is not None:
+            span = highest - lowest
+            if isinstance(span, Decimal):
+                step = span / self.count
+            else:
+                step = span / float(self.count)
+            edges = [lowest + i * step for i in range(self.count)]
+            return edges + [highest], True
+        # quantiles
+        last = len(values) - 1
+        edges = []
+        for i in range(self.quantiles + 1):
+            edge = values[int(round(last * i / float(self.quantiles)))]
+            if not edges or edges[-1] != edge:
+                edges.append(edge)
+        return edges, True
+
+    def make_bins(self, edges, closed):
+        "Returns a list of :class:`Bin` instances for given edges."
+        if len(edges) == 2 and edges[0] == edges[1]:
+            return [Bin(edges[0], edges[1], True)]
+        bins = [Bin(lo, hi) for lo, hi in zip(edges, edges[1:])]
+        if bins and closed:
+            bins[-1].closed = True
+        return bins
+
+    def locate(self, edges, closed, value):
+        "Returns the index of the bin for given value or `None`."
+        if value is None or not edges:
+            return None
+        idx = bisect_right(edges, value) - 1
+        if idx < 0:
+            return None
+        if idx >= len(edges) - 1:
+            if closed and value == edges[-1]:
+                return max(idx - 1, 0)
+            return None
+        return idx
+
+    def split(self, values, edges=None, closed=True):
+        """
+        Counts given values per bin in a single pass. Returns a list of pairs
+        `(bin, count)` including empty bins. If `edges` are not given, they are
+        calculated from the values.
+        """
+        if edges is None:
+            values = list(values)
+            edges, closed = self.get_edges(values)
+        bins = self.make_bins(edges, closed)
+        counts = [0] * len(bins)
+        locate = self.locate
+        for value in values:
+            idx = locate(edges, closed, value)
+            if idx is not None:
+                counts[idx] += 1
+        return zip(bins, counts)
+
+
+def to_bins(spec):
+    """
+    Converts a short bin specification to a :class:`Bins` instance: an integer
+    means the number of equal bins, a list means explicit edges.
+    """
+    if isinstance(spec, Bins):
+        return spec
+    if isinstance(spec, (int, long)):
+        return Bins(count=spec)
+    if isinstance(spec, (list, tuple)):
+        return Bins(edges=spec)
+    raise TypeError('Cannot interpret %r as bins.' % (spec,))
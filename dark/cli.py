@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright (c) 2009—2010 Andrey Mikhailenko and contributors
+#
+#  This file is part of Dark.
+#
+#  Dark is free software under terms of the GNU Lesser
+#  General Public License version 3 (LGPLv3) as published by the Free
+#  Software Foundation. See the file README for copying conditions.
+#
+
+"""
+Command-line interface
+======================
+
+The ``dark`` command builds a table (see :func:`dark.shaping.cast`) from a
+CSV or JSON-lines file, or from standard input::
+
+    $ dark access.csv -f status -p method -a 'Count' -a 'Avg(time)'
+    $ zcat events.jsonl.gz | dark -i jsonl -f country -f city \\
+          -a 'TopK(page, 3)' -j 4 -m 256M -o csv > report.csv
+
+Aggregates are given as ``Name`` or ``Name(arguments)``, e.g. ``Count``,
+``Sum(price)`` or ``TopK(city, 3, approximate=True)``. Items can be filtered
+with lookups (see :mod:`dark.predicates`), e.g. ``-w status__in=404,500``
+or ``-w time__range=0.5,10``.
+
+By default the input is loaded into a :class:`dark.memory.Dataset` and the
+strategy is chosen automatically. If a memory budget is given, the input is
+read once as a stream with the scan strategy; groups that do not fit into the
+budget are spilled to disk, and rows are written while the spilled groups are
+merged (unless pivot columns, a rollup or window aggregates need the whole
+table first). Aggregates such as ``Median`` keep all values of a group, so
+the budget is approximate. With ``--jobs`` the work is shared by a pool of
+processes (chunks of the input are grouped in parallel).
+
+If the input is already sorted by the factors (``--sorted``), it is read as a
+stream and each row is written as soon as its group is complete (unless
+pivot columns or a rollup need the whole table first).
+
+In CSV empty cells are treated as missing values; numbers are converted.
+"""
+
+import argparse
+import csv
+try:
+    import json
+except ImportError:
+    import simplejson as json
+from multiprocessing import Pool
+import re
+import sys
+
+import aggregates
+from memory import Dataset
+from predicates import Where
+from rendering import RENDERERS, render
+from shaping import AUTO, SCAN, SORTED, cast, compile_cast
+
+
+__all__ = ['main', 'parse_aggregate', 'parse_condition', 'parse_size',
+           'read_csv', 'read_jsonl']
+
+
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+AGGREGATE_RE = re.compile(r'^\s*(\w+)\s*(?:\((.*)\))?\s*$')
+
+
+def _convert(value):
+    # a number if it looks like one, otherwise a unicode string
+    for cast_type in int, float:
+        try:
+            return cast_type(value)
+        except ValueError:
+            pass
+    return value.decode('utf-8') if isinstance(value, str) else value
+
+def read_csv(f, **fmtparams):
+    """
+    Yields rows of a CSV file with a heading as dictionaries. Empty cells are
+    omitted; numbers are converted.
+    """
+    reader = csv.reader(f, **fmtparams)
+    try:
+        heading = [name.decode('utf-8') for name in reader.next()]
+    except StopIteration:
+        return
+    for row in reader:
+        yield dict((key, _convert(value))
+                   for key, value in zip(heading, row) if value != '')
+
+def read_jsonl(f):
+    "Yields objects from a file with one JSON object per line."
+    for line in f:
+        if line.strip():
+            yield json.loads(line)
+
+READERS = {
+    'csv': read_csv,
+    'jsonl': read_jsonl,
+}
+
+def parse_size(text):
+    "Converts a size like ``512K``, ``64M`` or ``2G`` to bytes."
+    text = text.strip().upper().rstrip('B')
+    unit = text[-1:] if text[-1:] in SIZE_UNITS else ''
+    try:
+        number = float(text[:len(text) - len(unit)])
+    except ValueError:
+        raise ValueError('Invalid size "{0}"'.format(text))
+    return int(number * SIZE_UNITS[unit])
+
+def parse_aggregate(spec):
+    """
+    Returns an aggregate for given specification, e.g. ``Count``,
+    ``Avg(age)`` or ``TopK(city, 3, approximate=True)``.
+    """
+    match = AGGREGATE_RE.match(spec)
+    if not match:
+        raise ValueError('Invalid aggregate "{0}"'.format(spec))
+    name, arguments = match.groups()
+    cls = getattr(aggregates, name, None)
+    if not (isinstance(cls, type) and issubclass(cls, aggregates.Aggregate)
+            and name in aggregates.__all__):
+        raise ValueError('Unknown aggregate "{0}"'.format(name))
+    args, kwargs = [], {}
+    for argument in (arguments or '').split(','):
+        argument = argument.strip()
+        if not argument:
+            continue
+        key, sep, value = argument.partition('=')
+        if sep:
+            value = value.strip()
+            kwargs[str(key.strip())] = {'True': True, 'False': False}.get(
+                value, _convert(value))
+        else:
+            args.append(_convert(argument))
+    try:
+        return cls(*args, **kwargs)
+    except TypeError, e:
+        raise ValueError('Invalid aggregate "{0}": {1}'.format(spec, e))
+
+def parse_condition(spec):
+    """
+    Returns a pair `(lookup, value)` for a condition like ``age__gte=18``.
+    Values of ``in`` and ``range`` lookups are separated by commas.
+    """
+    name, sep, value = spec.partition('=')
+    name = str(name.strip())
+    if not sep or not name:
+        raise ValueError('Invalid condition "{0}"'.format(spec))
+    operation = name.partition('__')[2]
+    if operation in ('in', 'range'):
+        return name, [_convert(x.strip()) for x in value.split(',')]
+    if operation == 'exists':
+        return name, value.strip().lower() in ('1', 'true', 'yes')
+    if operation == 'match':
+        return name, value.decode('utf-8')
+    return name, _convert(value)
+
+def make_parser():
+    parser = argparse.ArgumentParser(prog='dark',
+        description='Builds a pivot table from CSV or JSON-lines data.')
+    parser.add_argument('file', nargs='?', default='-',
+                        help='input file (default: standard input)')
+    parser.add_argument('-i', '--input-format', choices=sorted(READERS),
+                        help='input format (default: guessed by the file '
+                             'extension, CSV for standard input)')
+    parser.add_argument('-d', '--delimiter', default=',',
+                        help='CSV field delimiter (default: ",")')
+    parser.add_argument('-f', '--factor', action='append', default=[],
+                        help='key to group rows by (can be repeated)')
+    parser.add_argument('-p', '--pivot', action='append', default=[],
+                        help='key which values become columns '
+                             '(can be repeated)')
+    parser.add_argument('-a', '--aggregate', action='append', default=[],
+                        help='aggregate, e.g. "Count" or "Avg(age)" '
+                             '(can be repeated; default: Count)')
+    parser.add_argument('-w', '--where', action='append', default=[],
+                        help='only use items matching the condition, e.g. '
+                             '"age__gte=18" (can be repeated)')
+    parser.add_argument('-r', '--rollup', action='store_true',
+                        help='add subtotal and grand total rows')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of worker processes (default: 1)')
+    parser.add_argument('-m', '--memory-budget',
+                        help='stream the input and spill groups to disk '
+                             'above this estimated size, e.g. "256M" '
+                             '(the output table is not included)')
+    parser.add_argument('-s', '--sorted', action='store_true',
+                        help='the input is sorted by the factors (empty '
+                             'values first); group it by runs')
+    parser.add_argument('-o', '--format', default='ascii',
+                        choices=sorted(RENDERERS),
+                        help='output format (default: ascii)')
+    return parser
+
+def main(argv=None, stdin=None, stdout=None):
+    "Runs the ``dark`` command. Returns the exit status."
+    parser = make_parser()
+    args = parser.parse_args(argv)
+    stdin = sys.stdin if stdin is None else stdin
+    try:
+        aggregate_list = [parse_aggregate(spec) for spec in args.aggregate]
+        where = (Where(**dict(parse_condition(spec) for spec in args.where))
+                 if args.where else None)
+        memory_budget = (parse_size(args.memory_budget)
+                         if args.memory_budget else None)
+    except ValueError, e:
+        parser.error(str(e))
+    if args.jobs < 1:
+        parser.error('The number of jobs must be positive.')
+
+    input_format = args.input_format
+    if input_format is None:
+        is_json = args.file.endswith(('.jsonl', '.json', '.ndjson'))
+        input_format = 'jsonl' if is_json else 'csv'
+    options = {'delimiter': args.delimiter} if input_format == 'csv' else {}
+
+    f = stdin if args.file == '-' else open(args.file, 'rb')
+    pool = Pool(args.jobs) if args.jobs > 1 else None
+    try:
+        items = READERS[input_format](f, **options)
+        streaming = not args.rollup and not any(
+            isinstance(x, aggregates.WindowAggregate) for x in aggregate_list)
+        if streaming and (args.sorted or memory_budget is not None):
+            # rows are rendered while the input (or the spilled groups) is
+            # being read
+            plan = compile_cast(args.factor, args.pivot, *aggregate_list,
+                                strategy=SORTED if args.sorted else SCAN,
+                                where=where, memory_budget=memory_budget)
+            render(plan.stream(items, pool), args.format, stdout)
+            return 0
+        if args.sorted:
+            query, strategy = items, SORTED
+        elif memory_budget is None:
+            # the fastest option if the data fits into memory
+            query, strategy = Dataset(items), AUTO
+        else:
+            query, strategy = items, SCAN
+        table = cast(query, args.factor, args.pivot, *aggregate_list,
+                     rollup=args.rollup, strategy=strategy, where=where,
+                     memory_budget=memory_budget, executor=pool)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if f is not stdin:
+            f.close()
+    render(table, args.format, stdout)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright (c) 2009—2010 Andrey Mikhailenko and contributors
+#
+#  This file is part of Dark.
+#
+#  Dark is free software under terms of the GNU Lesser
+#  General Public License version 3 (LGPLv3) as published by the Free
+#  Software Foundation. See the file README for copying conditions.
+#
+
+"""
+Concurrency
+===========
+
+Tools to build tables when the storage sits behind slow I/O. :func:`cast`
+issues a lot of small queries (levels of each parent level, pivot levels and
+cells of each row) strictly one after another, so latency adds up. They are
+independent, though, and can be fetched concurrently.
+
+Source protocol
+---------------
+
+Any query accepted by :func:`cast` will do, provided that its methods
+(`where`, `values`, `count` and iteration) can be called from several threads
+at once. A source may declare the `max_concurrency` attribute to limit the
+number of simultaneous requests; `1` makes the fetching sequential.
+"""
+
+import sys
+import threading
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+
+from shaping import CastPlan
+
+
+__all__ = ['AsyncCast', 'cast_async']
+
+
+DEFAULT_CONCURRENCY = 8
+
+
+class AsyncCast(object):
+    """
+    A handle for a table being built in background. Mimics the interface of
+    :class:`multiprocessing.pool.AsyncResult`.
+    """
+    def __init__(self, func, *args):
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+        thread = threading.Thread(target=self._run, args=(func,) + args)
+        thread.daemon = True
+        thread.start()
+
+    def _run(self, func, *args):
+        try:
+            self._result = func(*args)
+        except Exception:
+            self._error = sys.exc_info()
+        finally:
+            self._done.set()
+
+    def ready(self):
+        "Returns `True` if the table is built (or building has failed)."
+        return self._done.isSet()
+
+    def wait(self, timeout=None):
+        "Waits until the table is built or until `timeout` seconds pass."
+        self._done.wait(timeout)
+        return self.ready()
+
+    def get(self, timeout=None):
+        """
+        Returns the table. Waits for it if necessary. If building failed, the
+        original exception is raised here.
+        """
+        if not self.wait(timeout):
+            raise TimeoutError('The table is not ready yet.')
+        if self._error:
+            raise self._error[0], self._error[1], self._error[2]
+        return self._result
+
+
+def _get_concurrency(query, concurrency):
+    limit = getattr(query, 'max_concurrency', None)
+    if limit:
+        concurrency = min(concurrency, limit)
+    return max(1, concurrency)
+
+def _execute(plan, query, concurrency):
+    pool = ThreadPool(concurrency)
+    try:
+        return plan.execute(query, executor=pool)
+    finally:
+        pool.close()
+        pool.join()
+
+def cast_async(basic_query, factor_names=None, pivot_factors=None, *aggregates,
+               **options):
+    """
+    Same as :func:`dark.shaping.cast` but returns immediately with an
+    :class:`AsyncCast` handle; call its `get()` method to obtain the table.
+
+    Sub-queries are fetched concurrently by a pool of threads. The pool size
+    is `concurrency` (default is 8) unless the query declares a lower
+    `max_concurrency`. The resulting table is exactly the same as the one
+    built by :func:`cast`. Other keyword options are those of :func:`cast`.
+
+    Usage::
+
+        pending = cast_async(people, ['country', 'city'], ['gender'],
+                             concurrency=16)
+        ...    # do something else
+        table = pending.get()
+
+    """
+    concurrency = options.pop('concurrency', DEFAULT_CONCURRENCY)
+    plan = CastPlan(factor_names, pivot_factors, aggregates, **options)
+    concurrency = _get_concurrency(basic_query, concurrency)
+    return AsyncCast(_execute, plan, basic_query, concurrency)
@@ -23,9 +23,6 @@ b) pick best document class for a dictionary.
 
 """
 
-from doqu import *
-
-
 __all__ = [
     'suggest_document_class',
     'field_frequency', 'print_field_frequency',
@@ -57,6 +54,9 @@ def suggest_document_class(data, classes, fit_whole_data=False,
     are sorted by structure similarity and then the first valid choice is
     picked.
     """
+    # doqu is only imported when it is really needed
+    from doqu import Document, validators
+
     assert classes
     assert hasattr(classes, '__iter__')
     assert all(issubclass(cls, Document) for cls in classes)
@@ -95,7 +95,7 @@ def suggest_document_class(data, classes, fit_whole_data=False,
             return cls
     return None
 
-def suggest_structures(query, having=None):
+def suggest_structures(query, having=None, where=None):
     """
     Analyses all documents in given database and returns a list of unique
     structures found. The usefullness of the result depends on the database:
@@ -106,6 +106,10 @@ def suggest_structures(query, having=None):
     :param having:
         list of field names that must be present in each structure.
 
+    :param where:
+        optional :class:`dark.predicates.Predicate`; other documents are
+        ignored.
+
     Usage example::
 
         from doqu import *
@@ -119,6 +123,8 @@ def suggest_structures(query, having=None):
 
     See also :func:`print_suggest_structures`.
     """
+    if where is not None:
+        query = where.filter(query)
     structures = {}  #[]
     for d in query:
         cols = tuple(sorted(d.keys()))
@@ -139,13 +145,17 @@ def print_suggest_structures(*args, **kwargs):
         print u'×{frequency:>5} ... {structure}'.format(
             frequency=frequency, structure=', '.join(structure))
 
-def field_frequency(query, having=None, raw=False):
+def field_frequency(query, having=None, raw=False, where=None):
     """
     Returns a list of pairs (field name, frequency) sorted by frequency in
-    given query (most frequent field is listed first).
+    given query (most frequent field is listed first). If a
+    :class:`dark.predicates.Predicate` is given as `where`, other documents
+    are ignored.
 
     See also :func:`print_field_frequency`.
     """
+    if where is not None:
+        query = where.filter(query)
     freqs = {}
     for document in query:
         data = document._saved_state.data if raw else document
@@ -190,8 +200,11 @@ def document_factory(structure, all_required=True):
     these records. Neither does this method guarantee that the data types would
     match.
     """
+    from doqu import Document, validators as doqu_validators
+    fields = structure
+
     # TODO: name it properly(?)
     class cls(Document):
-        structure = dict.fromkeys(structure, unicode)
-        validators = dict.fromkeys(structure, [validators.exists()])
+        structure = dict.fromkeys(fields, unicode)
+        validators = dict.fromkeys(fields, [doqu_validators.exists()])
     return cls
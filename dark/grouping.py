@@ -0,0 +1,411 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright (c) 2009—2010 Andrey Mikhailenko and contributors
+#
+#  This file is part of Dark.
+#
+#  Dark is free software under terms of the GNU Lesser
+#  General Public License version 3 (LGPLv3) as published by the Free
+#  Software Foundation. See the file README for copying conditions.
+#
+
+"""
+Grouping by scan
+================
+
+An alternative to building the table level by level. The query is iterated
+exactly once; each item is put into buckets by the tuple of its factor values
+and fed to the accumulators of the bucket. This is used by
+:func:`dark.shaping.cast` with `strategy='scan'`::
+
+    cast(people, ['country', 'city', 'gender'], [], Avg('age'),
+         strategy='scan', memory_budget=64 * 1024 * 1024)
+
+If the estimated size of the buckets exceeds `memory_budget` (in bytes), they
+are sorted by key and spilled to a temporary file. At the end the sorted runs
+are combined by a streaming k-way merge, so only one bucket per run is kept in
+memory at a time. :func:`stream_tree` yields the merged buckets in the order
+of rows without building the tree, so the rows can be written out as they
+come (see :meth:`dark.shaping.CastPlan.stream`); :func:`group_tree` builds
+the whole tree instead.
+
+The size of a bucket is estimated by its accumulators. Sums, counts,
+minimums and maximums keep constant-size partial results; aggregates which
+need all values (e.g. medians) keep them, so their buckets grow with the
+number of items.
+
+The resulting table is the same as the one built level by level: items with
+a missing key go to the `None` level, or are ignored if the parent level has
+other values for that key.
+
+If the items are already sorted by the factors, :func:`group_sorted` groups
+them by contiguous runs instead (`strategy='sorted'`): each group is complete
+as soon as the next one starts, so only the current groups are kept in
+memory.
+"""
+
+import cPickle as pickle
+import heapq
+from itertools import groupby, product
+from operator import itemgetter
+import tempfile
+
+
+__all__ = ['MISSING', 'VOID', 'Grouper', 'group_sorted', 'group_tree',
+           'stream_tree']
+
+
+class Marker(object):
+    "A special value of a bucket key. Markers survive pickling."
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return self.name
+
+    def __reduce__(self):
+        return self.name
+
+#: the item has no value for the key (or the value is `None` for a factor
+#: that only matches `None` in a dummy level, e.g. a binned factor)
+MISSING = Marker('MISSING')
+
+#: the item cannot belong to any level of the factor (e.g. an empty list)
+VOID = Marker('VOID')
+
+# key of the "total" cell of a bucket (as opposed to pivot cells)
+TOTAL = ()
+
+
+# rough costs (in bytes) used to estimate the memory taken by buckets
+BUCKET_SIZE = 400
+CELL_SIZE = 150
+VALUE_SIZE = 40
+
+
+def _rank(value):
+    # same order as sorted() of level values, markers follow `None`
+    if value is None:
+        return (0,)
+    if value is MISSING:
+        return (1,)
+    if value is VOID:
+        return (3,)
+    return (2, value)
+
+def sort_key(key):
+    "Returns a sortable representation of a bucket key."
+    return tuple(_rank(value) for value in key)
+
+
+class Grouper(object):
+    """
+    Collects accumulators of given aggregates per bucket. A bucket is a
+    dictionary of cells; each cell is a list of accumulators (or `None` for
+    aggregates that do not support accumulators).
+
+    If `memory_budget` (in bytes) is given, buckets are spilled to sorted
+    runs in temporary files whenever their estimated size exceeds it.
+    Cells are created by `new_cell` if given.
+    """
+    def __init__(self, aggregates, memory_budget=None, new_cell=None):
+        self.aggregates = aggregates
+        self.memory_budget = memory_budget
+        if new_cell is not None:
+            self.new_cell = new_cell
+        self.buckets = {}
+        self.size = 0
+        self.runs = []
+
+    def new_cell(self):
+        return [agg.accumulator() if hasattr(agg, 'accumulator') else None
+                for agg in self.aggregates]
+
+    def add(self, item, keys, cells):
+        """
+        Feeds the item to given cells of each bucket in `keys`. Buckets and
+        cells are created as needed.
+        """
+        buckets = self.buckets
+        for key in keys:
+            bucket = buckets.get(key)
+            if bucket is None:
+                bucket = buckets[key] = {}
+                self.size += BUCKET_SIZE
+            if VOID in key:
+                # the bucket only marks the existence of parent levels
+                continue
+            for cell_key in cells:
+                cell = bucket.get(cell_key)
+                if cell is None:
+                    cell = bucket[cell_key] = self.new_cell()
+                    self.size += CELL_SIZE
+                for accumulator in cell:
+                    if accumulator is not None:
+                        accumulator.add(item)
+                        if isinstance(accumulator.values, list):
+                            self.size += VALUE_SIZE
+        if self.memory_budget is not None and self.size > self.memory_budget:
+            self.spill()
+
+    def add_bucket(self, key, bucket):
+        """
+        Merges a bucket collected by another grouper (e.g. in a worker
+        process) into the bucket with the same key.
+        """
+        size = bucket_size(bucket)
+        existing = self.buckets.get(key)
+        if existing is None:
+            self.buckets[key] = bucket
+        else:
+            merge_buckets(existing, bucket)
+            size -= BUCKET_SIZE
+        self.size += size
+        if self.memory_budget is not None and self.size > self.memory_budget:
+            self.spill()
+
+    def spill(self):
+        "Writes buckets to a temporary file as a sorted run."
+        run = tempfile.TemporaryFile()
+        pickler = pickle.Pickler(run, pickle.HIGHEST_PROTOCOL)
+        for key in sorted(self.buckets, key=sort_key):
+            pickler.dump((key, self.buckets[key]))
+            pickler.clear_memo()
+        self.runs.append(run)
+        self.buckets = {}
+        self.size = 0
+
+    def _read_run(self, num, run):
+        run.seek(0)
+        unpickler = pickle.Unpickler(run)
+        while True:
+            try:
+                key, bucket = unpickler.load()
+            except EOFError:
+                run.close()
+                return
+            yield sort_key(key), num, key, bucket
+
+    def __iter__(self):
+        """
+        Yields pairs `(key, bucket)` sorted by key. Buckets with the same key
+        from different runs are merged.
+        """
+        if not self.runs:
+            for key in sorted(self.buckets, key=sort_key):
+                yield key, self.buckets[key]
+            return
+        if self.buckets:
+            self.spill()
+        runs = [self._read_run(num, run) for num, run in enumerate(self.runs)]
+        self.runs = []
+        for _, entries in groupby(heapq.merge(*runs), key=itemgetter(0)):
+            _, _, key, bucket = entries.next()
+            for _, _, _, other in entries:
+                merge_buckets(bucket, other)
+            yield key, bucket
+
+
+def bucket_size(bucket):
+    "Returns the estimated size of a bucket in bytes."
+    size = BUCKET_SIZE
+    for cell in bucket.itervalues():
+        size += CELL_SIZE
+        for accumulator in cell:
+            if accumulator is not None and isinstance(accumulator.values,
+                                                      list):
+                size += VALUE_SIZE * len(accumulator.values)
+    return size
+
+def merge_buckets(bucket, other):
+    "Merges cells of `other` bucket into `bucket`."
+    for cell_key, cell in other.iteritems():
+        if cell_key not in bucket:
+            bucket[cell_key] = cell
+            continue
+        for accumulator, other_accumulator in zip(bucket[cell_key], cell):
+            if accumulator is not None:
+                accumulator.merge(other_accumulator)
+
+def _merge_nodes(node, other, depth):
+    if not depth:
+        merge_buckets(node, other)
+        return node
+    for value, child in other.iteritems():
+        if value in node:
+            node[value] = _merge_nodes(node[value], child, depth - 1)
+        else:
+            node[value] = child
+    return node
+
+def _resolve(node, depth, siblings=False):
+    # the same rules as when levels are found by querying values of the key;
+    # `siblings` means that the node has other levels elsewhere
+    node.pop(VOID, None)
+    if MISSING in node:
+        missing = node.pop(MISSING)
+        if None in node:
+            node[None] = _merge_nodes(node[None], missing, depth - 1)
+        elif not node and not siblings:
+            node[None] = missing
+    if not node and not siblings:
+        # a dummy level, as if no value was found
+        node[None] = {}
+    if depth > 1:
+        for child in node.itervalues():
+            _resolve(child, depth - 1)
+
+def group_tree(buckets, depth, siblings=False):
+    """
+    Builds a tree of nested dictionaries (level value -> node) from sorted
+    pairs `(key, bucket)`. Leaves are buckets. Markers are resolved: missing
+    values are merged into `None` levels or dropped, void values are dropped.
+    If `siblings` is `True`, the first factor has levels that are not in
+    this tree, so missing values never make a level of their own.
+    """
+    if not depth:
+        # no factors, so there is at most one bucket
+        return dict(buckets).get((), {})
+    tree = {}
+    for key, bucket in buckets:
+        node = tree
+        for value in key[:-1]:
+            node = node.setdefault(value, {})
+        node[key[-1]] = bucket
+    _resolve(tree, depth, siblings)
+    return tree
+
+def _walk_tree(node, depth, path):
+    for value in sorted(node):
+        if depth == 1:
+            yield path + (value,), node[value]
+        else:
+            for pair in _walk_tree(node[value], depth - 1, path + (value,)):
+                yield pair
+
+def _stream_runs(pairs, level, depth, path):
+    pending = None    # buckets with `None` and missing values of this level
+    found = False
+    for value, run in groupby(pairs, lambda pair: pair[0][level]):
+        if value is VOID:
+            continue
+        if value is None or value is MISSING:
+            # they come first; whether missing values are dropped depends
+            # on the values that follow
+            if pending is None:
+                pending = Grouper([])
+            for key, bucket in run:
+                pending.add_bucket(key[level:], bucket)
+            continue
+        if pending is not None:
+            tree = group_tree(pending, depth - level, siblings=True)
+            for pair in _walk_tree(tree, depth - level, path):
+                yield pair
+            pending = None
+        found = True
+        if level + 1 == depth:
+            # keys are unique, so this is a single bucket
+            for key, bucket in run:
+                yield path + (value,), bucket
+        else:
+            for pair in _stream_runs(run, level + 1, depth, path + (value,)):
+                yield pair
+    if pending is not None:
+        tree = group_tree(pending, depth - level)
+    elif not found:
+        # a dummy level, as if no value was found
+        tree = group_tree([], depth - level)
+    else:
+        return
+    for pair in _walk_tree(tree, depth - level, path):
+        yield pair
+
+def stream_tree(buckets, depth):
+    """
+    Same as walking the tree built by :func:`group_tree`, but the pairs
+    `(key, bucket)` are consumed as they come and pairs `(path, bucket)` are
+    yielded in the order of levels, so the tree is never built. `path` is a
+    tuple of level values. Only `None` and missing values of a level are
+    kept until the next value of the level is found.
+    """
+    if not depth:
+        yield (), group_tree(buckets, 0)
+        return
+    for pair in _stream_runs(iter(buckets), 0, depth, ()):
+        yield pair
+
+def _level_value(entry, level):
+    # missing values are sorted along with `None`
+    value = entry[0][level]
+    return None if value is MISSING else value
+
+def _group_runs(entries, level, depth, new_grouper, path):
+    pending = None    # grouper for the run of `None` and missing values
+    previous = MISSING
+    for value, run in groupby(entries, lambda entry: _level_value(entry,
+                                                                   level)):
+        if previous is not MISSING and (value is None or value <= previous):
+            raise ValueError('Items are not sorted by factors: {0!r} after '
+                             '{1!r}'.format(value, previous))
+        previous = value
+        if value is None:
+            # whether missing values are dropped depends on other levels,
+            # so this run is grouped in memory
+            pending = new_grouper()
+            for key, item, cells in run:
+                pending.add(item, [key[level:]], cells)
+            continue
+        if pending is not None:
+            tree = group_tree(pending, depth - level, siblings=True)
+            for pair in _walk_tree(tree, depth - level, path):
+                yield pair
+            pending = None
+        if level + 1 == depth:
+            grouper = new_grouper()
+            for key, item, cells in run:
+                grouper.add(item, [()], cells)
+            yield path + (value,), group_tree(grouper, 0)
+        else:
+            for pair in _group_runs(run, level + 1, depth, new_grouper,
+                                    path + (value,)):
+                yield pair
+    if pending is not None:
+        tree = group_tree(pending, depth - level)
+        for pair in _walk_tree(tree, depth - level, path):
+            yield pair
+
+def group_sorted(entries, depth, new_grouper):
+    """
+    Groups items sorted by their bucket keys and yields pairs `(path,
+    bucket)` in the order of levels, each as soon as the group is complete.
+    `path` is a tuple of level values.
+
+    `entries` are triples `(key, item, cells)` where `key` is the single
+    bucket key of the item (see :meth:`Grouper.add`). Within each parent
+    level, `None` and missing values must come first; they are grouped in
+    memory with a grouper made by `new_grouper`. Other groups are only kept
+    until the next one starts. `ValueError` is raised if the items are not
+    sorted.
+    """
+    found = False
+    for pair in _group_runs(entries, 0, depth, new_grouper, ()):
+        found = True
+        yield pair
+    if not found:
+        # dummy levels, as if no value was found
+        for pair in _walk_tree(group_tree([], depth), depth, ()):
+            yield pair
+
+def bucket_keys(key_sets):
+    """
+    Returns bucket keys for an item given the sets of its keys per factor.
+    An empty set stops the key with :data:`VOID`.
+    """
+    for num, keys in enumerate(key_sets):
+        if not keys:
+            prefixes = product(*key_sets[:num])
+            padding = (VOID,) * (len(key_sets) - num)
+            return [prefix + padding for prefix in prefixes]
+    return list(product(*key_sets))
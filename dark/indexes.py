@@ -0,0 +1,472 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright (c) 2009—2010 Andrey Mikhailenko and contributors
+#
+#  This file is part of Dark.
+#
+#  Dark is free software under terms of the GNU Lesser
+#  General Public License version 3 (LGPLv3) as published by the Free
+#  Software Foundation. See the file README for copying conditions.
+#
+
+"""
+Indexes
+=======
+
+Precalculated information about the data. An index is built once (or
+maintained by calling its `add()` method whenever an item is inserted) and can
+be saved to a file and loaded later.
+
+:class:`StatsIndex` keeps summary statistics per key, so that
+:func:`dark.shaping.summary` and :func:`dark.shaping.stdev` do not need to
+scan and sort the data::
+
+    index = StatsIndex(['age', 'height']).update(people)
+    index.save('people.stats')
+    ...
+    summary(people, 'age', index=StatsIndex.load('people.stats'))
+
+The index must describe the same items as the query it is used with.
+
+:class:`DistinctValuesIndex` keeps the number of items per distinct value of
+each key. A query wrapped with the index finds the levels of a factor (and
+the number of items) without reading the data::
+
+    index = DistinctValuesIndex(['country', 'gender']).update(people)
+    ...
+    index.add(person)    # on insert
+    index.remove(person) # on delete
+    cast(index.wrap(people), ['country'], ['gender'], Avg('age'))
+"""
+
+import cPickle as pickle
+import random
+
+import aggregates
+from aggregates import Aggregate, LazyCalculation, Median, NA, Qu1, Qu3
+
+
+__all__ = ['DistinctValuesIndex', 'Index', 'IndexedQuery', 'KeyStats',
+           'QuantileSketch', 'StatsIndex']
+
+
+class QuantileSketch(object):
+    """
+    A compact summary of a stream of values for approximate quantiles (a
+    simplified KLL sketch by Karnin, Lang and Liberty, 2016). Values are kept
+    as is until there are `capacity` of them; after that half of the sorted
+    values of a level are promoted to the next level with double weight.
+    Whether the even or the odd values are promoted is chosen at random, so
+    that errors do not accumulate in one direction; pass a `seed` to get the
+    same results every time. Memory grows with the logarithm of the number
+    of values.
+    """
+    def __init__(self, capacity=200, seed=None):
+        self.capacity = capacity
+        self.levels = [[]]
+        self.count = 0
+        self.random = random.Random(seed)
+
+    def __getstate__(self):
+        return self.capacity, self.levels, self.count, self.random
+
+    def __setstate__(self, state):
+        if len(state) == 3:
+            # saved before the choice of values was random
+            state += (random.Random(),)
+        self.capacity, self.levels, self.count, self.random = state
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def exact(self):
+        "`True` if all values are kept (i.e. nothing was compacted yet)."
+        return len(self.levels) == 1
+
+    def add(self, value):
+        self.levels[0].append(value)
+        self.count += 1
+        if len(self.levels[0]) >= self.capacity:
+            self._compact()
+
+    def merge(self, other):
+        "Adds values summarized by another sketch."
+        for height, items in enumerate(other.levels):
+            if len(self.levels) <= height:
+                self.levels.append([])
+            self.levels[height].extend(items)
+        self.count += other.count
+        self._compact()
+
+    def _compact(self):
+        height = 0
+        while height < len(self.levels):
+            items = self.levels[height]
+            if len(items) >= self.capacity:
+                items.sort()
+                # an odd item stays on this level
+                rest = [items.pop()] if len(items) % 2 else []
+                # a fixed choice would always drop the same half
+                offset = self.random.randint(0, 1)
+                if len(self.levels) == height + 1:
+                    self.levels.append([])
+                self.levels[height + 1].extend(items[offset::2])
+                self.levels[height] = rest
+            height += 1
+
+    def values(self):
+        "Returns all values, sorted. Only available if the sketch is exact."
+        if not self.exact:
+            raise ValueError('The sketch does not keep all values.')
+        return sorted(self.levels[0])
+
+    def quantile(self, fraction):
+        "Returns the (approximate) value at given fraction of sorted values."
+        weighted = sorted((value, 2 ** height)
+                          for height, items in enumerate(self.levels)
+                          for value in items)
+        if not weighted:
+            return None
+        target = fraction * sum(weight for value, weight in weighted)
+        passed = 0
+        for value, weight in weighted:
+            passed += weight
+            if passed >= target:
+                return value
+        return weighted[-1][0]
+
+
+class Computed(Aggregate):
+    "A pseudo-aggregate which result is already known from the index."
+    def __init__(self, key, name, func):
+        self.key = key
+        self._name = name
+        self.func = func
+
+    def name(self):
+        return self._name
+
+    def calc(self, values):
+        return self.func()
+
+
+class KeyStats(object):
+    """
+    Statistics on the values of a single key: number of values, number of
+    N/A values (`None` or missing key), sum, sum of squares, minimum, maximum
+    and a :class:`QuantileSketch`. Only numbers can be indexed.
+    """
+    __slots__ = ('key', 'count', 'na_count', 'sum', 'sumsq', 'min', 'max',
+                 'sketch')
+
+    def __init__(self, key, capacity=200):
+        self.key = key
+        self.count = 0
+        self.na_count = 0
+        self.sum = 0
+        self.sumsq = 0
+        self.min = None
+        self.max = None
+        self.sketch = QuantileSketch(capacity)
+
+    def __getstate__(self):
+        return [getattr(self, name) for name in self.__slots__]
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+    def __repr__(self):
+        return '<KeyStats {0}: {1} values, {2} N/A>'.format(
+            self.key, self.count, self.na_count)
+
+    def add(self, value):
+        if value is None:
+            self.na_count += 1
+            return
+        if not aggregates._is_number(value):
+            raise TypeError('Cannot index non-numeric value {0!r} of key '
+                            '"{1}"'.format(value, self.key))
+        self.count += 1
+        self.sum += value
+        self.sumsq += value * value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or self.max < value:
+            self.max = value
+        self.sketch.add(value)
+
+    def merge(self, other):
+        "Adds statistics of another part of the data."
+        self.count += other.count
+        self.na_count += other.na_count
+        self.sum += other.sum
+        self.sumsq += other.sumsq
+        for value in other.min, other.max:
+            if value is not None:
+                if self.min is None or value < self.min:
+                    self.min = value
+                if self.max is None or self.max < value:
+                    self.max = value
+        self.sketch.merge(other.sketch)
+
+    def _known(self, name, func):
+        return LazyCalculation(Computed(self.key, name, func), [None])
+
+    def average(self):
+        "Returns the average as a lazy calculation (same as `Avg`)."
+        if not self.count:
+            return NA()
+        def calc():
+            if aggregates.NUMERIC_MODE == aggregates.EXACT:
+                return aggregates.to_decimal(self.sum) / self.count
+            return float(self.sum) / self.count
+        return self._known('Avg', calc)
+
+    def quantiles(self):
+        """
+        Returns the first quartile, the median and the third quartile as lazy
+        calculations. They are the same as `Qu1`, `Median` and `Qu3` while the
+        sketch is exact, and approximate afterwards.
+        """
+        if not self.count:
+            return NA(), NA(), NA()
+        if self.sketch.exact:
+            values = self.sketch.values()
+            return tuple(LazyCalculation(agg(self.key), values)
+                         for agg in (Qu1, Median, Qu3))
+        quantile = self.sketch.quantile
+        return tuple(self._known(name, lambda f=fraction: quantile(f))
+                     for name, fraction in (('Qu1', 0.25), ('Median', 0.5),
+                                            ('Qu3', 0.75)))
+
+    def summary(self):
+        "Returns the cells of :func:`dark.shaping.summary`."
+        if not self.count:
+            return (NA(),) * 6
+        qu1, median, qu3 = self.quantiles()
+        return (self._known('Min', lambda: self.min), qu1, median,
+                self.average(), qu3, self._known('Max', lambda: self.max))
+
+
+class Index(object):
+    "Base class for indexes that can be saved to a file."
+
+    def save(self, path):
+        "Saves the index to a file."
+        f = open(path, 'wb')
+        try:
+            pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+
+    @classmethod
+    def load(cls, path):
+        "Loads an index saved by :meth:`save`."
+        f = open(path, 'rb')
+        try:
+            return pickle.load(f)
+        finally:
+            f.close()
+
+
+class StatsIndex(Index):
+    """
+    Summary statistics for given keys (see :class:`KeyStats`). Items are
+    added one by one with :meth:`add` or in bulk with :meth:`update`.
+    `capacity` is the number of values per level of the quantile sketches.
+    """
+    def __init__(self, keys, capacity=200):
+        self.keys = list(keys)
+        self.count = 0
+        self.stats = dict((key, KeyStats(key, capacity)) for key in self.keys)
+
+    def __repr__(self):
+        return '<StatsIndex {0} for {1} items>'.format(self.keys, self.count)
+
+    def __getitem__(self, key):
+        return self.stats[key]
+
+    def __contains__(self, key):
+        return key in self.stats
+
+    def add(self, item):
+        "Updates statistics with an item (e.g. when it is inserted)."
+        self.count += 1
+        for key, stats in self.stats.iteritems():
+            stats.add(item.get(key))
+
+    def update(self, items):
+        "Adds all given items. Returns the index itself."
+        for item in items:
+            self.add(item)
+        return self
+
+    def merge(self, other):
+        "Adds statistics of another index built for the same keys."
+        self.count += other.count
+        for key, stats in self.stats.iteritems():
+            stats.merge(other.stats[key])
+
+    def has_na(self, key):
+        """
+        Returns `False` if the key is indexed and none of the items lack a
+        value for it, `True` otherwise.
+        """
+        stats = self.stats.get(key)
+        return stats is None or stats.na_count > 0
+
+
+def _item_values(item, key):
+    # same semantics as `query.values()`: lists are unwrapped, missing keys
+    # and unhashable values are ignored
+    if key not in item:
+        return ()
+    value = item[key]
+    if isinstance(value, (list, tuple)):
+        return set(x for x in value if getattr(x, '__hash__', None))
+    if getattr(value, '__hash__', None):
+        return (value,)
+    return ()
+
+
+class DistinctValuesIndex(Index):
+    """
+    The number of items per distinct value of given keys. The index is
+    maintained by calling :meth:`add` and :meth:`remove` when items are
+    inserted or deleted. Sorted levels are cached until a value appears or
+    disappears.
+    """
+    def __init__(self, keys):
+        self.keys = list(keys)
+        self.count = 0
+        self.counts = dict((key, {}) for key in self.keys)
+        self._levels = {}
+
+    def __repr__(self):
+        return '<DistinctValuesIndex {0} for {1} items>'.format(self.keys,
+                                                                self.count)
+
+    def __contains__(self, key):
+        return key in self.counts
+
+    def __getstate__(self):
+        # sorted levels are not saved
+        return self.keys, self.count, self.counts
+
+    def __setstate__(self, state):
+        self.keys, self.count, self.counts = state
+        self._levels = {}
+
+    def add(self, item):
+        "Counts the values of an item (e.g. when it is inserted)."
+        self.count += 1
+        for key, counts in self.counts.iteritems():
+            for value in _item_values(item, key):
+                if value in counts:
+                    counts[value] += 1
+                else:
+                    counts[value] = 1
+                    self._levels.pop(key, None)
+
+    def remove(self, item):
+        """
+        Discounts the values of an item (e.g. when it is deleted). Raises
+        `ValueError` if the item could not have been added: the index is
+        left unchanged then.
+        """
+        found = [(key, counts, _item_values(item, key))
+                 for key, counts in self.counts.iteritems()]
+        if not self.count or any(value not in counts
+                                 for key, counts, values in found
+                                 for value in values):
+            raise ValueError('{0!r} is not in the index'.format(item))
+        self.count -= 1
+        for key, counts, values in found:
+            for value in values:
+                if counts[value] > 1:
+                    counts[value] -= 1
+                else:
+                    del counts[value]
+                    self._levels.pop(key, None)
+
+    def update(self, items):
+        "Adds all given items. Returns the index itself."
+        for item in items:
+            self.add(item)
+        return self
+
+    def merge(self, other):
+        "Adds counts of another index built for the same keys."
+        self.count += other.count
+        for key, counts in self.counts.iteritems():
+            for value, count in other.counts[key].iteritems():
+                counts[value] = counts.get(value, 0) + count
+        self._levels = {}
+
+    def value_counts(self, key):
+        "Returns a dictionary of item counts by value of given key."
+        return dict(self.counts[key])
+
+    def levels(self, key):
+        "Returns a sorted list of distinct values of given key."
+        levels = self._levels.get(key)
+        if levels is None:
+            levels = self._levels[key] = sorted(self.counts[key])
+        return list(levels)
+
+    def wrap(self, query):
+        """
+        Returns the query that uses this index (see :class:`IndexedQuery`).
+        The index must describe the same items as the query.
+        """
+        return IndexedQuery(query, self)
+
+
+class IndexedQuery(object):
+    """
+    A query which distinct values and the number of items are taken from a
+    :class:`DistinctValuesIndex`. Sub-queries made by :meth:`where` are
+    plain queries of the wrapped backend. Other attributes (e.g.
+    `group_by`) are those of the wrapped query.
+    """
+    def __init__(self, query, index):
+        self.query = query
+        self.index = index
+
+    def __repr__(self):
+        return '<Indexed {0!r}>'.format(self.query)
+
+    def __getattr__(self, name):
+        return getattr(self.query, name)
+
+    def __iter__(self):
+        return iter(self.query)
+
+    def __len__(self):
+        return self.count()
+
+    def count(self):
+        return self.index.count
+
+    def values(self, key):
+        if key in self.index:
+            return self.index.levels(key)
+        return self.query.values(key)
+
+    def value_counts(self, key):
+        """
+        Returns a dictionary of item counts by value of given key. Lists are
+        unwrapped and missing keys are ignored, as in :meth:`values`.
+        """
+        if key in self.index:
+            return self.index.value_counts(key)
+        counts = {}
+        for item in self.query:
+            for value in _item_values(item, key):
+                counts[value] = counts.get(value, 0) + 1
+        return counts
+
+    def where(self, *predicates, **conditions):
+        return self.query.where(*predicates, **conditions)
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright (c) 2009—2010 Andrey Mikhailenko and contributors
+#
+#  This file is part of Dark.
+#
+#  Dark is free software under terms of the GNU Lesser
+#  General Public License version 3 (LGPLv3) as published by the Free
+#  Software Foundation. See the file README for copying conditions.
+#
+
+"""
+Joins
+=====
+
+Facts can be grouped by attributes that live in another source (a
+"dimension"), e.g. orders by the region of the customer::
+
+    customers = Lookup(customer_query, on='customer_id', key='id',
+                       name='customer')
+    cast(orders, ['customer.region'], [], Sum('amount'), join=[customers])
+
+The dimension is read once and hashed by `key`. While the facts are scanned,
+each fact gets the attributes of the dimension item it refers to, prefixed
+with the name of the lookup. Facts that refer to nothing keep their own
+attributes only (i.e. this is a left join), so they go to the `None` level.
+"""
+
+from predicates import Filtered, Where
+
+
+__all__ = ['Joined', 'Lookup']
+
+
+class Lookup(object):
+    """
+    A dimension joined to facts by value. `source` is any iterable of
+    dictionaries (e.g. a query). Dimension items are identified by the value
+    of `key`; facts refer to them by the value of `on` (same as `key` by
+    default). Attributes become available as ``<name>.<attribute>``; the
+    name defaults to `on`. If `fields` are given, only these attributes are
+    kept in memory.
+    """
+    def __init__(self, source, on, key=None, name=None, fields=None):
+        self.source = source
+        self.on = on
+        self.key = key or on
+        self.name = name or on
+        self.fields = fields
+        self.index = None
+
+    def __repr__(self):
+        return '<Lookup {0} by {1}>'.format(self.name, self.on)
+
+    def build(self):
+        """
+        Reads the dimension and builds the index (only once). Returns the
+        index: a dictionary of prefixed attributes by key value.
+        """
+        if self.index is not None:
+            return self.index
+        index = {}
+        prefix = self.name + '.'
+        for item in self.source:
+            value = item.get(self.key)
+            if value is None or not getattr(value, '__hash__', None):
+                continue
+            if value in index:
+                raise ValueError('Duplicate key {0!r} in dimension "{1}"'
+                                 .format(value, self.name))
+            fields = item.keys() if self.fields is None else self.fields
+            index[value] = dict((prefix + field, item[field])
+                                for field in fields if field in item)
+        self.index = index
+        return index
+
+    def attributes(self, item):
+        "Returns prefixed attributes of the dimension item the fact refers to."
+        value = item.get(self.on)
+        if not getattr(value, '__hash__', None):
+            return {}
+        return self.index.get(value, {})
+
+
+class Joined(object):
+    """
+    A query which items are extended with attributes of looked up
+    dimensions. Supports the subset of the query API used by Dark:
+    :meth:`where`, :meth:`values`, :meth:`count` and iteration.
+    """
+    def __init__(self, query, lookups):
+        self.query = query
+        self.lookups = list(lookups)
+
+    def __repr__(self):
+        return '<Joined {0!r} with {1}>'.format(self.query, self.lookups)
+
+    def __iter__(self):
+        lookups = self.lookups
+        for lookup in lookups:
+            lookup.build()
+        for item in self.query:
+            joined = dict(item)
+            for lookup in lookups:
+                joined.update(lookup.attributes(item))
+            yield joined
+
+    def __len__(self):
+        return self.count()
+
+    def count(self):
+        # joins do not change the number of items
+        try:
+            return len(self.query)
+        except TypeError:
+            return sum(1 for item in self.query)
+
+    def values(self, key):
+        # an empty predicate matches all items
+        return Filtered(self, Where()).values(key)
+
+    def where(self, **conditions):
+        # conditions may refer to joined attributes
+        return Filtered(self, Where(**conditions))
@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright (c) 2009—2010 Andrey Mikhailenko and contributors
+#
+#  This file is part of Dark.
+#
+#  Dark is free software under terms of the GNU Lesser
+#  General Public License version 3 (LGPLv3) as published by the Free
+#  Software Foundation. See the file README for copying conditions.
+#
+
+"""
+In-memory data
+==============
+
+A lightweight query over a list of dictionaries. It can be used wherever a
+:class:`doqu` query is expected (e.g. in :func:`dark.shaping.cast`)::
+
+    people = Dataset(yaml.load(open('people.yaml')))
+    cast(people.where(gender='female'), ['birth_country'])
+
+The records are never copied. Each key used in a query is indexed once: the
+column is stored as a compact array of value codes, one per record. A query
+(and thus each factor level) only keeps a sorted array of row ids, so even
+deep hierarchies with many levels are cheap to build.
+
+Semantics follow the document-oriented databases: list values are unwrapped
+(a record matches if any of the items match), and `None` matches both
+explicit `None` and missing keys.
+"""
+
+from array import array
+import re
+
+
+__all__ = ['Dataset']
+
+
+# special codes
+MISSING = -1    # the record has no such key
+MULTI = -2      # the value is a list; item codes are stored separately
+
+
+def _equals(expected, value):
+    return value == expected
+
+def _in(expected, value):
+    return value in expected
+
+def _gt(expected, value):
+    return value is not None and value > expected
+
+def _gte(expected, value):
+    return value is not None and value >= expected
+
+def _lt(expected, value):
+    return value is not None and value < expected
+
+def _lte(expected, value):
+    return value is not None and value <= expected
+
+def _range(expected, value):
+    return value is not None and expected[0] <= value <= expected[1]
+
+def _match(expected, value):
+    # `expected` is a regular expression (a string or a compiled pattern)
+    return (isinstance(value, basestring) and
+            re.search(expected, value) is not None)
+
+def _exists(expected, value):
+    return bool(expected)
+
+# lookups are checked once per distinct value of a column, not per record
+LOOKUPS = {
+    'equals': _equals,
+    'in':     _in,
+    'gt':     _gt,
+    'gte':    _gte,
+    'lt':     _lt,
+    'lte':    _lte,
+    'range':  _range,
+    'match':  _match,
+    'exists': _exists,
+}
+
+
+class Column(object):
+    "Values of a single key, encoded as an array of codes."
+    __slots__ = ('codes', 'values', 'multi')
+
+    def __init__(self, records, key):
+        codes = array('l')
+        lookup = {}
+        values = []
+        multi = {}
+
+        def encode(value):
+            code = lookup.get(value)
+            if code is None:
+                code = lookup[value] = len(values)
+                values.append(value)
+            return code
+
+        for i, record in enumerate(records):
+            if key not in record:
+                codes.append(MISSING)
+                continue
+            value = record[key]
+            if isinstance(value, (list, tuple)):
+                multi[i] = [encode(x) for x in value
+                            if getattr(x, '__hash__', None)]
+                codes.append(MULTI)
+            elif getattr(value, '__hash__', None):
+                codes.append(encode(value))
+            else:
+                # unhashable values cannot be levels; treat as empty list
+                multi[i] = []
+                codes.append(MULTI)
+
+        self.codes = codes
+        self.values = values
+        self.multi = multi
+
+
+class Table(object):
+    "Records shared by all queries of a dataset, plus the column index."
+    __slots__ = ('records', 'columns')
+
+    def __init__(self, records):
+        self.records = records if isinstance(records, list) else list(records)
+        self.columns = {}
+
+    def column(self, key):
+        column = self.columns.get(key)
+        if column is None:
+            column = self.columns[key] = Column(self.records, key)
+        return column
+
+
+class Dataset(object):
+    """
+    A query over a list of dictionaries. Supports the subset of the query API
+    used by Dark: :meth:`where`, :meth:`values`, :meth:`count`, iteration and
+    `len()`.
+
+    Supported lookups: `key=value` (default), `key__in`, `key__gt`,
+    `key__gte`, `key__lt`, `key__lte`, `key__range` (a pair of inclusive
+    bounds), `key__match` (a regular expression) and `key__exists`.
+    """
+    __slots__ = ('_table', '_rows')
+
+    def __init__(self, records):
+        self._table = Table(records)
+        self._rows = None    # None means "all rows"
+
+    @classmethod
+    def _view(cls, table, rows):
+        query = object.__new__(cls)
+        query._table = table
+        query._rows = rows
+        return query
+
+    def __repr__(self):
+        return '<Dataset: {0} items>'.format(self.count())
+
+    def __len__(self):
+        return self.count()
+
+    def __iter__(self):
+        records = self._table.records
+        if self._rows is None:
+            return iter(records)
+        return (records[i] for i in self._rows)
+
+    def _ids(self):
+        if self._rows is None:
+            return xrange(len(self._table.records))
+        return self._rows
+
+    def count(self):
+        "Returns the number of matching records."
+        if self._rows is None:
+            return len(self._table.records)
+        return len(self._rows)
+
+    def values(self, key):
+        """
+        Returns a list of distinct values for given key (in no particular
+        order). List values are unwrapped; missing keys are ignored.
+        """
+        column = self._table.column(key)
+        codes = column.codes
+        if self._rows is None:
+            found = set(codes)
+            multi = column.multi.itervalues()
+        else:
+            found = set(codes[i] for i in self._rows)
+            multi = (column.multi[i] for i in self._rows
+                     if codes[i] == MULTI)
+        if MULTI in found:
+            for item_codes in multi:
+                found.update(item_codes)
+        return [column.values[code] for code in found if code >= 0]
+
+    def na_count(self, key):
+        """
+        Returns the number of matching records where given key has no value
+        (`None` or missing). Only the column index is read.
+        """
+        column = self._table.column(key)
+        codes = column.codes
+        na_codes = [MISSING]
+        if None in column.values:
+            na_codes.append(column.values.index(None))
+        if self._rows is None:
+            return sum(codes.count(code) for code in na_codes)
+        return sum(1 for i in self._rows if codes[i] in na_codes)
+
+    def value_counts(self, key):
+        """
+        Returns a dictionary of the number of matching records by value of
+        given key. A record with a list is counted once for each distinct
+        value in it; missing keys are ignored. Only the column index is read.
+        """
+        column = self._table.column(key)
+        codes = column.codes
+        rows = xrange(len(codes)) if self._rows is None else self._rows
+        counts = [0] * len(column.values)
+        for i in rows:
+            code = codes[i]
+            if code >= 0:
+                counts[code] += 1
+            elif code == MULTI:
+                for code in set(column.multi[i]):
+                    counts[code] += 1
+        return dict((column.values[code], count)
+                    for code, count in enumerate(counts) if count)
+
+    def where(self, *predicates, **conditions):
+        """
+        Returns a new query with matching records only. Compiled predicates
+        (see :mod:`dark.predicates`) are accepted as positional arguments.
+        """
+        rows = self._ids()
+        for predicate in predicates:
+            rows = predicate.select(self, rows)
+        for name, expected in conditions.iteritems():
+            key, _, operation = name.partition('__')
+            operation = operation or 'equals'
+            if operation not in LOOKUPS:
+                raise ValueError('Unsupported lookup "{0}"'.format(name))
+            rows = self._filter(rows, key, operation, expected)
+        return self._view(self._table, rows)
+
+    def _filter(self, rows, key, operation, expected):
+        column = self._table.column(key)
+        codes = column.codes
+        multi = column.multi
+        if operation == 'exists':
+            if expected:
+                return array('l', (i for i in rows if codes[i] != MISSING))
+            return array('l', (i for i in rows if codes[i] == MISSING))
+        test = LOOKUPS[operation]
+        ok = set(code for code, value in enumerate(column.values)
+                 if test(expected, value))
+        if operation == 'equals' and expected is None:
+            # missing keys are treated as None
+            ok.add(MISSING)
+        return array('l', (i for i in rows if codes[i] in ok or
+                           (codes[i] == MULTI and ok.intersection(multi[i]))))
+
+    def group_by(self, key):
+        """
+        Splits the query by values of given key in a single pass. Returns a
+        dictionary of queries by value. The result is the same as calling
+        :meth:`where` for each value returned by :meth:`values`.
+        """
+        column = self._table.column(key)
+        codes = column.codes
+        buckets = {}
+        missing = []
+        for i in self._ids():
+            code = codes[i]
+            if code >= 0:
+                buckets.setdefault(code, []).append(i)
+            elif code == MULTI:
+                for item_code in set(column.multi[i]):
+                    buckets.setdefault(item_code, []).append(i)
+            else:
+                missing.append(i)
+        groups = {}
+        for code, rows in buckets.iteritems():
+            value = column.values[code]
+            if value is None and missing:
+                # missing keys are treated as None
+                rows = sorted(rows + missing)
+            groups[value] = self._view(self._table, array('l', rows))
+        return groups
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright (c) 2009—2010 Andrey Mikhailenko and contributors
+#
+#  This file is part of Dark.
+#
+#  Dark is free software under terms of the GNU Lesser
+#  General Public License version 3 (LGPLv3) as published by the Free
+#  Software Foundation. See the file README for copying conditions.
+#
+
+"""
+Predicates
+==========
+
+Compiled filters for :func:`dark.shaping.cast`, :func:`dark.shaping.summary`
+and the discovery functions. Conditions use the same lookups as
+:meth:`dark.memory.Dataset.where`; predicates can be combined with ``&``,
+``|`` and ``~``::
+
+    adults = Where(age__gte=18) & ~Where(email__exists=False)
+    cast(people, ['country'], [], Avg('age'),
+         where=adults | Where(name__match='^A', city__in=['Moscow', 'Tver']))
+
+Supported lookups: `key=value`, `key__in`, `key__gt`, `key__gte`,
+`key__lt`, `key__lte`, `key__range` (inclusive bounds), `key__match` (a
+regular expression) and `key__exists`.
+
+A :class:`dark.memory.Dataset` evaluates each condition once per distinct
+value of the column. Other sources are filtered item by item while they are
+scanned, so filtered reports need no extra pass over the data.
+"""
+
+from array import array
+from itertools import ifilter
+import re
+
+from memory import LOOKUPS, Dataset
+
+
+__all__ = ['AllOf', 'AnyOf', 'Filtered', 'Not', 'Predicate', 'Where']
+
+
+_MISSING = object()
+
+
+def _format_value(value):
+    if hasattr(value, 'pattern'):
+        return value.pattern
+    if isinstance(value, (set, list, tuple)):
+        items = sorted(value) if isinstance(value, set) else value
+        return ','.join(_format_value(x) for x in items)
+    return '%s' % (value,)
+
+
+class Predicate(object):
+    """
+    A condition on an item. Calling a predicate with an item returns `True`
+    if the item matches.
+    """
+    def __call__(self, item):
+        raise NotImplementedError
+
+    def __and__(self, other):
+        return AllOf(self, other)
+
+    def __or__(self, other):
+        return AnyOf(self, other)
+
+    def __invert__(self):
+        return Not(self)
+
+    def select(self, dataset, rows):
+        """
+        Returns ids of matching rows of a :class:`dark.memory.Dataset` (a
+        sorted array). Checks each record by default.
+        """
+        records = dataset._table.records
+        return array('l', (i for i in rows if self(records[i])))
+
+    def filter(self, query):
+        """
+        Returns the query filtered by this predicate: a new dataset for
+        :class:`dark.memory.Dataset`, a :class:`Filtered` query otherwise.
+        """
+        if isinstance(query, Dataset):
+            return query.where(self)
+        return Filtered(query, self)
+
+
+class Condition(object):
+    "A single lookup, e.g. `age__gte=18`."
+    __slots__ = ('key', 'operation', 'expected', 'test')
+
+    def __init__(self, name, expected):
+        key, _, operation = name.partition('__')
+        operation = operation or 'equals'
+        if operation not in LOOKUPS:
+            raise ValueError('Unsupported lookup "{0}"'.format(name))
+        if operation == 'match' and isinstance(expected, basestring):
+            expected = re.compile(expected)
+        if operation == 'in':
+            expected = set(expected)
+        self.key = key
+        self.operation = operation
+        self.expected = expected
+        self.test = LOOKUPS[operation]
+
+    def __repr__(self):
+        return '{0}__{1}={2!r}'.format(self.key, self.operation,
+                                       self.expected)
+
+    def __str__(self):
+        # same syntax as the keyword arguments
+        name = self.key
+        if self.operation != 'equals':
+            name += '__' + self.operation
+        return '%s=%s' % (name, _format_value(self.expected))
+
+    def __call__(self, item):
+        # same semantics as in Dataset: lists are unwrapped, `None` matches
+        # missing keys
+        value = item.get(self.key, _MISSING)
+        if self.operation == 'exists':
+            return (value is not _MISSING) == bool(self.expected)
+        if value is _MISSING:
+            return self.operation == 'equals' and self.expected is None
+        if isinstance(value, (list, tuple)):
+            return any(self.test(self.expected, x) for x in value
+                       if getattr(x, '__hash__', None))
+        if not getattr(value, '__hash__', None):
+            return False
+        return self.test(self.expected, value)
+
+
+class Where(Predicate):
+    "Matches items that satisfy all given conditions (lookups)."
+    def __init__(self, **conditions):
+        self.conditions = [Condition(name, conditions[name])
+                           for name in sorted(conditions)]
+
+    def __repr__(self):
+        return '<Where {0}>'.format(', '.join(repr(c)
+                                              for c in self.conditions))
+
+    def __str__(self):
+        return ', '.join(str(c) for c in self.conditions)
+
+    def __call__(self, item):
+        for condition in self.conditions:
+            if not condition(item):
+                return False
+        return True
+
+    def select(self, dataset, rows):
+        for condition in self.conditions:
+            rows = dataset._filter(rows, condition.key, condition.operation,
+                                   condition.expected)
+        return rows
+
+
+class AllOf(Predicate):
+    "Matches items that satisfy all given predicates."
+    def __init__(self, *predicates):
+        self.predicates = predicates
+
+    def __repr__(self):
+        return '<AllOf {0}>'.format(', '.join(map(repr, self.predicates)))
+
+    def __str__(self):
+        return ' & '.join('(%s)' % p for p in self.predicates)
+
+    def __call__(self, item):
+        for predicate in self.predicates:
+            if not predicate(item):
+                return False
+        return True
+
+    def select(self, dataset, rows):
+        for predicate in self.predicates:
+            rows = predicate.select(dataset, rows)
+        return rows
+
+
+class AnyOf(Predicate):
+    "Matches items that satisfy at least one of given predicates."
+    def __init__(self, *predicates):
+        self.predicates = predicates
+
+    def __repr__(self):
+        return '<AnyOf {0}>'.format(', '.join(map(repr, self.predicates)))
+
+    def __str__(self):
+        return ' | '.join('(%s)' % p for p in self.predicates)
+
+    def __call__(self, item):
+        for predicate in self.predicates:
+            if predicate(item):
+                return True
+        return False
+
+    def select(self, dataset, rows):
+        found = set()
+        for predicate in self.predicates:
+            found.update(predicate.select(dataset, rows))
+        return array('l', sorted(found))
+
+
+class Not(Predicate):
+    "Matches items that do not satisfy given predicate."
+    def __init__(self, predicate):
+        self.predicate = predicate
+
+    def __repr__(self):
+        return '<Not {0!r}>'.format(self.predicate)
+
+    def __str__(self):
+        return '~(%s)' % self.predicate
+
+    def __call__(self, item):
+        return not self.predicate(item)
+
+    def select(self, dataset, rows):
+        excluded = set(self.predicate.select(dataset, rows))
+        return array('l', (i for i in rows if i not in excluded))
+
+
+class Filtered(object):
+    """
+    A query filtered by a predicate item by item, for sources that cannot
+    evaluate predicates themselves. Supports the subset of the query API
+    used by Dark: :meth:`where`, :meth:`values`, :meth:`count` and iteration.
+    """
+    def __init__(self, query, predicate):
+        self.query = query
+        self.predicate = predicate
+
+    def __repr__(self):
+        return '<Filtered {0!r} by {1!r}>'.format(self.query, self.predicate)
+
+    def __iter__(self):
+        return ifilter(self.predicate, self.query)
+
+    def __len__(self):
+        return self.count()
+
+    def count(self):
+        return sum(1 for item in self)
+
+    def values(self, key):
+        found = set()
+        for item in self:
+            value = item.get(key, _MISSING)
+            if isinstance(value, (list, tuple)):
+                found.update(x for x in value if getattr(x, '__hash__', None))
+            elif value is not _MISSING and getattr(value, '__hash__', None):
+                found.add(value)
+        return list(found)
+
+    def where(self, **conditions):
+        return Filtered(self.query.where(**conditions), self.predicate)
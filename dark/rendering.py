@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright (c) 2009—2010 Andrey Mikhailenko and contributors
+#
+#  This file is part of Dark.
+#
+#  Dark is free software under terms of the GNU Lesser
+#  General Public License version 3 (LGPLv3) as published by the Free
+#  Software Foundation. See the file README for copying conditions.
+#
+
+"""
+Rendering tables
+================
+
+Functions that write a table built by :func:`dark.shaping.cast` to a file
+(standard output by default) in a number of formats::
+
+    render(table, 'csv', open('report.csv', 'wb'))
+
+Each cell is formatted exactly once and the output is written in large chunks.
+The CSV and JSON-lines renderers accept any iterable of rows and do not keep
+the table in memory.
+"""
+
+import csv
+from decimal import Decimal
+try:
+    import json
+except ImportError:
+    import simplejson as json
+import sys
+
+import aggregates
+
+
+__all__ = ['format_cell', 'render', 'render_ascii', 'render_csv',
+           'render_jsonl', 'render_rotated']
+
+
+# number of lines collected before writing them out
+CHUNK_SIZE = 1000
+
+
+def format_cell(value):
+    "Returns a table cell as a unicode string."
+    # handle lazy calculation (it can be coerced to str/unicode/int/float but
+    # we want nicer results)
+    if hasattr(value, 'get_result'):
+        result = value.get_result()
+        if isinstance(result, float):
+            # in the fast numeric mode rounding is only done here
+            return u'%.*f' % (aggregates.PRECISION, result)
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    return unicode(value)
+
+def _json_value(value):
+    if hasattr(value, 'get_result'):
+        value = value.get_result()
+    if isinstance(value, aggregates.NA):
+        return None
+    if isinstance(value, Decimal):
+        return float(value)
+    if value is None or isinstance(value, (bool, int, long, float,
+                                           basestring)):
+        return value
+    return format_cell(value)
+
+
+class Writer(object):
+    "Collects lines and writes them to a file in chunks."
+    def __init__(self, out=None, encoding=None):
+        self.out = sys.stdout if out is None else out
+        self.encoding = (encoding or getattr(self.out, 'encoding', None)
+                         or 'utf-8')
+        self.lines = []
+
+    def write(self, line):
+        self.lines.append(line)
+        if len(self.lines) >= CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.lines:
+            text = u'\n'.join(self.lines) + u'\n'
+            self.out.write(text.encode(self.encoding))
+            self.lines = []
+
+
+def render_ascii(table, out=None):
+    "Writes a list of lists as a nice-looking ASCII table."
+    rows = [[format_cell(cell) for cell in row] for row in table]
+    widths = []
+    for row in rows:
+        for idx, text in enumerate(row):
+            if len(widths) <= idx:
+                widths.append(len(text))
+            elif widths[idx] < len(text):
+                widths[idx] = len(text)
+    hr = lambda row: u' +-' + u'+'.join(u'-' * (2 + widths[idx])
+                                        for idx in range(len(row)))[1:] + u'+'
+    writer = Writer(out)
+    last = len(rows) - 1
+    for i, row in enumerate(rows):
+        if i == 0:
+            writer.write(hr(row))
+        writer.write(u' | ' + u' | '.join(text.rjust(widths[idx])
+                                          for idx, text in enumerate(row))
+                     + u' |')
+        if i in (0, last):
+            writer.write(hr(row))
+    writer.flush()
+
+def render_rotated(table, out=None):
+    """
+    Same as :func:`render_ascii` but rotated: the heading becomes the first
+    column and each row becomes a column. Handy for wide tables.
+    """
+    table = list(table)
+    length = max(len(row) for row in table) if table else 0
+    rotated = [[row[idx] if idx < len(row) else u'' for row in table]
+               for idx in range(length)]
+    render_ascii(rotated, out)
+
+def render_csv(table, out=None, **fmtparams):
+    """
+    Writes rows as CSV in UTF-8. Extra keyword arguments are passed to
+    :func:`csv.writer`.
+    """
+    out = sys.stdout if out is None else out
+    writer = csv.writer(out, **fmtparams)
+    chunk = []
+    for row in table:
+        chunk.append([format_cell(cell).encode('utf-8') for cell in row])
+        if len(chunk) >= CHUNK_SIZE:
+            writer.writerows(chunk)
+            chunk = []
+    writer.writerows(chunk)
+
+def render_jsonl(table, out=None):
+    """
+    Writes each row (except for the heading) as a JSON object on a separate
+    line. The keys are taken from the heading. Numbers are kept as numbers,
+    N/A becomes `null`.
+    """
+    rows = iter(table)
+    try:
+        heading = [format_cell(cell) for cell in rows.next()]
+    except StopIteration:
+        return
+    writer = Writer(out, 'utf-8')
+    dumps = json.dumps
+    # keys are encoded once; pairs keep the order of columns
+    keys = [dumps(key) + ': ' for key in heading]
+    for row in rows:
+        pairs = (key + dumps(_json_value(cell))
+                 for key, cell in zip(keys, row))
+        writer.write(u'{' + u', '.join(pairs) + u'}')
+    writer.flush()
+
+RENDERERS = {
+    'ascii': render_ascii,
+    'csv': render_csv,
+    'jsonl': render_jsonl,
+    'rotated': render_rotated,
+}
+
+def render(table, format='ascii', out=None):
+    "Writes the table in given format: ascii, rotated, csv or jsonl."
+    try:
+        renderer = RENDERERS[format]
+    except KeyError:
+        raise ValueError('Unknown format "{0}". Expected one of: {1}'.format(
+            format, ', '.join(sorted(RENDERERS))))
+    renderer(table, out)
@@ -19,11 +19,42 @@ to build HTML tables, etc. For interactive shell there is a wrapper function
 as a nice-looking ASCII table.
 """
 
+from collections import deque
+import copy
+import cPickle as pickle
+from itertools import islice
 import math
+from multiprocessing.pool import Pool, ThreadPool
+try:
+    from concurrent.futures import ProcessPoolExecutor
+except ImportError:
+    ProcessPoolExecutor = None
+
 from aggregates import *
+from binning import to_bins
+from grouping import (MISSING, TOTAL, VOID, Grouper, bucket_keys,
+                      group_sorted, group_tree, stream_tree)
+from joins import Joined
+from memory import Dataset
+from predicates import Filtered
+from rendering import render_ascii, render_rotated
+
+
+__all__ = ['BinnedFactor', 'CastPlan', 'Explanation', 'Factor', 'cast',
+           'cast_cons', 'compile_cast', 'stdev', 'summary']
+
 
+# strategies of finding levels
+LEVELS, SCAN, SORTED, AUTO = 'levels', 'scan', 'sorted', 'auto'
 
-__all__ = ['cast', 'cast_cons', 'stdev', 'summary']
+# relative costs for the automatic choice of strategy (in item visits)
+QUERY_COST = 100          # a sub-query on a generic backend
+INDEXED_QUERY_COST = 1    # a sub-query on a backend that can group (group_by)
+SCAN_ITEM_COST = 3        # grouping an item by a factor in Python
+
+# scanning with a process pool: items per task and tasks per round
+SCAN_CHUNK_SIZE = 10000
+SCAN_BATCH = 16
 
 
 # TODO: consider syntax like:
@@ -49,10 +80,61 @@ class Factor(object):
     def __iter__(self):
         return iter(self.levels)
 
-    def add_levels(self, query):
+    def spawn(self):
+        "Returns a fresh copy of this factor without any levels."
+        factor = copy.copy(self)
+        factor.levels = []
+        return factor
+
+    def prepare(self, query):
+        """
+        Called once with the whole query before any levels are found. Does
+        nothing by default.
+        """
+
+    def conditions(self, value):
+        "Returns query conditions for a level with given value."
+        return {self.key: value}
+
+    def find_values(self, query):
+        "Returns a sorted list of level values found in given query."
+        return sorted(query.values(self.key))
+
+    def estimate_levels(self, query):
+        "Returns the (estimated) number of levels in given query."
+        return len(query.values(self.key))
+
+    def split(self, query):
+        """
+        Returns a list of pairs `(value, subquery)` for levels found in given
+        query, sorted by value. If the query can group data in a single pass
+        (i.e. it provides `group_by()`), that is used instead of making a
+        sub-query for each value.
+        """
+        if hasattr(query, 'group_by'):
+            groups = query.group_by(self.key)
+            return [(value, groups[value]) for value in sorted(groups)]
+        return [(value, query.where(**self.conditions(value)))
+                for value in self.find_values(query)]
+
+    def scan_keys(self, item):
+        """
+        Returns a set of level values the item belongs to (used by the scan
+        strategy). A missing key is represented by
+        :data:`dark.grouping.MISSING`.
+        """
+        value = item.get(self.key, MISSING)
+        if isinstance(value, (list, tuple)):
+            return set(x for x in value if getattr(x, '__hash__', None))
+        if getattr(value, '__hash__', None):
+            return set([value])
+        return set()
+
+    def add_levels(self, query, found=None):
         """
         Finds factor levels filtered by given query and appends them to the whole
-        list of levels. Returns only the newly found levels.
+        list of levels. Returns only the newly found levels. If the levels were
+        already found by :meth:`split`, its result can be passed as `found`.
 
         If no level could be found, a dummy empty level is inserted so that
         all columns are present regardless of data availability.
@@ -60,46 +142,1083 @@ class Factor(object):
         Warning: query uniqueness is not checked. If same query provided twice,
         duplicates will occur.
         """
-        new_levels = [Level(self,val,query) for val in
-                        sorted(query.values(self.key))] or \
+        if found is None:
+            found = self.split(query)
+        new_levels = [Level(self,val,query,subquery) for val, subquery in found] or \
                      [Level(self,None,query)]
         self.levels.extend(new_levels)
         return new_levels
 
 
+class BinnedFactor(Factor):
+    """
+    A factor which levels are intervals of a numeric key. Grouping people by
+    exact age would yield a row per distinct age; binning keeps the table
+    small::
+
+        cast(people, [BinnedFactor('age', Bins(width=10))])
+
+    `bins` is anything accepted by :func:`dark.binning.to_bins`. The edges are
+    calculated once for the whole query, so nested levels share the bins.
+    Only bins that contain at least one value become levels.
+    """
+    def __init__(self, key, bins):
+        super(BinnedFactor, self).__init__(key)
+        self.bins = to_bins(bins)
+        self.edges = None
+        self.closed = True
+        self.intervals = []
+
+    def __repr__(self):
+        return '<BinnedFactor {key} {bins}>'.format(key=self.key,
+                                                   bins=self.bins)
+
+    def _get_values(self, query):
+        if self.bins.needs_all_values:
+            return [d.get(self.key) for d in query]
+        return list(query.values(self.key))
+
+    def spawn(self):
+        factor = super(BinnedFactor, self).spawn()
+        factor.edges = None
+        factor.intervals = []
+        return factor
+
+    def prepare(self, query):
+        if self.bins.edges is not None:
+            values = []    # explicit edges do not depend on data
+        else:
+            values = self._get_values(query)
+        self.edges, self.closed = self.bins.get_edges(values)
+        self.intervals = self.bins.make_bins(self.edges, self.closed)
+
+    def conditions(self, value):
+        if value is None:
+            return {self.key: None}
+        return value.conditions(self.key)
+
+    def find_values(self, query):
+        if self.edges is None:
+            self.prepare(query)
+        # distinct values are enough to tell which bins are not empty
+        values = query.values(self.key)
+        return [b for b, count in self.bins.split(values, self.edges,
+                                                  self.closed) if count]
+
+    def estimate_levels(self, query):
+        return len(self.intervals) or 1
+
+    def split(self, query):
+        # bins are not plain values, so each of them needs a sub-query
+        return [(value, query.where(**self.conditions(value)))
+                for value in self.find_values(query)]
+
+    def scan_keys(self, item):
+        # `None` only matches the dummy level, just like a missing key
+        value = item.get(self.key)
+        keys = set()
+        for value in value if isinstance(value, (list, tuple)) else [value]:
+            if value is None:
+                keys.add(MISSING)
+                continue
+            idx = self.bins.locate(self.edges, self.closed, value)
+            if idx is not None:
+                keys.add(self.intervals[idx])
+        return keys
+
+
 class Level(object):
-    "A factor level, i.e. an existing value."
-    def __init__(self, factor, value, query):
+    """
+    A factor level, i.e. an existing value. If the query filtered by the value
+    is already known, it can be passed as `subquery`.
+    """
+    __slots__ = ('value', 'query', 'children')
+
+    def __init__(self, factor, value, query, subquery=None):
         self.value = value
-        self.query = query.where(**{factor.key: value})
-        self.children = []
+        if subquery is None:
+            subquery = query.where(**factor.conditions(value))
+        self.query = subquery
+        self.children = ()
     def attach(self, levels):
         "Attaches a depending factor level to this level."
         if __debug__:
             for l in levels: assert(isinstance(l, Level))
-        self.children.extend(levels)
-    def get_rows(self):
-        "Returns table rows. If more than one child exists, duplicate self for each of them."
         if self.children:
-            for child in self.children:
-                for row in child.get_rows():
-                    yield [self] + row
+            self.children.extend(levels)
         else:
+            self.children = list(levels)
+    def get_rows(self):
+        """
+        Returns table rows. If more than one child exists, duplicate self for each of them.
+
+        The tree is walked iteratively; each row is copied from the current
+        path only once.
+        """
+        path = [self]
+        stack = [iter(self.children)]
+        if not self.children:
             yield [self]
+            return
+        while stack:
+            try:
+                child = stack[-1].next()
+            except StopIteration:
+                stack.pop()
+                path.pop()
+                continue
+            if child.children:
+                path.append(child)
+                stack.append(iter(child.children))
+            else:
+                yield path + [child]
     __repr__ = lambda self: '<Level %s>' % self.value
     __unicode__ = lambda self: unicode(self.value)
     __str__ = lambda self: str(self.value)
 
+class ScanLevel(Level):
+    """
+    A level found by the scan strategy. Its query is only made if needed
+    (e.g. for aggregates that do not support accumulators).
+    """
+    __slots__ = ('factor', 'parent', '_query')
+
+    def __init__(self, factor, value, parent):
+        self.value = value
+        self.factor = factor
+        self.parent = parent    # parent level or the basic query
+        self._query = None
+        self.children = ()
+
+    @property
+    def query(self):
+        if self._query is None:
+            parent = self.parent
+            if isinstance(parent, Level):
+                parent = parent.query
+            self._query = parent.where(**self.factor.conditions(self.value))
+        return self._query
+
 class CatchAllLevel(object):
     """"
     Dummy level representing 'SELECT * FROM ...' query. Inserted into the table
     if grouper factors are not specified.
     """
+    __slots__ = ('query',)
+
     def __init__(self, query):
         self.query = query
     __unicode__ = __str__ = lambda self: '(all)'
 
-def cast(basic_query, factor_names=None, pivot_factors=None, *aggregates):
+class TotalLevel(object):
+    "Dummy level in subtotal and grand total rows (see `rollup`)."
+    __slots__ = ('level',)
+
+    def __init__(self, level):
+        self.level = level    # the level which items are summarized
+
+    @property
+    def query(self):
+        # the query of a scan level is only made if needed
+        return self.level.query
+    __unicode__ = __str__ = lambda self: '(total)'
+
+class Explanation(object):
+    """
+    Describes how a table is built: the chosen strategy, the reason, the
+    estimated costs of the strategies (in item visits) and the estimates they
+    are based on. Printing it yields a readable report.
+    """
+    def __init__(self, strategy, reason, costs, **estimates):
+        self.strategy = strategy
+        self.reason = reason
+        self.costs = costs
+        self.estimates = estimates
+
+    def __repr__(self):
+        return '<Explanation {0}>'.format(self.strategy)
+
+    def __str__(self):
+        lines = ['strategy: {0} ({1})'.format(self.strategy, self.reason)]
+        for name in sorted(self.costs):
+            lines.append('cost of {0}: {1}'.format(name, self.costs[name]))
+        for name in sorted(self.estimates):
+            lines.append('{0}: {1}'.format(name, self.estimates[name]))
+        return '\n'.join(lines)
+
+class CastPlan(object):
+    """
+    A compiled :func:`cast` specification. Factors, pivot factors and
+    aggregates are resolved once and the heading layout is prepared, so the
+    plan can be executed against any number of queries (e.g. against a new
+    dataset every day)::
+
+        plan = compile_cast(['birth_country'], ['gender'], Avg('age'))
+        table = plan.execute(todays_people)
+
+    Plans are picklable and can be cheaply sent to worker processes.
+
+    Pivot levels depend on data and are normally discovered on each execution.
+    If `remember_pivot_levels` is `True`, levels found by the first execution
+    are kept and later executions skip the discovery. Known levels can also be
+    passed as `pivot_levels`, a dictionary of level lists by factor key.
+
+    If `rollup` is `True`, subtotal rows are added for each level of each
+    factor but the last one, plus a grand total row. They are calculated by
+    merging accumulators of the rows above them, so no extra queries are made
+    (except for aggregates that cannot be merged). Note that an item with a
+    list value is counted once per level, just like in the rows.
+
+    The `strategy` defines how levels are found:
+
+    * ``'levels'`` (default): each factor level is a sub-query of its parent
+      level. This is best when the backend can filter data efficiently.
+    * ``'scan'``: the query is iterated once and items are grouped by the
+      tuple of their factor values (see :mod:`dark.grouping`). The buckets
+      are spilled to temporary files when their estimated size exceeds
+      `memory_budget` bytes. Sums, counts, minimums and maximums are kept
+      as constant-size partial results; other aggregates (e.g. medians)
+      keep their values. The table is the same, but it is kept in memory;
+      use :meth:`stream` to write it out while the runs are merged.
+    * ``'sorted'``: the query is already sorted by the factors (e.g. made
+      with ``.order_by(*factor_names)``) and is iterated once; each group is
+      a contiguous run of items and is complete as soon as the next one
+      starts (see :func:`dark.grouping.group_sorted`), so memory does not
+      grow with the number of groups. Within each parent level, `None` and
+      missing values must come first. Items with list values are not
+      supported. See also :meth:`stream`.
+    * ``'auto'``: ``'levels'`` or ``'scan'`` is picked on each execution by
+      comparing estimated costs. The estimate needs the number of items and
+      the number of levels of each factor. See :meth:`explain`.
+
+    If `stats` (a :class:`dark.indexes.StatsIndex`) is given, aggregates of
+    keys that are known to have no N/A values skip the N/A handling.
+
+    If `where` (a :class:`dark.predicates.Predicate`) is given, only matching
+    items are summarized. A :class:`dark.memory.Dataset` is filtered before
+    the table is built; other queries are filtered item by item and always
+    use the scan strategy, so the predicate is evaluated within the single
+    pass over the data.
+
+    If `join` (a list of :class:`dark.joins.Lookup` instances) is given, each
+    item is extended with attributes of the dimension items it refers to
+    before it is filtered and grouped, so these attributes can be used by
+    factors, aggregates and the predicate. Joined queries are scanned.
+    """
+    def __init__(self, factor_names=None, pivot_factors=None, aggregates=None,
+                 pivot_levels=None, remember_pivot_levels=False, rollup=False,
+                 strategy=LEVELS, memory_budget=None, stats=None, where=None,
+                 join=None):
+        if strategy not in (LEVELS, SCAN, SORTED, AUTO):
+            raise ValueError('Unknown strategy "{0}"'.format(strategy))
+        self.factors = [_to_factor(x) for x in factor_names or []]
+        self.pivot_factors = [_to_factor(x) for x in pivot_factors or []]
+        self.aggregates = list(aggregates or []) or [Count()]
+        self.pivot_levels = pivot_levels
+        self.remember_pivot_levels = remember_pivot_levels
+        self.rollup = rollup
+        self.strategy = strategy
+        self.memory_budget = memory_budget
+        self.stats = stats
+        self.where = where
+        self.join = list(join or [])
+        self.factor_heading = [factor.key for factor in self.factors]
+
+    def __repr__(self):
+        return '<CastPlan {factors} {pivots} {aggregates}>'.format(
+            factors=self.factor_heading,
+            pivots=[f.key for f in self.pivot_factors],
+            aggregates=[str(a) for a in self.aggregates])
+
+    def execute(self, query, executor=None):
+        """
+        Builds the table for given query. See :func:`cast` for details.
+
+        If `executor` is given, independent sub-queries (levels of each parent
+        level, pivot levels and each cell) are run through its `map()`
+        method, e.g. a thread pool. The order of results is preserved, so the
+        table is the same as without the executor.
+
+        A process pool (:class:`multiprocessing.Pool` or
+        :class:`concurrent.futures.ProcessPoolExecutor`) is only used for
+        cells: items of each row are fetched in this process and sent to a
+        worker which calculates all cells of the row. Pivot cells are then
+        filtered in memory (see :class:`dark.memory.Dataset`). With the scan
+        strategy the query is read in chunks of :data:`SCAN_CHUNK_SIZE`
+        items; each chunk is grouped by a worker and the resulting buckets
+        are merged in this process. At most :data:`SCAN_BATCH` chunks are
+        kept in memory at a time, so the query can be a stream.
+        """
+        processes = _is_process_pool(executor)
+        if executor is None or processes:
+            # queries and closures cannot be sent to other processes
+            mapper = map
+        else:
+            mapper = executor.map
+        query = self.filter_query(query)
+        factors, pivot_factors = self.spawn_factors(query)
+        strategy = self.strategy
+        if strategy == SORTED:
+            pass
+        elif isinstance(query, (Filtered, Joined)):
+            # the items are joined or filtered while they are scanned
+            strategy = SCAN
+        elif strategy == AUTO:
+            strategy = self.estimate(query, factors, pivot_factors).strategy
+
+        if strategy in (SCAN, SORTED):
+            if strategy == SORTED:
+                pairs = self.iter_sorted_rows(query, factors, pivot_factors)
+                table, buckets = map(list, zip(*pairs))
+            else:
+                table, buckets = self.scan_rows(
+                    query, factors, pivot_factors,
+                    executor if processes else None)
+            pivot_levels = self.find_pivot_levels(table, pivot_factors,
+                                                  buckets=buckets)
+            accumulated = [self.bucket_accumulators(bucket, pivot_levels)
+                           for bucket in buckets]
+        else:
+            table = self.find_rows(query, factors, mapper)
+            pivot_levels = self.find_pivot_levels(table, pivot_factors, mapper)
+            # (last level of each row is used for pivots and "total" aggregates)
+            if processes:
+                plan = self.worker_copy()
+                tasks = [(plan, list(row[-1].query), pivot_levels)
+                         for row in table]
+                accumulated = list(executor.map(_accumulate_items, tasks))
+            elif executor is not None:
+                accumulated = self.accumulate_cells(table, pivot_levels,
+                                                    mapper)
+            else:
+                accumulated = [self.accumulate(row[-1].query, pivot_levels)
+                               for row in table]
+        return self.build_table(query, factors, table, accumulated,
+                                pivot_levels)
+
+    __call__ = execute
+
+    def group(self, query, state=None, executor=None):
+        """
+        Groups items of the query by the factors as the scan strategy does
+        and returns the state: a picklable list of pairs `(key, bucket)`
+        with accumulators of all cells. If the `state` of previous items is
+        given, new items are added to it (the old state is consumed), so a
+        table can be kept up to date without reading the old items again::
+
+            state = plan.group(yesterday)
+            state = plan.group(today, state)
+            table = plan.execute_state(state)
+
+        Factors must not depend on data (e.g. bins of a
+        :class:`BinnedFactor` need explicit edges) when a state is updated.
+        """
+        query = self.filter_query(query)
+        factors, pivot_factors = self.spawn_factors(query)
+        if state is not None:
+            for factor in factors + pivot_factors:
+                if isinstance(factor, BinnedFactor) and \
+                   factor.bins.edges is None:
+                    raise ValueError('Bins of "{0}" depend on data, so items '
+                                     'cannot be added to a state'
+                                     .format(factor.key))
+        grouper = Grouper(self.aggregates, self.memory_budget,
+                          self.new_accumulators)
+        for key, bucket in state or []:
+            grouper.add_bucket(key, bucket)
+        self.group_items(query, factors, pivot_factors, grouper,
+                         executor if _is_process_pool(executor) else None)
+        return list(grouper)
+
+    def execute_state(self, state, query=None):
+        """
+        Builds the table from a state returned by :meth:`group`. The state
+        is copied, so it stays valid. The `query` is only needed for
+        aggregates that do not support accumulators.
+        """
+        if query is None and not all(hasattr(aggregate, 'accumulator')
+                                     for aggregate in self.aggregates):
+            raise ValueError('Aggregates without accumulators need the '
+                             'query.')
+        state = pickle.loads(pickle.dumps(state, pickle.HIGHEST_PROTOCOL))
+        factors = [factor.spawn() for factor in self.factors]
+        pivot_factors = [factor.spawn() for factor in self.pivot_factors]
+        pairs = self.path_rows(stream_tree(state, len(factors)), factors,
+                               query)
+        table, buckets = map(list, zip(*pairs))
+        pivot_levels = self.find_pivot_levels(table, pivot_factors,
+                                              buckets=buckets)
+        accumulated = [self.bucket_accumulators(bucket, pivot_levels)
+                       for bucket in buckets]
+        return self.build_table(query, factors, table, accumulated,
+                                pivot_levels)
+
+    def build_table(self, query, factors, table, accumulated, pivot_levels):
+        """
+        Finalizes the table given its rows (lists of levels) and their
+        accumulators: applies windows, adds rollups and the heading.
+        """
+        # append aggregated values
+        layout = self.make_layout(pivot_levels)
+        windowed = self.apply_windows(table, accumulated, layout)
+        if self.rollup and factors:
+            table, accumulated = self.add_rollups(query, table, accumulated,
+                                                  layout)
+        for row, accumulators in zip(table, accumulated):
+            # subtotal rows are not windowed
+            accumulators = windowed.get(id(accumulators), accumulators)
+            row.extend(self.finalize(row[-1], accumulators, layout))
+
+        # remove catch-all level
+        if not factors:
+            for row in table:
+                row.pop(0)
+
+        return [self.make_heading(pivot_levels)] + table
+
+    def stream(self, query, executor=None):
+        """
+        Yields the heading and then each row of the table for a query sorted
+        by the factors (see the ``'sorted'`` strategy). A row is yielded as
+        soon as its group is complete, so huge tables can be written out
+        while the query is being read. Unless pivot levels are known (see
+        `pivot_levels`), they are found in the whole table, so all rows are
+        kept until the end. Rollups and window aggregates need the whole
+        table and are not supported.
+
+        With the ``'scan'`` strategy the query needs not be sorted: it is
+        grouped first (see `memory_budget`), then rows are yielded while the
+        sorted runs are merged, so the table is never kept in memory. A
+        process pool can be given as `executor` (see :meth:`execute`).
+        """
+        if self.rollup or any(isinstance(x, WindowAggregate)
+                              for x in self.aggregates):
+            raise ValueError('Rollups and window aggregates need the whole '
+                             'table; use execute() instead.')
+        query = self.filter_query(query)
+        factors, pivot_factors = self.spawn_factors(query)
+        if self.strategy == SCAN:
+            pairs = self.iter_scan_rows(
+                query, factors, pivot_factors,
+                executor if _is_process_pool(executor) else None)
+        else:
+            pairs = self.iter_sorted_rows(query, factors, pivot_factors)
+        if pivot_factors and self.pivot_levels is None:
+            pairs = list(pairs)
+            pivot_levels = self.find_pivot_levels(
+                [row for row, bucket in pairs], pivot_factors,
+                buckets=[bucket for row, bucket in pairs])
+        else:
+            pivot_levels = self.find_pivot_levels(None, pivot_factors)
+        layout = self.make_layout(pivot_levels)
+        yield self.make_heading(pivot_levels)
+        for row, bucket in pairs:
+            accumulators = self.bucket_accumulators(bucket, pivot_levels)
+            row.extend(self.finalize(row[-1], accumulators, layout))
+            if not factors:
+                # remove catch-all level
+                row.pop(0)
+            yield row
+
+    def spawn_factors(self, query):
+        """
+        Returns lists of factors and pivot factors prepared for given query.
+        Factors collect levels, so each execution gets its own copies.
+        """
+        factors = [factor.spawn() for factor in self.factors]
+        pivot_factors = [factor.spawn() for factor in self.pivot_factors]
+        for factor in factors + pivot_factors:
+            factor.prepare(query)
+        return factors, pivot_factors
+
+    def explain(self, query):
+        """
+        Returns a :class:`Explanation` of how the table would be built for
+        given query, without building it.
+        """
+        query = self.filter_query(query)
+        factors, pivot_factors = self.spawn_factors(query)
+        return self.estimate(query, factors, pivot_factors)
+
+    def filter_query(self, query):
+        """
+        Returns the query joined with dimensions (see `join`) and filtered by
+        the `where` predicate.
+        """
+        if self.join:
+            query = Joined(query, self.join)
+        if self.where is not None:
+            query = self.where.filter(query)
+        return query
+
+    def worker_copy(self):
+        """
+        Returns a copy of the plan for worker processes. Items are joined
+        and filtered before they are sent, so lookups and the predicate are
+        left out.
+        """
+        plan = copy.copy(self)
+        plan.join, plan.where = [], None
+        return plan
+
+    def estimate(self, query, factors, pivot_factors):
+        """
+        Estimates costs of both strategies for given query and returns an
+        :class:`Explanation` with the chosen one. Only the number of items and
+        the number of levels of each factor are queried.
+        """
+        items = query.count()
+        levels = [f.estimate_levels(query) for f in factors]
+        if self.pivot_levels is not None:
+            pivot_levels = [len(self.pivot_levels.get(f.key, []))
+                            for f in pivot_factors]
+        else:
+            pivot_levels = [f.estimate_levels(query) for f in pivot_factors]
+
+        # a row cannot exist without items
+        rows, level_queries = 1, 0
+        for num in levels:
+            rows = max(1, min(items, rows * num))
+            level_queries += rows
+        cells = rows * (1 + sum(pivot_levels))
+        if self.pivot_levels is None:
+            # pivot levels are found for each row
+            cells += rows * len(pivot_factors)
+
+        if hasattr(query, 'group_by'):
+            query_cost = INDEXED_QUERY_COST
+        else:
+            query_cost = QUERY_COST
+        costs = {
+            LEVELS: ((level_queries + cells) * query_cost
+                     + items * (1 + len(pivot_factors))),
+            SCAN: items * (1 + len(factors) + len(pivot_factors))
+                  * SCAN_ITEM_COST,
+        }
+        if self.strategy == SORTED:
+            strategy = SORTED
+            reason = 'chosen explicitly'
+        elif isinstance(query, (Filtered, Joined)):
+            strategy = SCAN
+            reason = 'items are joined or filtered in the scan'
+        elif self.strategy == AUTO:
+            strategy = min(costs, key=lambda name: (costs[name], name))
+            reason = 'lowest estimated cost'
+        else:
+            strategy = self.strategy
+            reason = 'chosen explicitly'
+        return Explanation(strategy, reason, costs, items=items,
+                           levels=zip([f.key for f in factors], levels),
+                           pivot_levels=zip([f.key for f in pivot_factors],
+                                            pivot_levels),
+                           rows=rows, cells=cells, queries=level_queries)
+
+    def find_rows(self, query, factors, mapper=map):
+        """
+        Finds levels of given factors and returns a list of rows, each row
+        being a list of levels.
+        """
+        for num, factor in enumerate(factors):
+            if num == 0:
+                # find all available levels
+                factor.add_levels(query)
+            else:
+                # find levels for each super level (i.e. each level of parent factor)
+                super_levels = factors[num-1].levels
+                found = mapper(factor.split,
+                               [level.query for level in super_levels])
+                for super_level, pairs in zip(super_levels, found):
+                    # find levels filtered by that super level
+                    levels = factor.add_levels(super_level.query, pairs)
+                    # inform the super level about these nested levels (so that it can poll them later)
+                    super_level.attach(levels)
+
+        # poll levels of the first factor; they will recursively gather information
+        # from attached levels of other factors. This may result in multiple rows per level.
+        if factors:
+            return [row for level in factors[0] for row in level.get_rows()]
+        # a dummy level representing "SELECT * FROM ..." query
+        return [[CatchAllLevel(query)]]
+
+    def scan_rows(self, query, factors, pivot_factors, executor=None):
+        """
+        Finds rows by iterating the query once. Returns a list of rows and a
+        list of buckets (one per row) with accumulators of pivot cells and
+        "total" cells. If a process pool is given as `executor`, chunks of
+        items are grouped by its workers.
+        """
+        pairs = self.iter_scan_rows(query, factors, pivot_factors, executor)
+        table, buckets = map(list, zip(*pairs))
+        return table, buckets
+
+    def iter_scan_rows(self, query, factors, pivot_factors, executor=None):
+        """
+        Same as :meth:`scan_rows` but yields pairs `(row, bucket)` in the
+        order of rows. Once the query is grouped, rows are made while the
+        sorted runs are merged (see :func:`dark.grouping.stream_tree`).
+        """
+        grouper = Grouper(self.aggregates, self.memory_budget,
+                          self.new_accumulators)
+        self.group_items(query, factors, pivot_factors, grouper, executor)
+        return self.path_rows(stream_tree(grouper, len(factors)), factors,
+                              query)
+
+    def group_items(self, query, factors, pivot_factors, grouper,
+                    executor=None):
+        """
+        Puts all items of the query into buckets of the grouper. If a process
+        pool is given as `executor`, chunks of items are grouped by its
+        workers.
+        """
+        if executor is None:
+            self.scan_items(query, factors, pivot_factors, grouper)
+        else:
+            plan = self.worker_copy()
+            items = iter(query)
+            while True:
+                tasks = []
+                for i in range(SCAN_BATCH):
+                    chunk = list(islice(items, SCAN_CHUNK_SIZE))
+                    if not chunk:
+                        break
+                    tasks.append((plan, factors, pivot_factors, chunk))
+                if not tasks:
+                    break
+                for pairs in executor.map(_scan_items, tasks):
+                    for key, bucket in pairs:
+                        grouper.add_bucket(key, bucket)
+
+    def path_rows(self, pairs, factors, query):
+        """
+        Yields pairs `(row, bucket)` for pairs `(values, bucket)` in the
+        order of rows, where `values` is a tuple of level values. Rows of
+        the same parent level share its level objects.
+        """
+        if not factors:
+            for values, bucket in pairs:
+                yield [CatchAllLevel(query)], bucket
+            return
+        path = []
+        for values, bucket in pairs:
+            # levels of the common prefix are shared with the previous row
+            same = 0
+            while same < len(path) and path[same].value == values[same]:
+                same += 1
+            del path[same:]
+            for num in range(same, len(factors)):
+                parent = path[-1] if path else query
+                path.append(ScanLevel(factors[num], values[num], parent))
+            yield list(path), bucket
+
+    def scan_items(self, items, factors, pivot_factors, grouper):
+        "Puts each item into buckets of the grouper (see :meth:`scan_rows`)."
+        for item in items:
+            keys = bucket_keys([factor.scan_keys(item) for factor in factors])
+            grouper.add(item, keys, self.scan_cells(item, pivot_factors))
+
+    def scan_cells(self, item, pivot_factors):
+        "Returns keys of the pivot cells and the \"total\" cell of an item."
+        cells = [TOTAL]
+        for num, factor in enumerate(pivot_factors):
+            cells.extend((num, value) for value in factor.scan_keys(item))
+        return cells
+
+    def iter_sorted_rows(self, query, factors, pivot_factors):
+        """
+        Groups a query sorted by the factors by contiguous runs of items (see
+        the ``'sorted'`` strategy). Yields pairs `(row, bucket)` in the order
+        of rows, each as soon as the group is complete. Rows of the same
+        parent level share its level objects, as in :meth:`scan_rows`.
+        """
+        def new_grouper():
+            return Grouper(self.aggregates, self.memory_budget,
+                           self.new_accumulators)
+
+        if not factors:
+            grouper = new_grouper()
+            self.scan_items(query, factors, pivot_factors, grouper)
+            yield [CatchAllLevel(query)], group_tree(grouper, 0)
+            return
+
+        def entries():
+            for item in query:
+                keys = bucket_keys([f.scan_keys(item) for f in factors])
+                if len(keys) != 1 or VOID in keys[0]:
+                    raise ValueError('Items with list values cannot be '
+                                     'grouped by sorted runs: {0!r}'
+                                     .format(item))
+                yield keys[0], item, self.scan_cells(item, pivot_factors)
+
+        pairs = group_sorted(entries(), len(factors), new_grouper)
+        for pair in self.path_rows(pairs, factors, query):
+            yield pair
+
+    def bucket_accumulators(self, bucket, pivot_levels):
+        """
+        Returns a list of accumulators for pivot cells and total cells taken
+        from a bucket (see :meth:`scan_rows`). Same as :meth:`accumulate`.
+        """
+        def get_cell(key):
+            cell = bucket.get(key)
+            if cell is None:
+                cell = self.new_accumulators()
+            return cell
+
+        accumulators = []
+        for num, (factor, levels) in enumerate(pivot_levels):
+            for level in levels:
+                cell = get_cell((num, level))
+                if level is None and (num, MISSING) in bucket:
+                    # missing keys are treated as None
+                    for acc, other in zip(cell, bucket[num, MISSING]):
+                        if acc is not None:
+                            acc.merge(other)
+                accumulators.extend(cell)
+        accumulators.extend(get_cell(TOTAL))
+        return accumulators
+
+    def find_pivot_levels(self, table, pivot_factors, mapper=map,
+                          buckets=None):
+        """
+        Returns a list of pairs `(factor, levels)` where `levels` is a sorted
+        list of pivot factor levels found in the rows of the table. If the
+        `buckets` of the rows are given, levels are taken from them.
+        """
+        # XXX we do _not_ use hierarchy _within_ pivots. Is this correct?
+        if self.pivot_levels is not None:
+            return [(factor, list(self.pivot_levels.get(factor.key, [])))
+                    for factor in pivot_factors]
+
+        if not pivot_factors:
+            return []
+
+        # values found in a query always match some items, so no need to
+        # count them; each row is asked for distinct values once per factor
+        def find_row_levels(row):
+            query = row[-1].query
+            return [factor.find_values(query) for factor in pivot_factors]
+
+        def find_bucket_levels(bucket):
+            found = [[] for factor in pivot_factors]
+            for key in bucket:
+                if key is not TOTAL and key[1] is not MISSING:
+                    found[key[0]].append(key[1])
+            return found
+
+        if buckets is not None:
+            found_levels = map(find_bucket_levels, buckets)
+        else:
+            found_levels = mapper(find_row_levels, table)
+
+        # collect pivot levels filtered by all grouper factors
+        used_pivot_levels = [set() for factor in pivot_factors]
+        for found in found_levels:
+            for used, levels in zip(used_pivot_levels, found):
+                used.update(levels)
+
+        pivot_levels = [(factor, sorted(used))
+                        for factor, used in zip(pivot_factors,
+                                                used_pivot_levels)]
+        if self.remember_pivot_levels:
+            self.pivot_levels = dict((factor.key, levels)
+                                     for factor, levels in pivot_levels)
+        return pivot_levels
+
+    def make_layout(self, pivot_levels):
+        """
+        Returns a list of triples `(factor, level, aggregate)`, one per cell.
+        For "total" cells the factor and the level are `None`.
+        """
+        layout = []
+        for factor, levels in pivot_levels:
+            for level in levels:
+                for aggregate in self.aggregates:
+                    layout.append((factor, level, aggregate))
+        for aggregate in self.aggregates:
+            layout.append((None, None, aggregate))
+        return layout
+
+    def accumulate(self, query, pivot_levels):
+        """
+        Returns a list of accumulators for pivot cells and total cells of given
+        row query (`None` for aggregates that do not support accumulators).
+        """
+        accumulators = []
+        counting = self.counts_items() and hasattr(query, 'value_counts')
+        # insert pivot cells
+        for factor, levels in pivot_levels:
+            counts = None
+            if counting and type(factor) is Factor:
+                # one call instead of counting the items of each cell
+                counts = query.value_counts(factor.key)
+            for level in levels:
+                if counts is not None and level is not None:
+                    # items without the key belong to the `None` level, so
+                    # it is counted by a query
+                    accumulators.extend(self.counted(counts.get(level, 0)))
+                else:
+                    accumulators.extend(
+                        self.accumulate_cell(query, factor, level))
+        # insert "total" aggregates (by last real, non-pivot column)
+        accumulators.extend(self.accumulate_query(query))
+        return accumulators
+
+    def accumulate_cells(self, table, pivot_levels, mapper):
+        """
+        Same as :meth:`accumulate` for each row of the table but each cell is
+        a separate task for the `mapper`, so that wide pivot tables are
+        processed concurrently even if there are few rows.
+        """
+        cells = [(factor, level) for factor, levels in pivot_levels
+                 for level in levels] + [(None, None)]
+        tasks = [(row[-1].query, factor, level)
+                 for row in table for factor, level in cells]
+        results = iter(mapper(lambda task: self.accumulate_cell(*task), tasks))
+        accumulated = []
+        for row in table:
+            accumulators = []
+            for cell in cells:
+                accumulators.extend(results.next())
+            accumulated.append(accumulators)
+        return accumulated
+
+    def accumulate_cell(self, query, factor=None, level=None):
+        "Returns accumulators for a pivot cell (or the total cell) of a row."
+        if factor is not None:
+            query = query.where(**factor.conditions(level))
+        return self.accumulate_query(query)
+
+    def new_accumulator(self, aggregate):
+        """
+        Returns a new accumulator for given aggregate or `None` if the
+        aggregate does not support accumulators.
+        """
+        if not hasattr(aggregate, 'accumulator'):
+            return None
+        accumulator = aggregate.accumulator()
+        if (self.stats is not None and type(accumulator) is Accumulator
+            and not self.stats.has_na(aggregate.key)):
+            return DenseAccumulator(aggregate)
+        return accumulator
+
+    def new_accumulators(self):
+        "Returns a list of new accumulators for all aggregates."
+        return [self.new_accumulator(agg) for agg in self.aggregates]
+
+    def counts_items(self):
+        """
+        Returns `True` if all aggregates that support accumulators only count
+        items (e.g. the default `Count()`), so that the number of items is
+        enough to calculate them.
+        """
+        counting = [agg for agg in self.aggregates
+                    if hasattr(agg, 'accumulator')]
+        return bool(counting) and all(
+            isinstance(agg, Count) and not agg.key and agg.where is None
+            for agg in counting)
+
+    def counted(self, count):
+        """
+        Returns a list of new accumulators with given number of items (see
+        :meth:`counts_items`).
+        """
+        accumulators = self.new_accumulators()
+        for accumulator in accumulators:
+            if accumulator is not None:
+                accumulator.values = count
+        return accumulators
+
+    def accumulate_query(self, query):
+        """
+        Returns a list of accumulators for all aggregates in given query.
+        Aggregates share a single pass over the data.
+        """
+        accumulators = self.new_accumulators()
+        active = [acc for acc in accumulators if acc is not None]
+        rejecting = [acc for acc in active
+                     if getattr(acc.agg, 'na_policy', None) == NA.reject]
+        if rejecting:
+            # a rejected cell is final: stop reading items for it
+            for item in query:
+                for accumulator in active:
+                    accumulator.add(item)
+                if any(acc.rejected for acc in rejecting):
+                    active = [acc for acc in active if not acc.rejected]
+                    rejecting = [acc for acc in rejecting if not acc.rejected]
+                    if not active:
+                        break
+        elif active:
+            for item in query:
+                for accumulator in active:
+                    accumulator.add(item)
+        return accumulators
+
+    def finalize(self, row_level, accumulators, layout):
+        """
+        Returns cell values for a row given its last level. Cells without
+        accumulators are calculated by querying the data.
+        """
+        cells = []
+        for accumulator, (factor, level, aggregate) in zip(accumulators,
+                                                            layout):
+            if accumulator is not None:
+                cells.append(accumulator.finalize())
+            elif factor is None:
+                cells.append(aggregate.count_for(row_level.query))
+            else:
+                subquery = row_level.query.where(**factor.conditions(level))
+                cells.append(aggregate.count_for(subquery))
+        return cells
+
+    def apply_windows(self, table, accumulated, layout):
+        """
+        Combines accumulators of window aggregates (see
+        :class:`dark.aggregates.WindowAggregate`) with those of previous rows
+        of the same group in a single pass. Returns a dictionary of new lists
+        of accumulators keyed by `id()` of the original lists.
+        """
+        columns = [idx for idx, (factor, level, agg) in enumerate(layout)
+                   if isinstance(agg, WindowAggregate)]
+        if not columns:
+            return {}
+        windows = dict((idx, [deque(), layout[idx][2].accumulator(), 0])
+                       for idx in columns)
+        windowed = {}
+        previous = None
+        for row, accumulators in zip(table, accumulated):
+            if previous is None or any(a is not b for a, b
+                                       in zip(row[:-1], previous[:-1])):
+                # a new group starts
+                for idx in columns:
+                    windows[idx] = [deque(), layout[idx][2].accumulator(), 0]
+            previous = row
+            combined = list(accumulators)
+            for idx in columns:
+                states, running, rejected = windows[idx]
+                state = accumulators[idx]
+                states.append(state)
+                running.total += state.total
+                running.count += state.count
+                rejected += state.rejected
+                window = layout[idx][2].window
+                if window is not None and len(states) > window:
+                    old = states.popleft()
+                    running.total -= old.total
+                    running.count -= old.count
+                    rejected -= old.rejected
+                windows[idx][2] = rejected
+                result = layout[idx][2].accumulator()
+                result.total, result.count = running.total, running.count
+                result.rejected = bool(rejected)
+                combined[idx] = result
+            windowed[id(accumulators)] = combined
+        return windowed
+
+    def add_rollups(self, query, table, accumulated, layout):
+        """
+        Inserts a subtotal row after each group of rows sharing a level of any
+        factor but the last one, and appends the grand total row. Returns new
+        lists of rows and accumulators.
+        """
+        depth = len(table[0]) if table else 0
+
+        def new_totals():
+            return [self.new_accumulator(agg) if agg.mergeable else None
+                    for factor, level, agg in layout]
+
+        def merge(totals, accumulators):
+            for i, accumulator in enumerate(accumulators):
+                if totals[i] is None:
+                    continue
+                if accumulator is None:
+                    totals[i] = None     # will be calculated by a rescan
+                else:
+                    totals[i].merge(accumulator)
+
+        rows, results = [], []
+        grand_total = new_totals()
+        subtotals = []    # pairs (row prefix, totals) for open groups
+
+        def close_groups(num):
+            while len(subtotals) > num:
+                prefix, totals = subtotals.pop()
+                padding = [TotalLevel(prefix[-1])
+                           for i in range(depth - len(prefix))]
+                rows.append(prefix + padding)
+                results.append(totals)
+
+        previous = None
+        for row, accumulators in zip(table, accumulated):
+            # find the first level that differs from the previous row
+            same = 0
+            if previous is not None:
+                while same < depth - 1 and row[same] is previous[same]:
+                    same += 1
+            close_groups(same)
+            for num in range(same, depth - 1):
+                subtotals.append((row[:num+1], new_totals()))
+            for prefix, totals in subtotals:
+                merge(totals, accumulators)
+            merge(grand_total, accumulators)
+            rows.append(row)
+            results.append(accumulators)
+            previous = row
+        close_groups(0)
+
+        everything = CatchAllLevel(query)
+        rows.append([TotalLevel(everything) for i in range(depth)])
+        results.append(grand_total)
+        return rows, results
+
+    def make_heading(self, pivot_levels):
+        "Returns the table heading for given pivot levels."
+        aggregates = self.aggregates
+        table_heading = list(self.factor_heading)
+        for factor, levels in pivot_levels:
+            for level in levels:
+                if len(aggregates) < 2:
+                    table_heading.append(level)
+                else:
+                    for aggregate in aggregates:
+                        table_heading.append('%s %s' % (level, aggregate))
+        for aggregate in aggregates:
+            table_heading.append(str(aggregate))
+        return table_heading
+
+
+def _is_process_pool(executor):
+    if executor is None or isinstance(executor, ThreadPool):
+        return False
+    if isinstance(executor, Pool):
+        return True
+    return (ProcessPoolExecutor is not None
+            and isinstance(executor, ProcessPoolExecutor))
+
+def _accumulate_items(task):
+    # runs in a worker process, so it must be a module-level function
+    plan, items, pivot_levels = task
+    return plan.accumulate(Dataset(items), pivot_levels)
+
+def _scan_items(task):
+    # runs in a worker process; buckets are returned sorted by key
+    plan, factors, pivot_factors, items = task
+    grouper = Grouper(plan.aggregates, new_cell=plan.new_accumulators)
+    plan.scan_items(items, factors, pivot_factors, grouper)
+    return list(grouper)
+
+def _to_factor(name):
+    return name if isinstance(name, Factor) else Factor(name)
+
+def compile_cast(factor_names=None, pivot_factors=None, *aggregates, **options):
+    """
+    Compiles a :func:`cast` specification into a reusable :class:`CastPlan`.
+    Accepts the same arguments as :func:`cast` (except for the query) and
+    the keyword options of :class:`CastPlan`.
+    """
+    return CastPlan(factor_names, pivot_factors, aggregates, **options)
+
+def cast(basic_query, factor_names=None, pivot_factors=None, *aggregates,
+         **options):
     """
     Creates a table summarizing data grouped by given factors. Calculates
     aggregated values. If aggregate is not defined, all items in the query are
@@ -119,12 +1238,14 @@ def cast(basic_query, factor_names=None, pivot_factors=None, *aggregates):
         optional list of keys by which data will be grouped. Their names
         will go into the table heading, and their values will be used to
         calculate aggregated values. If more than one factor is specified, they
-        will be grouped hierarchically from left to right.
+        will be grouped hierarchically from left to right. A :class:`Factor`
+        instance (e.g. :class:`BinnedFactor`) can be used instead of a key.
 
     :param pivot_factors:
         optional list of keys which values will go into the table heading
         along with factor names so that extra columns with aggregated values
-        will be added for each possible factor level (key value).
+        will be added for each possible factor level (key value). Factor
+        instances are accepted as well.
 
     :param aggregates:
         optional list of Aggregate instances. Some aggregates require a factor
@@ -133,97 +1254,51 @@ def cast(basic_query, factor_names=None, pivot_factors=None, *aggregates):
         factor level. If aggregates are not specified,
         :class:`Count <dark.aggregates.Count>` instance is added.
 
-    :returns: a list of lists, i.e. a table.
+    :param rollup:
+        if `True`, subtotal rows and a grand total row are added. See
+        :class:`CastPlan` for details.
 
-    See tests for usage examples.
-    """
+    :param strategy:
+        ``'levels'`` (default), ``'scan'``, ``'sorted'`` (for queries sorted
+        by the factors) or ``'auto'``. See :class:`CastPlan`.
 
-    # XXX this function actually *groups* data and creates a table.
-    #     Move the grouping stuff to Query code as a method?
+    :param memory_budget:
+        approximate number of bytes the scan strategy may use for grouping
+        before spilling to disk. The resulting table is not included.
 
-    # note: mutables declared in func signature tend to migrate between calls ;)
-    factor_names  = factor_names  or []
-    pivot_factors = pivot_factors or []
-    aggregates    = aggregates    or [Count()]
+    :param where:
+        optional :class:`dark.predicates.Predicate`; only matching items are
+        summarized. See :class:`CastPlan`.
 
-    factors = [Factor(n) for n in factor_names]
-    for num, factor in enumerate(factors):
-        if num == 0:
-            # find all available levels
-            factor.add_levels(basic_query)
-        else:
-            # find levels for each super level (i.e. each level of parent factor)
-            for super_level in factors[num-1]:
-                # find levels filtered by that super level
-                levels = factor.add_levels(super_level.query)
-                # inform the super level about these nested levels (so that it can poll them later)
-                super_level.attach(levels)
-
-    # build the table    (can be extracted to another function)
-
-    table = []
-    # poll levels of the first factor; they will recursively gather information
-    # from attached levels of other factors. This may result in multiple rows per level.
-    if factors:
-        for level in factors[0]:
-            level_rows = level.get_rows()
-            for row in level_rows:
-                row_last_level = row[-1]
-                table.append(row)
-    else:
-        # a dummy level representing "SELECT * FROM ..." query
-        table.append([CatchAllLevel(basic_query)])
-
-    # XXX we do _not_ use hierarchy _within_ pivots. Is this correct?
-
-    # XXX this code is almost completely duplicated below, where we insert
-    #     pivot cells and total aggregates into rows. is there a way to unify?
+    :param join:
+        optional list of :class:`dark.joins.Lookup` instances; attributes of
+        looked up dimensions can be used as factors. See :class:`CastPlan`.
 
-    # collect pivot levels filtered by all grouper factors
-    used_pivot_levels = dict((k,[]) for k in pivot_factors)
-    for row in table:
-        last_level = row[-1]
+    :param executor:
+        optional thread or process pool (anything with a `map()` method) to
+        run independent sub-queries and cells concurrently. The table is the
+        same. See :meth:`CastPlan.execute` for details.
 
-        # collect pivot levels
-        for factor in pivot_factors:
-            for level in sorted(last_level.query.values(factor)):
-                query = last_level.query.where(**{factor:level})
-                if query.count() and level not in used_pivot_levels[factor]:
-                    used_pivot_levels[factor].append(level)
+    :param explain:
+        if `True`, the table is not built; an :class:`Explanation` of the
+        plan is returned instead.
 
-    # append aggregated values
-    for row in table:
-        last_level = row[-1] # for pivots and "total" aggregates (after pivots are inserted)
-
-        # insert pivot cells
-        for factor in pivot_factors:
-            for level in sorted(used_pivot_levels.get(factor,[])):
-                query = last_level.query.where(**{factor:level})
-                for aggregate in aggregates:
-                    row.append(aggregate.count_for(query))
+    :returns: a list of lists, i.e. a table.
 
-        # insert "total" aggregates (by last real, non-pivot column)
-        for aggregate in aggregates:
-            row.append(aggregate.count_for(last_level.query))
+    Other keyword options are passed to :class:`CastPlan`.
 
-    # remove catch-all level
-    if not factors:
-        for row in table:
-            row.pop(0)
-
-    # generate table heading
-    table_heading = factor_names
-    for factor in pivot_factors:
-        for level in sorted(used_pivot_levels.get(factor,[])):
-            if len(aggregates) < 2:
-                table_heading.append(level)
-            else:
-                for aggregate in aggregates:
-                    table_heading.append('%s %s' % (level, aggregate))
-    for aggregate in aggregates:
-        table_heading.append(str(aggregate))
+    See tests for usage examples. To run the same specification against
+    many queries, see :func:`compile_cast`.
+    """
 
-    return [table_heading] + table
+    # XXX this function actually *groups* data and creates a table.
+    #     Move the grouping stuff to Query code as a method?
+    executor = options.pop('executor', None)
+    explain = options.pop('explain', False)
+    plan = CastPlan(factor_names, pivot_factors, aggregates, **options)
+    if explain:
+        return plan.explain(basic_query)
+    return plan.execute(basic_query, executor)
 
 def cast_cons(*args, **kwargs):
     """
@@ -234,37 +1309,39 @@ def cast_cons(*args, **kwargs):
 
 def print_table(table):
     "Prints a list of lists as a nice-looking ASCII table."
-    def _format_cell(val):
-        # handle lazy calculation (it can be coerced to str/unicode/int/float but we want nicer results)
-        if hasattr(val, 'get_result'):
-            n = val.get_result()
-            if isinstance(n, float):
-                return '%.1f' % n
-        return unicode(val)
-    maxlens = []
-    for row in table:
-        for col_i, col in enumerate(row):
-            col_len = len(_format_cell(col))
-            if len(maxlens)-1 < col_i:
-                maxlens.append(col_len)
-            maxlens[col_i] = max(col_len, maxlens[col_i])
-    _hr = lambda i, row: ' +-'+ '+'.join('-'*(2+maxlens[idx]) for idx, cell in enumerate(row))[1:] +'+'
-    for i, row in enumerate(table):
-        if i == 0: print _hr(i,row)
-        print ' | '+ ' | '.join(_format_cell(cell).rjust(maxlens[idx]) for (idx, cell) in enumerate(row)) +' |'
-        if i in (0, len(table)-1): print _hr(i,row)
-
-def print_table_rotated():
-    "Same as print_table but rotated 90 by degrees clockwise."
+    render_ascii(table)
+
+def print_table_rotated(table):
+    """
+    Same as print_table but rotated: the heading becomes the first column.
+    """
     # XXX this should be an option for cast(), not cast_cons()
-    raise NotImplementedError, 'sorry, table rotation is not supported yet.'
+    render_rotated(table)
 
-def summary(query, key):
+def _filter_query(query, index, where):
+    if where is None:
+        return query
+    if index is not None:
+        raise ValueError('An index cannot be used with a predicate.')
+    return where.filter(query)
+
+def summary(query, key, index=None, where=None):
     """
     Prints a summary for given key in given query.
     (see `summary` function in R language).
+
+    If a :class:`dark.indexes.StatsIndex` built for the query is given as
+    `index`, the data is not scanned. Quartiles are approximate if the index
+    does not keep all values.
+
+    If a :class:`dark.predicates.Predicate` is given as `where`, only
+    matching items are summarized.
     """
     head = ('min', '1st qu.', 'median', 'average', '3rd qu.', 'max')
+    query = _filter_query(query, index, where)
+    if index is not None:
+        print_table([head, index[key].summary()])
+        return
     stats = (
         Min(key).count_for(query),
         Qu1(key).count_for(query),
@@ -275,8 +1352,21 @@ def summary(query, key):
     )
     print_table([head, stats])
 
-def stdev(query, key):
-    "Prints standard deviation for given key in given query."
+def stdev(query, key, index=None, where=None):
+    """
+    Prints standard deviation for given key in given query. If a
+    :class:`dark.indexes.StatsIndex` built for the query is given as `index`,
+    the data is not scanned. Only items matching the predicate `where` are
+    taken into account if it is given.
+    """
+    query = _filter_query(query, index, where)
+    if index is not None:
+        stats = index[key]
+        mean = int(stats.average())
+        # sum of (x - mean)^2 expanded to use the precalculated sums
+        squares = (stats.sumsq - 2 * mean * stats.sum
+                   + stats.count * mean * mean)
+        return math.sqrt(squares / float(index.count - 1))
     avg = Avg(key).count_for(query)
     deviations = [d[key] - int(avg) for d in query if key in d]
     variance = sum(x*x for x in deviations) / float(len(query)-1)
@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright (c) 2009—2010 Andrey Mikhailenko and contributors
+#
+#  This file is part of Dark.
+#
+#  Dark is free software under terms of the GNU Lesser
+#  General Public License version 3 (LGPLv3) as published by the Free
+#  Software Foundation. See the file README for copying conditions.
+#
+
+"""
+Snapshots
+=========
+
+A table built by :func:`dark.shaping.cast` can be saved to a file and used
+by other processes, e.g. rendered into several formats or served by a
+dashboard, without building it again::
+
+    table = cast(people, ['birth_country'], ['gender'], Avg('age'))
+    save('people.snapshot', table)
+    ...
+    snapshot = load('people.snapshot')
+    render(snapshot, 'csv', out)
+
+Cells are saved as their final values. The file is memory-mapped on load and
+rows are only decoded when they are accessed, so loading takes the same time
+for a table of any size.
+
+If the plan and its state of accumulators (see
+:meth:`dark.shaping.CastPlan.group`) are saved too, the table can be updated
+with new items without reading the old ones::
+
+    snapshot = build('events.snapshot', plan, todays_events)
+    ...
+    snapshot = snapshot.update(new_events, 'events.snapshot')
+
+Rows, the plan and the state are unpickled when they are read, and
+unpickling can run arbitrary code. Only load snapshots from trusted
+sources.
+"""
+
+import cPickle as pickle
+from decimal import Decimal
+import mmap
+import os
+import struct
+
+from shaping import CatchAllLevel, Level, TotalLevel
+
+
+__all__ = ['Snapshot', 'build', 'load', 'save']
+
+
+MAGIC = 'DARKSNAP'
+VERSION = 1
+
+# magic, version, number of rows, offset of the row index, then offsets and
+# sizes of the heading, the plan and the state
+HEADER = struct.Struct('<8sI8Q')
+
+# row offsets written at a time
+INDEX_CHUNK = 4096
+
+# kinds of cells
+VALUE, RESULT, DECIMAL, LEVEL, TOTAL = 'vrdlt'
+
+
+class SavedResult(object):
+    "A finalized aggregated value. Behaves like a calculated lazy result."
+    __slots__ = ('result',)
+
+    def __init__(self, result):
+        self.result = result
+
+    def get_result(self):
+        return self.result
+
+    def __int__(self):
+        return int(self.result)
+
+    def __float__(self):
+        return float(self.result)
+
+    def __str__(self):
+        return str(self.result)
+
+    def __unicode__(self):
+        return unicode(self.result)
+
+    def __repr__(self):
+        return '<saved {0!r}>'.format(self.result)
+
+
+class SavedLevel(object):
+    "A factor level of a saved table."
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    __unicode__ = lambda self: unicode(self.value)
+    __str__ = lambda self: str(self.value)
+
+    def __repr__(self):
+        return '<saved level {0!r}>'.format(self.value)
+
+
+def _encode_row(row):
+    kinds, values = [], []
+    for cell in row:
+        if hasattr(cell, 'get_result'):
+            cell = cell.get_result()
+            if isinstance(cell, Decimal):
+                # much shorter than a pickled Decimal
+                kinds.append(DECIMAL)
+                values.append(str(cell))
+            else:
+                kinds.append(RESULT)
+                values.append(cell)
+        elif isinstance(cell, (Level, SavedLevel)):
+            kinds.append(LEVEL)
+            values.append(cell.value)
+        elif isinstance(cell, (TotalLevel, CatchAllLevel)):
+            kinds.append(TOTAL)
+            values.append(None)
+        else:
+            kinds.append(VALUE)
+            values.append(cell)
+    return pickle.dumps((''.join(kinds), values), pickle.HIGHEST_PROTOCOL)
+
+def _decode_row(data):
+    kinds, values = pickle.loads(data)
+    row = []
+    for kind, value in zip(kinds, values):
+        if kind == VALUE:
+            row.append(value)
+        elif kind == DECIMAL:
+            row.append(SavedResult(Decimal(value)))
+        elif kind == RESULT:
+            row.append(SavedResult(value))
+        elif kind == LEVEL:
+            row.append(SavedLevel(value))
+        else:
+            row.append(TotalLevel(None))
+    return row
+
+def save(path, table, plan=None, state=None):
+    """
+    Saves a table (a list of rows, the first one being the heading) to a
+    file. Lazy calculations are done now and only their results are kept.
+    The `plan` (a :class:`dark.shaping.CastPlan`) and its `state` are needed
+    to update the table later (see :meth:`Snapshot.update`).
+
+    The file is replaced at once, so processes that have loaded the old
+    snapshot keep reading it.
+    """
+    if state is not None and plan is None:
+        raise ValueError('The state cannot be used without the plan.')
+    rows = iter(table)
+    heading = list(rows.next())
+    offsets = []
+    temp_path = path + '.tmp'
+    f = open(temp_path, 'wb')
+    try:
+        try:
+            f.write('\0' * HEADER.size)
+            position = HEADER.size
+            for row in rows:
+                data = _encode_row(row)
+                offsets.append(position)
+                f.write(data)
+                position += len(data)
+            offsets.append(position)
+            sections = []
+            for obj in heading, plan, state:
+                if obj is None:
+                    sections.extend([0, 0])
+                    continue
+                data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+                position = f.tell()
+                f.write(data)
+                sections.extend([position, len(data)])
+            index_offset = f.tell()
+            for start in xrange(0, len(offsets), INDEX_CHUNK):
+                chunk = offsets[start:start + INDEX_CHUNK]
+                f.write(struct.pack('<%dQ' % len(chunk), *chunk))
+            f.seek(0)
+            f.write(HEADER.pack(MAGIC, VERSION, len(offsets) - 1, index_offset,
+                                *sections))
+        finally:
+            f.close()
+    except:
+        os.remove(temp_path)
+        raise
+    os.rename(temp_path, path)
+
+def load(path):
+    "Loads a table saved by :func:`save`. Returns a :class:`Snapshot`."
+    return Snapshot(path)
+
+def build(path, plan, query, executor=None):
+    """
+    Groups the query with given plan (see
+    :meth:`dark.shaping.CastPlan.group`), saves the table with the state and
+    returns the :class:`Snapshot`.
+    """
+    state = plan.group(query, executor=executor)
+    save(path, plan.execute_state(state, query), plan, state)
+    return load(path)
+
+
+class Snapshot(object):
+    """
+    A saved table. Can be used as a read-only table: iteration yields the
+    heading and then each row; rows are decoded from the memory-mapped file
+    as they are accessed. `len()` includes the heading. Cells are the saved
+    values of levels and aggregates; they are rendered the same way as in
+    the original table.
+    """
+    def __init__(self, path):
+        self.path = path
+        f = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        header = HEADER.unpack_from(self._map, 0)
+        magic, version = header[:2]
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('{0} is not a snapshot of version {1}'.format(
+                path, VERSION))
+        (self.row_count, self._index_offset, heading_offset, heading_size,
+         plan_offset, plan_size, state_offset, state_size) = header[2:]
+        self.heading = self._read(heading_offset, heading_size)
+        self._plan = plan_offset, plan_size
+        self._state = state_offset, state_size
+
+    def __repr__(self):
+        return '<Snapshot {0}: {1} rows>'.format(self.path, self.row_count)
+
+    def _read(self, offset, size):
+        if not size:
+            return None
+        return pickle.loads(self._map[offset:offset + size])
+
+    def _offset(self, num):
+        return struct.unpack_from('<Q', self._map,
+                                  self._index_offset + 8 * num)[0]
+
+    def row(self, num):
+        "Returns a row by its number (the heading is not counted)."
+        if not 0 <= num < self.row_count:
+            raise IndexError('row index out of range')
+        start, end = self._offset(num), self._offset(num + 1)
+        return _decode_row(self._map[start:end])
+
+    def rows(self, start=0, stop=None):
+        "Yields rows from `start` to `stop` (the heading is not counted)."
+        stop = self.row_count if stop is None else min(stop, self.row_count)
+        for num in xrange(start, stop):
+            yield self.row(num)
+
+    def __len__(self):
+        return self.row_count + 1
+
+    def __iter__(self):
+        yield self.heading
+        for row in self.rows():
+            yield row
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if index == 0:
+            return self.heading
+        return self.row(index - 1)
+
+    @property
+    def plan(self):
+        "The saved :class:`dark.shaping.CastPlan` or `None`."
+        return self._read(*self._plan)
+
+    @property
+    def state(self):
+        "The saved state of accumulators or `None`."
+        return self._read(*self._state)
+
+    def update(self, items, path=None, executor=None):
+        """
+        Adds new items to the saved state, saves the updated table with the
+        new state to `path` (this file by default) and returns the new
+        snapshot. This snapshot is closed.
+        """
+        plan, state = self.plan, self.state
+        if state is None:
+            raise ValueError('{0} has no saved state'.format(self.path))
+        state = plan.group(items, state, executor)
+        table = plan.execute_state(state)
+        path = path or self.path
+        save(path, table, plan, state)
+        self.close()
+        return load(path)
+
+    def close(self):
+        "Releases the file."
+        self._map.close()
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright (c) 2009—2010 Andrey Mikhailenko and contributors
+#
+#  This file is part of Dark.
+#
+#  Dark is free software under terms of the GNU Lesser
+#  General Public License version 3 (LGPLv3) as published by the Free
+#  Software Foundation. See the file README for copying conditions.
+#
+
+"""
+Time series
+===========
+
+Tools for timestamped events. :class:`TimeBucket` is a factor which levels
+are periods of time (minutes, hours, days or weeks); combined with rolling
+window aggregates (:class:`dark.aggregates.MovingAvg`,
+:class:`dark.aggregates.MovingSum`, :class:`dark.aggregates.CumSum`) it
+yields time-series reports::
+
+    cast(events, [TimeBucket('time', 'day', tz=FixedOffset(180))], [],
+         Sum('amount'), MovingAvg('amount', 7), CumSum('amount'))
+
+Timestamps can be `datetime` instances (naive ones are considered UTC),
+dates or numbers of seconds since the epoch. Periods are calculated in given
+time zone (any `tzinfo` instance, e.g. from `pytz`; UTC by default). Dates
+are calendar days of that time zone, so they are not converted.
+"""
+
+import calendar
+from datetime import date, datetime, timedelta, tzinfo
+
+from grouping import MISSING
+from shaping import Factor
+
+
+__all__ = ['UTC', 'FixedOffset', 'Period', 'TimeBucket']
+
+
+ZERO = timedelta(0)
+
+
+class FixedOffset(tzinfo):
+    "A time zone with a fixed offset from UTC (in minutes)."
+    def __init__(self, offset, name=None):
+        self.offset = timedelta(minutes=offset)
+        if name is None:
+            sign = '-' if offset < 0 else '+'
+            name = 'UTC{0}{1:02d}:{2:02d}'.format(sign, *divmod(abs(offset),
+                                                               60))
+        self.name = name
+
+    def __repr__(self):
+        return '<FixedOffset {0}>'.format(self.name)
+
+    def __getinitargs__(self):
+        return self.offset.days * 1440 + self.offset.seconds // 60, self.name
+
+    def utcoffset(self, dt):
+        return self.offset
+
+    def tzname(self, dt):
+        return self.name
+
+    def dst(self, dt):
+        return ZERO
+
+UTC = FixedOffset(0, 'UTC')
+
+
+UNITS = {
+    'minute': timedelta(minutes=1),
+    'hour':   timedelta(hours=1),
+    'day':    timedelta(days=1),
+    'week':   timedelta(weeks=1),
+}
+
+FORMATS = {
+    'minute': '%Y-%m-%d %H:%M',
+    'hour':   '%Y-%m-%d %H:00',
+    'day':    '%Y-%m-%d',
+    'week':   '%Y-%m-%d',
+}
+
+
+class Period(object):
+    "A period of time from `start` (inclusive) to `end` (exclusive)."
+    __slots__ = ('start', 'end', 'unit')
+
+    def __init__(self, start, end, unit):
+        self.start = start
+        self.end = end
+        self.unit = unit
+
+    def __eq__(self, other):
+        return (isinstance(other, Period) and
+                (self.start, self.unit) == (other.start, other.unit))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __lt__(self, other):
+        return self.start < other.start
+
+    def __hash__(self):
+        return hash((self.start, self.unit))
+
+    def __getstate__(self):
+        return self.start, self.end, self.unit
+
+    def __setstate__(self, state):
+        self.start, self.end, self.unit = state
+
+    def __unicode__(self):
+        return unicode(self.start.strftime(FORMATS[self.unit]))
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+    def __repr__(self):
+        return '<Period %s>' % self
+
+
+class TimeBucket(Factor):
+    """
+    A factor which levels are periods of time of given `unit`: ``'minute'``,
+    ``'hour'``, ``'day'`` or ``'week'`` (weeks start on Monday). Only periods
+    that contain at least one item become levels.
+    """
+    def __init__(self, key, unit='day', tz=None):
+        if unit not in UNITS:
+            raise ValueError('Unknown unit "{0}". Expected one of: {1}'.format(
+                unit, ', '.join(sorted(UNITS))))
+        super(TimeBucket, self).__init__(key)
+        self.unit = unit
+        self.tz = tz or UTC
+        self.kind = None    # how timestamps are stored in the data
+
+    def __repr__(self):
+        return '<TimeBucket {0} {1}>'.format(self.key, self.unit)
+
+    def spawn(self):
+        factor = super(TimeBucket, self).spawn()
+        factor.kind = None
+        return factor
+
+    def _localize(self, naive):
+        if hasattr(self.tz, 'localize'):
+            # pytz time zones need this to pick the right offset
+            return self.tz.localize(naive)
+        return naive.replace(tzinfo=self.tz)
+
+    def _to_datetime(self, value):
+        if isinstance(value, datetime):
+            if value.tzinfo is None:
+                self.kind = self.kind or 'naive'
+                value = value.replace(tzinfo=UTC)
+            else:
+                self.kind = self.kind or 'aware'
+        elif isinstance(value, date):
+            # a date is a calendar day in the local time zone already
+            self.kind = self.kind or 'date'
+            return self._localize(datetime(value.year, value.month,
+                                           value.day))
+        elif isinstance(value, (int, long, float)):
+            self.kind = self.kind or 'timestamp'
+            value = datetime.fromtimestamp(value, UTC)
+        else:
+            raise TypeError('Cannot interpret {0!r} as time.'.format(value))
+        return value.astimezone(self.tz)
+
+    def _from_datetime(self, value):
+        # period bounds must be comparable with the values in the data
+        if self.kind == 'aware':
+            return value
+        if self.kind == 'date':
+            # no conversion, see _to_datetime(); a bound within a day is
+            # rounded up so that the day is not lost
+            local = value.replace(tzinfo=None)
+            if local.time() != datetime.min.time():
+                return local.date() + timedelta(days=1)
+            return local.date()
+        value = value.astimezone(UTC)
+        if self.kind == 'timestamp':
+            return calendar.timegm(value.utctimetuple())
+        return value.replace(tzinfo=None)
+
+    def truncate(self, value):
+        "Returns the :class:`Period` containing given timestamp."
+        local = self._to_datetime(value).replace(tzinfo=None)
+        start = local.replace(second=0, microsecond=0)
+        if self.unit != 'minute':
+            start = start.replace(minute=0)
+        if self.unit in ('day', 'week'):
+            start = start.replace(hour=0)
+        if self.unit == 'week':
+            start -= timedelta(days=start.weekday())
+        end = start + UNITS[self.unit]
+        return Period(self._localize(start), self._localize(end), self.unit)
+
+    def conditions(self, value):
+        if value is None:
+            return {self.key: None}
+        return {self.key + '__gte': self._from_datetime(value.start),
+                self.key + '__lt': self._from_datetime(value.end)}
+
+    def find_values(self, query):
+        values = query.values(self.key)
+        return sorted(set(self.truncate(v) for v in values if v is not None))
+
+    def estimate_levels(self, query):
+        return len(self.find_values(query)) or 1
+
+    def split(self, query):
+        # periods are not plain values, so each of them needs a sub-query
+        return [(value, query.where(**self.conditions(value)))
+                for value in self.find_values(query)]
+
+    def scan_keys(self, item):
+        value = item.get(self.key)
+        keys = set()
+        for value in value if isinstance(value, (list, tuple)) else [value]:
+            if value is None:
+                keys.add(MISSING)
+            else:
+                keys.add(self.truncate(value))
+        return keys
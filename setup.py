@@ -29,7 +29,7 @@ setup(
 
     provides     = ['dark'],
     obsoletes    = ['datashaping'],
-    requires     = ['python (>= 2.5)', 'doqu (>= 0.25)'],
+    requires     = ['python (>= 2.7)', 'doqu (>= 0.25)'],
     test_requires = ['nose', 'pyyaml'],
 
     description  = 'Data Analysis and Reporting Kit (DARK)',
@@ -57,6 +57,10 @@ setup(
         'Topic :: Software Development :: Libraries :: Python Modules',
     ],
 
+    entry_points = {
+        'console_scripts': ['dark = dark.cli:main'],
+    },
+
     # release sanity check
     test_suite = 'nose.collector',
 )
@@ -1,11 +1,20 @@
 # -*- coding: utf-8 -*-
 
+import cPickle as pickle
 import doqu
 import os
 import unittest
 import yaml
 
-from dark.aggregates import Avg, Count, Max, Median, Min, NA, Qu1, Qu3, Sum
+from decimal import Decimal
+
+from dark import aggregates
+from dark.aggregates import (AggregationError, Avg, CorrMatrix, Correlation,
+                             Count, CountNA, Covariance, Histogram, Max, Median,
+                             Min, Mode, NA, Qu1, Qu3, SpaceSaving, Sum, TopK)
+from dark.binning import Bins
+from dark.memory import Dataset
+from dark.shaping import cast
 
 
 TMP_DB_PATH = '_test_aggregates.shelve'
@@ -60,3 +69,303 @@ class AggregatesTestCase(unittest.TestCase):
         "Calculating average"
         rows = [{'x': 0.5}, {'x': 1.5}]
         assert float(Avg('x').count_for(rows)) == 1.0
+
+
+class NumericModeTestCase(unittest.TestCase):
+
+    rows = [{'x': 1}, {'x': 2}, {'x': 4}]
+
+    def tearDown(self):
+        aggregates.set_numeric_mode(aggregates.EXACT)
+        aggregates.set_precision(2)
+
+    def test_exact(self):
+        "Exact mode: results are quantized decimals"
+        result = Avg('x').count_for(self.rows).get_result()
+        assert result == Decimal('2.33')
+        assert Max('x').count_for(self.rows).get_result() == Decimal('4.00')
+
+    def test_fast(self):
+        "Fast mode: native numbers are kept"
+        aggregates.set_numeric_mode(aggregates.FAST)
+        result = Avg('x').count_for(self.rows).get_result()
+        assert isinstance(result, float)
+        assert abs(result - 7 / 3.0) < 1e-9
+        assert Max('x').count_for(self.rows).get_result() == 4
+        assert Sum('x').count_for(self.rows).get_result() == 7
+
+    def test_precision(self):
+        "Configurable precision"
+        aggregates.set_precision(4)
+        result = Avg('x').count_for(self.rows).get_result()
+        assert result == Decimal('2.3333')
+        self.assertRaises(ValueError, aggregates.set_precision, -1)
+        self.assertRaises(ValueError, aggregates.set_numeric_mode, 'foo')
+
+    def test_zero_result_is_cached(self):
+        "A zero result is not recalculated"
+        calc = Sum('x').count_for([{'x': 0}])
+        assert calc.get_result() == 0
+        calc.values = ['spam']    # would fail if recalculated
+        assert calc.get_result() == 0
+
+
+class FrequentValuesTestCase(unittest.TestCase):
+
+    rows = ([{'city': 'Moscow'}] * 5 + [{'city': 'London'}] * 3 +
+            [{'city': 'Paris'}] * 2 + [{'city': 'Rome'}, {'city': None}])
+
+    def test_top_k(self):
+        "Exact top-k"
+        top = TopK('city', 2).count_for(self.rows).get_result()
+        assert top == [('Moscow', 5), ('London', 3)]
+        assert str(TopK('city', 2)) == 'TopK(city, 2)'
+
+    def test_top_k_approximate(self):
+        "Approximate top-k with a Space-Saving sketch"
+        top = TopK('city', 2, approximate=True, capacity=3)
+        result = top.count_for(self.rows).get_result()
+        assert len(result) == 2
+        assert result[0] == ('Moscow', 5)
+
+    def test_mode(self):
+        "Most frequent value"
+        assert Mode('city').count_for(self.rows).get_result() == 'Moscow'
+        assert isinstance(Mode('city').count_for([{'city': None}]), NA)
+
+    def test_ties(self):
+        "Values with the same count are ranked by value"
+        for order in 'abc', 'cab', 'bca':
+            rows = [{'x': value} for value in order * 2]
+            assert Mode('x').count_for(rows).get_result() == 'a'
+            top = TopK('x', 2, approximate=True).count_for(rows).get_result()
+            assert top == [('a', 2), ('b', 2)]
+            assert TopK('x', 2).count_for(rows).get_result() == top
+
+    def test_space_saving(self):
+        "Space-Saving never underestimates counts"
+        sketch = SpaceSaving(2)
+        for value in 'aaabbc':
+            sketch.add(value)
+        assert len(sketch) == 2
+        assert sketch.counts['a'] == 3
+        for value, count in sketch.counts.items():
+            assert count - sketch.errors[value] <= 'aaabbc'.count(value) <= count
+
+    def test_histogram(self):
+        "Histogram"
+        rows = [{'age': x} for x in (15, 25, 30, 70, None)]
+        result = Histogram('age', [0, 18, 65, 120]).count_for(rows)
+        assert [c for b, c in result.get_result()] == [1, 2, 1]
+        result = Histogram('age', Bins(width=20)).count_for(rows)
+        assert [(b.lo, c) for b, c in result.get_result()] == [
+            (0, 1), (20, 2), (40, 0), (60, 1)]
+        # edges found in one cell would not match other cells
+        self.assertRaises(ValueError, Histogram, 'age', 3)
+        self.assertRaises(ValueError, Histogram, 'age', Bins(quantiles=4))
+
+
+class AccumulatorTestCase(unittest.TestCase):
+
+    def test_merge(self):
+        "Merged accumulators give the same result as a single pass"
+        rows = [{'x': x} for x in (3, 1, 4, 1, 5, 9, 2, 6)]
+        for agg in Avg('x'), Median('x'), Count('x'), Count(), Max('x'):
+            left, right = agg.accumulator(), agg.accumulator()
+            for row in rows[:3]:
+                left.add(row)
+            for row in rows[3:]:
+                right.add(row)
+            left.merge(right)
+            assert str(left.finalize()) == str(agg.count_for(rows))
+
+    def test_summary(self):
+        "Sums, counts and extremes do not keep the values"
+        rows = [{'x': x} for x in (3, 1, 4, 1, 5, 9, 2, 6)]
+        for agg in Avg('x'), Sum('x'), Min('x'), Max('x'), Count('x'):
+            accumulator = agg.accumulator()
+            for row in rows:
+                accumulator.add(row)
+            assert isinstance(accumulator.values, aggregates.Summary)
+            assert len(accumulator.values) == len(rows)
+            copy = pickle.loads(pickle.dumps(accumulator, 2))
+            assert str(copy.finalize()) == str(agg.count_for(rows))
+        accumulator = Sum('x').accumulator()
+        accumulator.add({'x': 1})
+        accumulator.add({'x': 'a'})
+        self.assertRaises(AggregationError, str, accumulator.finalize())
+
+    def test_reject(self):
+        "A rejected accumulator stays rejected after merge"
+        agg = Sum('x', NA.reject)
+        left, right = agg.accumulator(), agg.accumulator()
+        left.add({'x': 1})
+        right.add({'y': 1})
+        left.merge(right)
+        assert left.finalize() is None
+
+
+class NATestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.rows = [{'x': 1}, {'x': None}, {'y': 2}, {'x': [None]}, {'x': 3}]
+
+    def test_singleton(self):
+        "Empty cells share a single N/A object"
+        import cPickle as pickle
+        assert NA() is NA()
+        assert pickle.loads(pickle.dumps(NA(), 2)) is NA()
+        assert Avg('z').count_for(self.rows) is NA()
+
+    def test_count(self):
+        "N/A values are counted by accumulators and by CountNA"
+        agg = Sum('x')
+        left, right = agg.accumulator(), agg.accumulator()
+        for row in self.rows[:2]:
+            left.add(row)
+        for row in self.rows[2:]:
+            right.add(row)
+        left.merge(right)
+        assert left.na_count == 2
+        assert CountNA('x').count_for(self.rows) == 2
+        assert CountNA('y').count_for(Dataset(self.rows)) == 4
+        assert str(CountNA('x')) == 'CountNA(x)'
+
+    def test_dataset(self):
+        "The dataset index tells whether a value is missing"
+        data = Dataset(self.rows)
+        assert data.na_count('x') == 2
+        assert data.where(x__exists=True).na_count('x') == 1
+        assert data.where(x=3).na_count('x') == 0
+        assert Max('x', NA.reject).count_for(data) is None
+        assert int(Max('x', NA.reject).count_for(data.where(x=3))) == 3
+
+    def test_cast(self):
+        "Rejected cells are the same whichever way the table is built"
+        rows = [dict(row, g=i % 2) for i, row in enumerate(self.rows)]
+        tables = [[map(unicode, row) for row in
+                   cast(Dataset(rows), ['g'], [], Sum('x', NA.reject),
+                        Count(), CountNA('x'), strategy=strategy)]
+                  for strategy in ('levels', 'scan')]
+        assert tables[0] == tables[1] == [
+            ['g', 'Sum(x)', 'Count(all)', 'CountNA(x)'],
+            ['0', 'None', '3', '1'],
+            ['1', 'None', '2', '1']]
+
+
+class CorrelationTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.rows = [{'x': x, 'y': y, 'z': z} for x, y, z in
+                     [(1, 2, 9), (2, 4.5, 7), (3, 5, 8), (4, 9, 1), (5, 9, 0)]]
+        self.rows += [{'x': 6}, {'y': 1, 'z': 3}]
+
+    def test_results(self):
+        "Only items with values of both keys are used"
+        aggregates.set_numeric_mode(aggregates.FAST)
+        try:
+            cov = Covariance('x', 'y').count_for(self.rows).get_result()
+            assert round(cov, 10) == 4.625
+            corr = Correlation('x', 'y').count_for(self.rows).get_result()
+            assert round(corr, 4) == 0.9592
+            matrix = CorrMatrix('x', 'y', 'z').count_for(self.rows)
+            matrix = matrix.get_result()
+            assert round(matrix[0][1], 4) == round(matrix[1][0], 4) == 0.9592
+            assert round(matrix[2][2], 10) == 1
+        finally:
+            aggregates.set_numeric_mode(aggregates.EXACT)
+        assert unicode(Correlation('x', 'y').count_for(self.rows)) == '0.96'
+        assert str(CorrMatrix(['x', 'y'])) == 'CorrMatrix(x, y)'
+        assert Correlation('x', 'y').count_for(self.rows[:1]) is NA()
+        constant = [{'x': 1, 'y': 1}, {'x': 2, 'y': 1}]
+        assert Correlation('x', 'y').count_for(constant).get_result() is NA()
+        assert Covariance('x', 'y', NA.reject).count_for(self.rows) is None
+        self.assertRaises(ValueError, CorrMatrix, ['x'])
+        self.assertRaises(ValueError, CorrMatrix, 'x', 'y', where='z')
+        self.assertRaises(aggregates.AggregationError,
+                          Correlation('x', 'y').count_for, [{'x': 'a', 'y': 1}])
+
+    def test_merge(self):
+        "Merged co-moments are the same as those of a single pass"
+        rows = [{'x': i % 7, 'y': i * 0.5, 'z': (i * 37) % 11}
+                for i in range(2000)]
+        agg = CorrMatrix(['x', 'y', 'z'])
+        left, right = agg.accumulator(), agg.accumulator()
+        for row in rows[:700]:
+            left.add(row)
+        for row in rows[700:]:
+            right.add(row)
+        left.merge(right)
+        assert unicode(left.finalize()) == unicode(agg.count_for(rows))
+
+    def test_cast(self):
+        aggregates_list = Correlation('x', 'y'), CorrMatrix(['x', 'y', 'z'])
+        rows = [dict(row, g=i % 2) for i, row in enumerate(self.rows)]
+        tables = [[map(unicode, row) for row in
+                   cast(Dataset(rows), ['g'], [], strategy=strategy,
+                        rollup=True, *aggregates_list)]
+                  for strategy in ('levels', 'scan')]
+        assert tables[0] == tables[1]
+        assert tables[0][-1][1] == '0.96'
+
+
+class WeightedTestCase(unittest.TestCase):
+
+    rows = [{'price': 10, 'qty': 3}, {'price': 20, 'qty': 1},
+            {'price': 5, 'qty': 4}, {'price': 99, 'qty': 0},
+            {'price': 7}, {'qty': 2}]
+
+    def expanded(self):
+        return [{'price': row['price']} for row in self.rows
+                for i in range(row.get('qty', 0)) if 'price' in row]
+
+    def test_same_as_expanded(self):
+        "Weighted results are the same as for repeated items"
+        for cls in Avg, Sum, Median, Qu1, Qu3:
+            weighted = cls('price', weight='qty').count_for(self.rows)
+            plain = cls('price').count_for(self.expanded())
+            assert weighted.get_result() == plain.get_result(), cls
+
+    def test_invalid_options(self):
+        "Options passed by position are checked"
+        self.assertRaises(ValueError, Avg, 'p', 'b', 'c', 'd')
+        self.assertRaises(ValueError, Count, 'p', 3)
+        self.assertRaises(ValueError, TopK, 'p', where='x')
+
+    def test_fractional(self):
+        "Quantiles are located by fractional weights"
+        rows = [{'p': 1, 'w': 0.5}, {'p': 2, 'w': 0.5}, {'p': 3, 'w': 0.4}]
+        result = lambda cls: cls('p', weight='w').count_for(rows).get_result()
+        assert result(Median) == 2
+        assert result(Qu1) == 1
+        assert result(Qu3) == 3
+        assert 1 < result(Avg) < 2
+        rows = [{'p': 1, 'w': 0.5}, {'p': 2, 'w': 0.5}]
+        assert result(Median) == 1.5
+
+    def test_invalid_weight(self):
+        "A weight must be a non-negative number"
+        for weight in -1, '2', True:
+            rows = [{'p': 1, 'w': 1}, {'p': 2, 'w': weight}]
+            for cls in Avg, Median:
+                self.assertRaises(AggregationError,
+                                  cls('p', weight='w').count_for, rows)
+
+    def test_name(self):
+        "The weight is shown in the heading"
+        assert str(Avg('price', weight='qty')) == 'Avg(price, weight=qty)'
+
+    def test_merge(self):
+        "Weighted accumulators are merged"
+        agg = Median('price', weight='qty')
+        left, right = agg.accumulator(), agg.accumulator()
+        for row in self.rows[:2]:
+            left.add(row)
+        for row in self.rows[2:]:
+            right.add(row)
+        left.merge(right)
+        assert str(left.finalize()) == str(agg.count_for(self.rows))
+
+    def test_reject(self):
+        "An item without a weight is N/A"
+        assert Sum('price', NA.reject, weight='qty').count_for(self.rows) is None
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+from decimal import Decimal
+import unittest
+
+from dark.binning import Bin, Bins, to_bins
+
+
+class BinsTestCase(unittest.TestCase):
+
+    values = [1, 2, 2, 3, 5, 8, 13, 21]
+
+    def test_width(self):
+        "Fixed width bins"
+        edges, closed = Bins(width=10).get_edges(self.values)
+        assert edges == [0, 10, 20, 30]
+        assert not closed
+        counts = [c for b, c in Bins(width=10).split(self.values)]
+        assert counts == [6, 1, 1]
+
+    def test_decimal(self):
+        "Decimal values are binned without converting them to floats"
+        values = [Decimal('12.5'), Decimal('-3'), Decimal('30')]
+        edges, closed = Bins(width=Decimal('10')).get_edges(values)
+        assert edges == [-10, 0, 10, 20, 30, 40]
+        assert all(isinstance(edge, Decimal) for edge in edges)
+        assert [c for b, c in Bins(width=10).split(values)] == [
+            1, 0, 1, 0, 1]
+        edges = Bins(width=2.5).get_edges(values)[0]
+        assert edges[:2] == [Decimal('-5'), Decimal('-2.5')]
+        assert Bins(width=Decimal('10')).get_edges([12.5])[0] == [10.0, 20.0]
+        pairs = Bins(count=2).split(values)
+        assert pairs[0][0] == Bin(Decimal('-3'), Decimal('13.5'))
+
+    def test_count(self):
+        "Equal bins between min and max"
+        pairs = Bins(count=2).split(self.values)
+        assert [c for b, c in pairs] == [6, 2]
+        assert pairs[-1][0] == Bin(11.0, 21, closed=True)
+
+    def test_quantiles(self):
+        "Quantile-based bins"
+        pairs = Bins(quantiles=2).split(self.values)
+        assert [c for b, c in pairs] == [4, 4]
+
+    def test_edges(self):
+        "Explicit edges; values outside are ignored"
+        pairs = Bins(edges=[2, 5, 13]).split(self.values + [None])
+        assert [(unicode(b), c) for b, c in pairs] == [(u'[2, 5)', 3),
+                                                       (u'[5, 13]', 3)]
+
+    def test_single_value(self):
+        "All values are equal"
+        assert Bins(count=3).split([7, 7]) == [(Bin(7, 7, True), 2)]
+
+    def test_to_bins(self):
+        "Short bin specifications"
+        assert to_bins(5).count == 5
+        assert to_bins([1, 2]).edges == [1, 2]
+        self.assertRaises(TypeError, to_bins, 'foo')
+        self.assertRaises(TypeError, Bins)
+        self.assertRaises(ValueError, Bins, edges=[3, 1])
+
+    def test_conditions(self):
+        "Bins are translated to query lookups"
+        assert Bin(1, 2).conditions('x') == {'x__gte': 1, 'x__lt': 2}
+        assert Bin(1, 2, True).conditions('x') == {'x__gte': 1, 'x__lte': 2}
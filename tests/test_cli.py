@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+from StringIO import StringIO
+import unittest
+
+from dark.aggregates import Avg, TopK
+from dark.cli import main, parse_aggregate, parse_size
+
+
+CSV = """country,city,gender,age
+RU,Moscow,m,30
+RU,Moscow,f,25
+RU,Tver,f,
+US,NYC,m,40
+"""
+
+JSONL = """{"country": "RU", "age": 30}
+{"country": "RU", "age": 25}
+
+{"country": "US", "age": 40}
+"""
+
+
+class CommandLineTestCase(unittest.TestCase):
+
+    def _run(self, argv, data=CSV):
+        out = StringIO()
+        assert main(argv, stdin=StringIO(data), stdout=out) == 0
+        return out.getvalue().splitlines()
+
+    def test_parse_aggregate(self):
+        agg = parse_aggregate('Avg(age)')
+        assert isinstance(agg, Avg) and agg.key == 'age'
+        agg = parse_aggregate('TopK(city, 3, approximate=True)')
+        assert isinstance(agg, TopK)
+        assert (agg.key, agg.k, agg.approximate) == ('city', 3, True)
+        assert str(parse_aggregate('Count')) == 'Count(all)'
+        agg = parse_aggregate('CorrMatrix(x, y, z)')
+        assert agg.keys == ('x', 'y', 'z')
+        self.assertRaises(ValueError, parse_aggregate, 'Foo(age)')
+        self.assertRaises(ValueError, parse_aggregate, 'Avg(a, b, c, d)')
+
+    def test_parse_size(self):
+        assert parse_size('512') == 512
+        assert parse_size('64M') == 64 * 1024 * 1024
+        assert parse_size('1.5kb') == 1536
+        self.assertRaises(ValueError, parse_size, '12X')
+
+    def test_csv(self):
+        lines = self._run(['-f', 'country', '-p', 'gender', '-a', 'Count',
+                           '-a', 'Avg(age)', '-o', 'csv'])
+        assert lines == [
+            'country,f Count(all),f Avg(age),m Count(all),m Avg(age),'
+            'Count(all),Avg(age)',
+            'RU,2,25.00,1,30.00,3,27.50',
+            'US,0,N/A,1,40.00,1,40.00',
+        ]
+
+    def test_streaming(self):
+        expected = self._run(['-f', 'country', '-f', 'city', '-r'])
+        assert self._run(['-f', 'country', '-f', 'city', '-r',
+                          '-m', '1']) == expected
+        assert self._run(['-f', 'country', '-f', 'city', '-r',
+                          '-m', '1M', '-j', '2']) == expected
+
+    def test_sorted(self):
+        expected = self._run(['-f', 'country', '-f', 'city', '-a', 'Avg(age)',
+                              '-o', 'csv'])
+        assert self._run(['-f', 'country', '-f', 'city', '-a', 'Avg(age)',
+                          '-o', 'csv', '-s']) == expected
+        expected = self._run(['-f', 'country', '-r'])
+        assert self._run(['-f', 'country', '-r', '-s']) == expected
+
+    def test_corr_matrix(self):
+        lines = self._run(['-f', 'country', '-a', 'CorrMatrix(age, age)',
+                           '-o', 'csv'])
+        assert lines == [
+            'country,"CorrMatrix(age, age)"',
+            'RU,1.00 1.00; 1.00 1.00',
+            'US,N/A',
+        ]
+
+    def test_jsonl(self):
+        lines = self._run(['-i', 'jsonl', '-f', 'country', '-a', 'Sum(age)',
+                           '-o', 'jsonl'], JSONL)
+        assert lines == [
+            '{"country": "RU", "Sum(age)": 55.0}',
+            '{"country": "US", "Sum(age)": 40.0}',
+        ]
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+import glob
+from multiprocessing.pool import Pool, ThreadPool
+import os
+import unittest
+
+import doqu
+import yaml
+
+from dark.aggregates import Avg
+from dark.concurrency import cast_async
+from dark.shaping import _is_process_pool, cast
+
+
+TMP_DB_PATH = '_test_concurrency.shelve'
+
+
+class ConcurrencyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.db = doqu.get_db(backend='doqu.ext.shelve_db', path=TMP_DB_PATH)
+        self.db.clear()
+        for data in yaml.load(open('tests/people.yaml')):
+            doqu.Document(**data).save(self.db)
+        self.people = doqu.Document.objects(self.db)
+
+    def tearDown(self):
+        self.db.clear()
+        self.db.connection.close()
+        # the dbm module may add a suffix to the file name
+        for path in glob.glob(TMP_DB_PATH + '*'):
+            os.unlink(path)
+
+    def _as_text(self, table):
+        return [[unicode(cell) for cell in row] for row in table]
+
+    def test_same_table(self):
+        "Concurrent fetching yields the same table"
+        args = ['birth_country', 'gender'], ['birth_city'], Avg('age')
+        expected = cast(self.people, *args)
+        pending = cast_async(self.people, *args, **{'concurrency': 4})
+        assert self._as_text(pending.get(timeout=10)) == self._as_text(expected)
+        assert pending.ready()
+
+    def test_error(self):
+        "Errors are raised on get()"
+        pending = cast_async(self.people, ['gender'], [], 'not an aggregate')
+        self.assertRaises(AttributeError, pending.get, 10)
+
+    def test_executor(self):
+        "Thread and process pools passed to cast() yield the same table"
+        args = ['birth_country'], ['gender'], Avg('age')
+        expected = self._as_text(cast(self.people, *args))
+        for pool in ThreadPool(4), Pool(2):
+            try:
+                table = cast(self.people, *args, **{'executor': pool})
+            finally:
+                pool.close()
+                pool.join()
+            assert self._as_text(table) == expected
+
+    def test_process_pool_detection(self):
+        "Only real process pools are treated as such"
+        class ProcessPoolExecutor(object):
+            map = map
+        for pool, expected in ((ThreadPool(1), False), (Pool(1), True),
+                               (ProcessPoolExecutor(), False)):
+            try:
+                assert _is_process_pool(pool) == expected, pool
+            finally:
+                if hasattr(pool, 'close'):
+                    pool.close()
+                    pool.join()
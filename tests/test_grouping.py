@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from dark.aggregates import Avg, Count, Max, Median, Sum
+from dark.grouping import (MISSING, VOID, Grouper, bucket_keys, group_tree,
+                           stream_tree)
+from dark.memory import Dataset
+from dark.shaping import BinnedFactor, CastPlan, Explanation, cast
+
+
+class ScanStrategyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.data = Dataset([
+            {'a': 'x', 'b': 1, 'n': 10},
+            {'a': 'x', 'b': [1, 2], 'n': 20},
+            {'a': 'x', 'n': 5},
+            {'a': None, 'b': 2, 'n': 7},
+            {'b': 3, 'n': 33},
+            {'a': 'y', 'b': [], 'n': 1},
+            {'a': 'z', 'n': None},
+        ])
+
+    def _compare(self, *args, **kwargs):
+        expected = cast(self.data, *args, **kwargs)
+        for budget in None, 1:
+            table = cast(self.data, strategy='scan', memory_budget=budget,
+                         *args, **kwargs)
+            assert ([[unicode(c) for c in row] for row in table] ==
+                    [[unicode(c) for c in row] for row in expected])
+        return expected
+
+    def test_same_table(self):
+        "The scan strategy builds the same table as level queries"
+        self._compare(['a', 'b'], [], Count(), Sum('n'), Median('n'))
+        self._compare(['b', 'a'], [], Count(), Sum('n'))
+
+    def test_pivots(self):
+        self._compare(['a'], ['b'], Count(), Sum('n'))
+        self._compare([], ['a'], Count())
+
+    def test_binned(self):
+        self._compare([BinnedFactor('n', [0, 10, 50]), 'a'], ['b'], Count())
+
+    def test_rollup(self):
+        self._compare(['a', 'b'], [], Count(), Median('n'), rollup=True)
+
+    def test_empty(self):
+        "Dummy levels are kept for empty data"
+        self.data = Dataset([])
+        table = self._compare(['a', 'b'], [], Count())
+        assert [[unicode(c) for c in row] for row in table] == [
+            [u'a', u'b', u'Count(all)'], [u'None', u'None', u'0']]
+
+    def test_unknown_strategy(self):
+        self.assertRaises(ValueError, cast, self.data, ['a'], [], Count(),
+                          strategy='foo')
+
+    def test_stream(self):
+        "Rows of unsorted items are yielded while the runs are merged"
+        as_text = lambda t: [[unicode(c) for c in row] for row in t]
+        for factors, pivots in (['a', 'b'], []), (['b'], ['a']), ([], []):
+            plan = CastPlan(factors, pivots, [Count(), Sum('n')],
+                            strategy='scan', memory_budget=1)
+            assert (as_text(plan.stream(iter(self.data))) ==
+                    as_text(cast(self.data, factors, pivots, Count(),
+                                 Sum('n'))))
+
+
+def _sort_key(factors):
+    # `None` and missing values first, as required by the sorted strategy
+    def key(item):
+        return [(0,) if item.get(f) is None else (1, item[f]) for f in factors]
+    return key
+
+
+class SortedStrategyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.items = [
+            {'a': 'x', 'b': 1, 'n': 10},
+            {'a': 'x', 'b': 1, 'n': 20},
+            {'a': 'x', 'n': 5},
+            {'a': 'x', 'b': None, 'n': 4},
+            {'a': None, 'b': 2, 'n': 7},
+            {'b': 3, 'n': 33},
+            {'a': 'y', 'n': 1},
+            {'a': 'z', 'b': 2, 'n': None},
+            {'a': 'z', 'b': 5, 'n': 8},
+        ]
+
+    def _compare(self, factors, *args, **kwargs):
+        expected = cast(Dataset(self.items), factors, *args, **kwargs)
+        query = Dataset(sorted(self.items, key=_sort_key(factors)))
+        for budget in None, 1:
+            table = cast(query, factors, strategy='sorted',
+                         memory_budget=budget, *args, **kwargs)
+            assert ([[unicode(c) for c in row] for row in table] ==
+                    [[unicode(c) for c in row] for row in expected])
+        return expected
+
+    def test_same_table(self):
+        "Runs of sorted items make the same table as level queries"
+        self._compare(['a', 'b'], [], Count(), Sum('n'), Median('n'))
+        self._compare(['b', 'a'], ['a'], Count(), Sum('n'))
+        self._compare(['b'], [], Count(), rollup=True)
+        self._compare([], ['a'], Count())
+
+    def test_missing_only(self):
+        "Missing values make a `None` level if there are no other values"
+        self.items = [{'a': 'x', 'n': 1}, {'a': 'y', 'b': None, 'n': 2},
+                      {'a': 'y', 'n': 3}]
+        self._compare(['a', 'b'], [], Count())
+        self.items = []
+        self._compare(['a', 'b'], [], Count())
+
+    def test_stream(self):
+        "Rows are yielded as soon as their groups are complete"
+        query = sorted(self.items, key=_sort_key(['a']))
+        plan = CastPlan(['a'], [], [Sum('n')], strategy='sorted')
+        rows = plan.stream(iter(query))
+        assert [unicode(c) for c in rows.next()] == ['a', 'Sum(n)']
+        assert [unicode(c) for c in rows.next()] == ['None', '40.00']
+        assert [unicode(c) for c in rows.next()] == ['x', '39.00']
+        rows.close()
+        table = plan.execute(Dataset(query))
+        assert ([[unicode(c) for c in row] for row in plan.stream(query)] ==
+                [[unicode(c) for c in row] for row in table])
+        plan = CastPlan(['a'], [], [Sum('n')], strategy='sorted', rollup=True)
+        self.assertRaises(ValueError, list, plan.stream(query))
+
+    def test_unsorted(self):
+        self.assertRaises(ValueError, cast, self.items, ['a'], [], Count(),
+                          strategy='sorted')
+        items = [{'a': 1, 'b': [1, 2]}, {'a': 2, 'b': 1}]
+        self.assertRaises(ValueError, cast, items, ['a', 'b'], [], Count(),
+                          strategy='sorted')
+
+
+class FilteringOnly(object):
+    "A source which cannot group data in a single pass."
+    def __init__(self, query):
+        self.query = query
+
+    def where(self, **conditions):
+        return FilteringOnly(self.query.where(**conditions))
+
+    def values(self, key):
+        return self.query.values(key)
+
+    def count(self):
+        return self.query.count()
+
+    def __iter__(self):
+        return iter(self.query)
+
+
+class AutoStrategyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.data = Dataset([{'a': i % 50, 'b': i % 7, 'c': i}
+                             for i in range(500)])
+
+    def test_explain(self):
+        "The plan is explained without building the table"
+        explanation = cast(self.data, ['a', 'b'], [], Count(),
+                           strategy='auto', explain=True)
+        assert isinstance(explanation, Explanation)
+        assert explanation.estimates['levels'] == [('a', 50), ('b', 7)]
+        assert explanation.estimates['rows'] == 350
+        assert 'strategy: ' in str(explanation)
+
+    def test_choice(self):
+        "Sub-queries are cheap for grouping sources and expensive for others"
+        args = ['a', 'c'], [], Count()
+        assert cast(self.data, strategy='auto', explain=True,
+                    *args).strategy == 'levels'
+        source = FilteringOnly(self.data)
+        assert cast(source, strategy='auto', explain=True,
+                    *args).strategy == 'scan'
+        assert cast(source, strategy='levels', explain=True,
+                    *args).reason == 'chosen explicitly'
+
+    def test_same_table(self):
+        source = FilteringOnly(self.data)
+        as_text = lambda t: [[unicode(c) for c in row] for row in t]
+        assert (as_text(cast(source, ['b', 'c'], [], Sum('c'),
+                             strategy='auto')) ==
+                as_text(cast(self.data, ['b', 'c'], [], Sum('c'))))
+
+
+class GrouperTestCase(unittest.TestCase):
+
+    def test_bucket_keys(self):
+        assert bucket_keys([set([1]), set([2, 3])]) == [(1, 2), (1, 3)]
+        assert bucket_keys([set([MISSING]), set()]) == [(MISSING, VOID)]
+
+    def test_spill(self):
+        "Buckets spilled to sorted runs are merged"
+        grouper = Grouper([Count()], memory_budget=1)
+        for key in 'b', 'a', 'b', 'c', 'a', 'b':
+            grouper.add({}, [(key,)], [()])
+        assert len(grouper.runs) == 6
+        assert [(k, b[()][0].finalize()) for k, b in grouper] == [
+            (('a',), 2), (('b',), 3), (('c',), 1)]
+
+    def test_constant_size(self):
+        "Buckets of sums, counts and extremes do not grow with the items"
+        grouper = Grouper([Count(), Sum('n'), Avg('n'), Max('n')])
+        grouper.add({'n': 1}, [('a',)], [()])
+        size = grouper.size
+        for n in range(100):
+            grouper.add({'n': n}, [('a',)], [()])
+        assert grouper.size == size
+        grouper = Grouper([Median('n')])
+        grouper.add({'n': 1}, [('a',)], [()])
+        size = grouper.size
+        grouper.add({'n': 2}, [('a',)], [()])
+        assert grouper.size > size
+
+    def test_stream_tree(self):
+        "Streamed buckets are the same as the walked tree"
+        def walk(node, depth, path=()):
+            for value in sorted(node):
+                if depth == 1:
+                    yield path + (value,), node[value]
+                else:
+                    for pair in walk(node[value], depth - 1, path + (value,)):
+                        yield pair
+        cases = [
+            [((None, 1), {}), ((MISSING, 2), {}), (('x', VOID), {})],
+            [((MISSING, 1), {}), ((MISSING, MISSING), {})],
+            [((VOID, VOID), {})],
+            [],
+        ]
+        for pairs in cases:
+            assert (list(stream_tree(pairs, 2)) ==
+                    list(walk(group_tree(pairs, 2), 2)))
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from dark.aggregates import Avg, Count, DenseAccumulator, Median
+from dark.indexes import DistinctValuesIndex, QuantileSketch, StatsIndex
+from dark.memory import Dataset
+from dark.shaping import CastPlan, cast, stdev, summary
+
+
+class StatsIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.data = Dataset([{'age': age, 'height': 170 + age % 7}
+                             for age in (3, 41, 17, 8, 65, 23, 30)] +
+                            [{'height': 180}, {'age': None, 'height': 172}])
+        self.index = StatsIndex(['age', 'height']).update(self.data)
+
+    def _printed(self, func, *args, **kwargs):
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            func(*args, **kwargs)
+            return sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+    def test_stats(self):
+        stats = self.index['age']
+        assert (stats.count, stats.na_count) == (7, 2)
+        assert (stats.min, stats.max, stats.sum) == (3, 65, 187)
+        assert self.index.has_na('age')
+        assert not self.index.has_na('height')
+        assert self.index.has_na('unknown')
+
+    def test_summary(self):
+        "Summary and stdev from the index are the same as from the data"
+        for key in 'age', 'height':
+            assert (self._printed(summary, self.data, key, index=self.index)
+                    == self._printed(summary, self.data, key))
+        assert (round(stdev(self.data, 'height', index=self.index), 10) ==
+                round(stdev(self.data, 'height'), 10))
+
+    def test_non_numeric(self):
+        self.assertRaises(TypeError, StatsIndex(['name']).add, {'name': 'x'})
+
+    def test_save_and_load(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            self.index.save(path)
+            index = StatsIndex.load(path)
+        finally:
+            os.remove(path)
+        assert index.count == 9
+        assert index['age'].sum == 187
+
+    def test_cast_without_na_handling(self):
+        "Keys without N/A values get dense accumulators"
+        plan = CastPlan(['age'], [], [Avg('height'), Median('age')],
+                        stats=self.index)
+        dense, regular = plan.new_accumulators()
+        assert isinstance(dense, DenseAccumulator)
+        assert not isinstance(regular, DenseAccumulator)
+        args = ['age'], [], Avg('height'), Count()
+        as_text = lambda t: [[unicode(c) for c in row] for row in t]
+        assert (as_text(cast(self.data, stats=self.index, *args)) ==
+                as_text(cast(self.data, *args)))
+
+
+class QuantileSketchTestCase(unittest.TestCase):
+
+    def test_exact(self):
+        sketch = QuantileSketch(capacity=10)
+        for value in 5, 1, 3:
+            sketch.add(value)
+        assert sketch.exact
+        assert sketch.values() == [1, 3, 5]
+        assert sketch.quantile(0.5) == 3
+
+    def test_approximate(self):
+        "Memory is bounded, quantiles stay close"
+        sketch = QuantileSketch(capacity=50, seed=1)
+        other = QuantileSketch(capacity=50, seed=2)
+        for value in range(5000):
+            (sketch if value % 2 else other).add(value)
+        sketch.merge(other)
+        assert not sketch.exact
+        assert len(sketch) == 5000
+        assert sum(len(items) for items in sketch.levels) < 400
+        assert abs(sketch.quantile(0.5) - 2500) < 250
+        self.assertRaises(ValueError, sketch.values)
+
+    def test_seed(self):
+        "Compaction is random, but can be repeated"
+        def sketch(seed):
+            sketch = QuantileSketch(capacity=10, seed=seed)
+            for value in range(1000):
+                sketch.add(value)
+            return sketch.levels
+        assert sketch(5) == sketch(5)
+        assert len(set(repr(sketch(seed)) for seed in range(10))) > 1
+
+
+PEOPLE = [
+    {'country': 'RU', 'city': 'Moscow', 'tags': ['a', 'b', 'a'], 'age': 30},
+    {'country': 'RU', 'city': 'Tver', 'tags': [], 'age': 25},
+    {'country': 'RU', 'city': None, 'age': 41},
+    {'country': 'US', 'city': 'NYC', 'tags': 'b', 'age': 40},
+    {'city': 'Moscow', 'tags': [{}], 'age': 19},
+]
+
+
+class ProbedList(list):
+    "A list with the query API that records what it was asked for."
+
+    def __init__(self, items, scanned=None):
+        list.__init__(self, items)
+        self.scanned = [] if scanned is None else scanned
+
+    def count(self):
+        self.scanned.append('count')
+        return len(self)
+
+    def values(self, key):
+        self.scanned.append(key)
+        return Dataset(self).values(key)
+
+    def where(self, **conditions):
+        self.scanned.append('where')
+        subset = Dataset(self).where(**conditions)
+        return ProbedList(subset, self.scanned)
+
+
+class DistinctValuesIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.index = DistinctValuesIndex(['country', 'city', 'tags'])
+        self.index.update(PEOPLE)
+
+    def test_counts(self):
+        "Counts follow the semantics of query.values()"
+        assert self.index.count == 5
+        for key in 'country', 'city', 'tags':
+            assert self.index.levels(key) == \
+                   sorted(Dataset(PEOPLE).values(key))
+            assert self.index.value_counts(key) == \
+                   Dataset(PEOPLE).value_counts(key)
+        assert self.index.value_counts('tags') == {'a': 1, 'b': 2}
+        assert self.index.value_counts('city') == {
+            'Moscow': 2, 'Tver': 1, 'NYC': 1, None: 1}
+
+    def test_add_and_remove(self):
+        assert self.index.levels('country') == ['RU', 'US']
+        self.index.add({'country': 'DE'})
+        assert self.index.levels('country') == ['DE', 'RU', 'US']
+        self.index.remove(PEOPLE[3])
+        assert self.index.levels('country') == ['DE', 'RU']
+        assert self.index.value_counts('tags') == {'a': 1, 'b': 1}
+        self.index.remove(PEOPLE[0])
+        assert self.index.levels('tags') == []
+        assert self.index.count == 4
+        self.assertRaises(ValueError, self.index.remove,
+                          {'country': 'RU', 'city': 'Omsk'})
+        assert self.index.value_counts('country') == {'DE': 1, 'RU': 2}
+        assert self.index.count == 4
+
+    def test_merge_save_and_load(self):
+        index = DistinctValuesIndex(['country', 'city', 'tags'])
+        index.update(PEOPLE[:2]).merge(
+            DistinctValuesIndex(index.keys).update(PEOPLE[2:]))
+        assert index.levels('city') == self.index.levels('city')
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            index.save(path)
+            index = DistinctValuesIndex.load(path)
+        finally:
+            os.remove(path)
+        assert index.count == 5
+        assert index.value_counts('tags') == self.index.value_counts('tags')
+        assert index.levels('country') == ['RU', 'US']
+
+    def test_cast(self):
+        "Top-level levels come from the index, the table stays the same"
+        expected = cast(ProbedList(PEOPLE), ['country', 'city'], ['tags'],
+                        Count(), Avg('age'), strategy='levels')
+        query = ProbedList(PEOPLE)
+        table = cast(self.index.wrap(query), ['country', 'city'], ['tags'],
+                     Count(), Avg('age'), strategy='levels')
+        assert [map(unicode, row) for row in table] == \
+               [map(unicode, row) for row in expected]
+        assert 'country' not in query.scanned
+        assert 'count' not in query.scanned
+
+    def test_pivot_counts(self):
+        "Pivot cells that only count items are taken from the counts"
+        expected = cast(Dataset(PEOPLE), [], ['country', 'tags'], Count())
+        query = ProbedList(PEOPLE)
+        table = cast(self.index.wrap(query), [], ['country', 'tags'], Count(),
+                     strategy='levels')
+        assert [map(unicode, row) for row in table] == \
+               [map(unicode, row) for row in expected]
+        assert query.scanned == []
+        table = cast(Dataset(PEOPLE), ['city'], ['tags'], Count(),
+                     strategy='levels')
+        assert [map(unicode, row) for row in table][1:3] == [
+            [u'None', u'0', u'0', u'1'], [u'Moscow', u'1', u'1', u'2']]
+
+    def test_unindexed_key(self):
+        query = self.index.wrap(ProbedList(PEOPLE))
+        assert sorted(query.values('age')) == [19, 25, 30, 40, 41]
+        assert query.value_counts('age')[30] == 1
+        assert len(query) == 5
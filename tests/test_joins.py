@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+from multiprocessing import Pool
+import unittest
+
+from dark.aggregates import Count, Sum
+from dark.joins import Joined, Lookup
+from dark.memory import Dataset
+from dark.predicates import Where
+from dark.shaping import CastPlan, cast
+
+
+CUSTOMERS = [
+    {'id': 1, 'name': 'Anna', 'region': 'EU'},
+    {'id': 2, 'name': 'Bob', 'region': 'US'},
+    {'id': 3, 'name': 'Chen', 'region': 'EU'},
+]
+
+ORDERS = [
+    {'customer_id': 1, 'amount': 10, 'status': 'paid'},
+    {'customer_id': 3, 'amount': 5, 'status': 'paid'},
+    {'customer_id': 2, 'amount': 7, 'status': 'new'},
+    {'customer_id': 2, 'amount': 1, 'status': 'paid'},
+    {'customer_id': 9, 'amount': 2, 'status': 'paid'},
+    {'amount': 3, 'status': 'new'},
+]
+
+
+class CountingList(list):
+    "A list that counts how many times it was iterated."
+    iterations = 0
+
+    def __iter__(self):
+        self.iterations += 1
+        return super(CountingList, self).__iter__()
+
+
+class LookupTestCase(unittest.TestCase):
+
+    def lookup(self, source=CUSTOMERS):
+        return Lookup(source, on='customer_id', key='id', name='customer',
+                      fields=['region'])
+
+    def test_joined(self):
+        joined = list(Joined(ORDERS, [self.lookup()]))
+        assert joined[0] == {'customer_id': 1, 'amount': 10,
+                             'status': 'paid', 'customer.region': 'EU'}
+        assert 'customer.region' not in joined[4]
+        assert sorted(Joined(ORDERS, [self.lookup()]).values(
+            'customer.region')) == ['EU', 'US']
+
+    def test_duplicate_key(self):
+        lookup = Lookup(CUSTOMERS + CUSTOMERS[:1], on='id')
+        self.assertRaises(ValueError, lookup.build)
+
+    def test_cast(self):
+        customers = CountingList(CUSTOMERS)
+        plan = CastPlan(['customer.region'], ['status'], [Sum('amount')],
+                        join=[self.lookup(customers)])
+        # facts without a customer are ignored as there are other regions
+        expected = [
+            ['customer.region', 'new', 'paid', 'Sum(amount)'],
+            ['EU', 'N/A', '15.00', '15.00'],
+            ['US', '7.00', '1.00', '8.00'],
+        ]
+        for query in ORDERS, Dataset(ORDERS):
+            table = plan.execute(query)
+            assert [map(unicode, row) for row in table] == expected
+        # the dimension is read once
+        assert customers.iterations == 1
+        pool = Pool(2)
+        try:
+            table = plan.execute(iter(ORDERS), pool)
+        finally:
+            pool.close()
+        assert [map(unicode, row) for row in table] == expected
+
+    def test_where(self):
+        table = cast(ORDERS, ['status'], [], Count(),
+                     join=[self.lookup()], where=Where(**{'customer.region':
+                                                           'EU'}))
+        assert [map(unicode, row) for row in table] == [
+            ['status', 'Count(all)'], ['paid', '2']]
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from dark.aggregates import Count
+from dark.memory import Dataset
+from dark.shaping import cast
+
+
+class DatasetTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.data = Dataset([
+            {'name': 'John', 'age': 30, 'tags': ['a', 'b']},
+            {'name': 'Mary', 'age': 25, 'tags': ['b']},
+            {'name': 'Bill', 'age': None},
+            {'name': 'Kate'},
+        ])
+
+    def _names(self, query):
+        return [d['name'] for d in query]
+
+    def test_where(self):
+        "Lookups"
+        data = self.data
+        assert self._names(data.where(name='Mary')) == ['Mary']
+        assert self._names(data.where(age__gte=25, age__lt=30)) == ['Mary']
+        assert self._names(data.where(name__in=['Bill', 'Kate'])) == ['Bill', 'Kate']
+        assert self._names(data.where(tags__exists=False)) == ['Bill', 'Kate']
+        self.assertRaises(ValueError, data.where, name__foo=1)
+
+    def test_none_matches_missing(self):
+        "None matches both explicit None and missing keys"
+        assert self._names(self.data.where(age=None)) == ['Bill', 'Kate']
+
+    def test_lists(self):
+        "List values are unwrapped"
+        assert sorted(self.data.values('tags')) == ['a', 'b']
+        assert self._names(self.data.where(tags='b')) == ['John', 'Mary']
+
+    def test_values_and_count(self):
+        "Distinct values and count of a sub-query"
+        young = self.data.where(age__lt=30)
+        assert young.count() == len(young) == 1
+        assert young.values('name') == ['Mary']
+        assert sorted(self.data.values('age')) == [None, 25, 30]
+
+    def test_group_by(self):
+        "Single-pass grouping is the same as a query per value"
+        groups = self.data.group_by('age')
+        for value in self.data.values('age'):
+            assert (self._names(groups[value]) ==
+                    self._names(self.data.where(age=value)))
+
+    def test_cast(self):
+        "Datasets can be used as queries"
+        table = cast(self.data, ['tags'], [], Count())
+        assert [[unicode(c) for c in row] for row in table] == [
+            [u'tags', u'Count(all)'], [u'a', u'1'], [u'b', u'2']]
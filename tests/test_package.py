@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+
+import os
+import subprocess
+import sys
+import unittest
+
+import dark
+
+
+class LazyPackageTestCase(unittest.TestCase):
+
+    def test_exports(self):
+        for module, names in dark.EXPORTS:
+            module = __import__('dark.' + module, fromlist=['__all__'])
+            assert names == module.__all__, module.__name__
+
+    def test_attributes(self):
+        from dark.aggregates import Avg
+        assert dark.Avg is Avg
+        self.assertRaises(AttributeError, getattr, dark, 'no_such_name')
+
+    def test_no_backend_import(self):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        code = ('import sys, dark.aggregates, dark.memory, dark.shaping; '
+                'print "doqu" in sys.modules')
+        output = subprocess.Popen([sys.executable, '-c', code], cwd=root,
+                                  stdout=subprocess.PIPE).communicate()[0]
+        assert output.strip() == 'False'
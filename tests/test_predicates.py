@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from dark.aggregates import Avg, Count, Sum
+from dark.memory import Dataset
+from dark.predicates import Filtered, Where
+from dark.shaping import CastPlan, cast
+
+
+RECORDS = [
+    {'name': 'Anna', 'age': 30, 'city': 'Moscow', 'tags': ['a', 'b']},
+    {'name': 'Boris', 'age': 17, 'city': 'Tver'},
+    {'name': 'Alex', 'age': None, 'city': 'Moscow'},
+    {'name': 'Vera', 'city': 'Kazan', 'tags': []},
+    {'name': 'Adam', 'age': 45, 'tags': ['b']},
+]
+
+PREDICATES = [
+    Where(age__gte=18),
+    Where(age=None),
+    Where(age__range=(17, 30)),
+    Where(city__in=['Tver', 'Kazan']),
+    Where(name__match='^A'),
+    Where(tags='b'),
+    Where(tags__exists=True),
+    Where(age__exists=False),
+    Where(name__match='^A') & ~Where(city='Moscow'),
+    Where(age__lt=20) | Where(city__exists=False),
+]
+
+
+class PredicateTestCase(unittest.TestCase):
+
+    def names(self, items):
+        return sorted(item['name'] for item in items)
+
+    def test_lookups(self):
+        assert self.names(filter(Where(age__gte=18), RECORDS)) == [
+            'Adam', 'Anna']
+        assert self.names(filter(Where(age=None), RECORDS)) == ['Alex', 'Vera']
+        assert self.names(filter(Where(tags='b'), RECORDS)) == ['Adam', 'Anna']
+        assert self.names(filter(~Where(name__match='^A'), RECORDS)) == [
+            'Boris', 'Vera']
+        self.assertRaises(ValueError, Where, age__between=(1, 2))
+
+    def test_dataset(self):
+        # vectorized evaluation gives the same result as item by item
+        data = Dataset(RECORDS)
+        for predicate in PREDICATES:
+            expected = self.names(filter(predicate, RECORDS))
+            assert self.names(data.where(predicate)) == expected, predicate
+            assert self.names(predicate.filter(RECORDS)) == expected
+
+    def test_filtered(self):
+        query = Where(age__gte=18).filter(Dataset(RECORDS).where(city=None))
+        assert self.names(query) == ['Adam']
+        query = Filtered(Dataset(RECORDS), Where(name__match='^A'))
+        assert query.count() == 3
+        assert sorted(query.values('city')) == ['Moscow']
+        assert self.names(query.where(city='Moscow')) == ['Alex', 'Anna']
+
+
+class CastWhereTestCase(unittest.TestCase):
+
+    def test_cast(self):
+        where = Where(name__match='^A') | Where(age__lt=20)
+        aggregates = Count(), Avg('age')
+        expected = cast(Dataset(RECORDS), ['city'], [], *aggregates,
+                        where=where)
+        assert [map(unicode, row) for row in expected] == [
+            ['city', 'Count(all)', 'Avg(age)'],
+            ['Moscow', '2', '30.00'],
+            ['Tver', '1', '17.00']]
+        for strategy in 'levels', 'scan', 'auto':
+            table = cast(RECORDS, ['city'], [], *aggregates, where=where,
+                         strategy=strategy)
+            assert map(lambda row: map(unicode, row), table) == \
+                   map(lambda row: map(unicode, row), expected)
+
+    def test_explain(self):
+        plan = CastPlan(['city'], where=Where(age__gte=18), strategy='levels')
+        assert plan.explain(RECORDS).strategy == 'scan'
+        assert plan.explain(Dataset(RECORDS)).strategy == 'levels'
+
+
+class ConditionalAggregateTestCase(unittest.TestCase):
+
+    def test_names(self):
+        assert str(Count(where=Where(age__gte=18))) == \
+               'Count(where age__gte=18)'
+        assert str(Sum('age', where=Where(city__in=['Tver', 'Kazan']))) == \
+               'Sum(age, where city__in=Kazan,Tver)'
+
+    def test_count_for(self):
+        assert Count(where=Where(age__gte=18)).count_for(RECORDS) == 2
+        assert Count('city', where=Where(name__match='^A')).count_for(
+            RECORDS).get_result() == 1
+        total = Sum('age', where=Where(city='Moscow')).count_for(RECORDS)
+        assert int(total) == 30
+        average = Avg('age', where=Where(city='Omsk')).count_for(RECORDS)
+        assert str(average) == 'N/A'
+
+    def test_cast(self):
+        aggregates = [Count(), Count(where=Where(age__lt=40)),
+                      Sum('age', where=Where(tags__exists=True))]
+        expected = [
+            ['city', 'Count(all)', 'Count(where age__lt=40)',
+             'Sum(age, where tags__exists=True)'],
+            ['Kazan', '1', '0', 'N/A'],
+            ['Moscow', '2', '1', '30.00'],
+            ['Tver', '1', '1', 'N/A'],
+        ]
+        for strategy in 'levels', 'scan':
+            table = cast(Dataset(RECORDS), ['city'], [], *aggregates,
+                         strategy=strategy)
+            assert [map(unicode, row) for row in table] == expected
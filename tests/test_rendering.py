@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+from StringIO import StringIO
+import unittest
+
+from dark.aggregates import NA
+from dark.rendering import render
+
+
+class RenderingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.table = [['country', 'Count(all)'], [u'Россия', 2], ['USA', NA()]]
+
+    def _render(self, format):
+        out = StringIO()
+        render(self.table, format, out)
+        return out.getvalue().decode('utf-8')
+
+    def test_ascii(self):
+        assert self._render('ascii').splitlines() == [
+            u' +---------+------------+',
+            u' | country | Count(all) |',
+            u' +---------+------------+',
+            u' |  Россия |          2 |',
+            u' |     USA |        N/A |',
+            u' +---------+------------+',
+        ]
+
+    def test_rotated(self):
+        "The heading becomes the first column"
+        assert self._render('rotated').splitlines()[1:3] == [
+            u' |    country | Россия | USA |',
+            u' +------------+--------+-----+',
+        ]
+
+    def test_csv(self):
+        assert self._render('csv').splitlines() == [
+            u'country,Count(all)', u'Россия,2', u'USA,N/A']
+
+    def test_jsonl(self):
+        "Rows become objects; numbers are kept, N/A is null"
+        assert self._render('jsonl').splitlines() == [
+            u'{"country": "\\u0420\\u043e\\u0441\\u0441\\u0438\\u044f", '
+            u'"Count(all)": 2}',
+            u'{"country": "USA", "Count(all)": null}',
+        ]
+
+    def test_unknown_format(self):
+        self.assertRaises(ValueError, render, self.table, 'xml')
@@ -5,8 +5,13 @@
 # --with-doctest and --doctest-tests options are set).
 
 import doqu
+import unittest
 import yaml
 
+from dark.aggregates import Count, Median, Sum
+from dark.memory import Dataset
+from dark.shaping import cast
+
 
 TMP_DB_PATH = '_test_shaping.shelve'
 
@@ -232,6 +237,33 @@ __doc__ = """
  |           USA |             Seattle |   male |     54.0 |
  +---------------+---------------------+--------+----------+
 
+# binned factor
+
+>>> from dark.binning import Bins
+>>> from dark.shaping import BinnedFactor
+>>> cast_cons(q, [BinnedFactor('age', Bins(width=50))])
+ +------------+------------+
+ |        age | Count(all) |
+ +------------+------------+
+ |    [0, 50) |          3 |
+ |  [50, 100) |         11 |
+ | [100, 150) |          1 |
+ | [200, 250) |          1 |
+ +------------+------------+
+
+# compiled plans can be pickled and executed against any query
+
+>>> import pickle
+>>> from dark.shaping import compile_cast, print_table
+>>> plan = pickle.loads(pickle.dumps(compile_cast(['gender'], [], Count())))
+>>> print_table(plan.execute(q))
+ +--------+------------+
+ | gender | Count(all) |
+ +--------+------------+
+ | female |          3 |
+ |   male |         13 |
+ +--------+------------+
+
 # multiple aggregates -- NOT YET
 
 #>>> cast_cons(q, ['birth_country','birth_city'], [], [Avg('age'), Min('age'), Max('age')])
@@ -364,6 +396,66 @@ __doc__ = """
 
 """
 
+
+class RollupTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.data = Dataset([
+            {'a': 'x', 'b': 1, 'c': 10},
+            {'a': 'x', 'b': 2, 'c': 20},
+            {'a': 'y', 'b': 1, 'c': 5},
+            {'a': 'y', 'b': 1, 'c': 7},
+        ])
+
+    def _cast(self, *args, **kwargs):
+        table = cast(self.data, *args, **kwargs)
+        return [[unicode(c) for c in row] for row in table]
+
+    def test_subtotals(self):
+        "Subtotal and grand total rows are merged from the rows above"
+        table = self._cast(['a', 'b'], [], Count(), Sum('c'), rollup=True)
+        assert table == [
+            [u'a', u'b', u'Count(all)', u'Sum(c)'],
+            [u'x', u'1', u'1', u'10.00'],
+            [u'x', u'2', u'1', u'20.00'],
+            [u'x', u'(total)', u'2', u'30.00'],
+            [u'y', u'1', u'2', u'12.00'],
+            [u'y', u'(total)', u'2', u'12.00'],
+            [u'(total)', u'(total)', u'4', u'42.00'],
+        ]
+
+    def test_pivot_totals(self):
+        "Pivot cells are rolled up as well"
+        table = self._cast(['a'], ['b'], Median('c'), rollup=True)
+        assert table[-1] == [u'(total)', u'7.00', u'20.00', u'8.50']
+
+    def test_same_rows(self):
+        "Rows other than totals are not affected"
+        plain = self._cast(['a', 'b'], [], Sum('c'))
+        rolled = self._cast(['a', 'b'], [], Sum('c'), rollup=True)
+        assert [row for row in rolled if u'(total)' not in row] == plain
+
+
+class CountingDataset(Dataset):
+    __slots__ = ()
+    counted = []
+
+    def count(self):
+        self.counted.append(self)
+        return super(CountingDataset, self).count()
+
+
+class PivotDiscoveryTestCase(unittest.TestCase):
+
+    def test_no_count_probes(self):
+        "Pivot levels are found without counting items per level"
+        data = CountingDataset([{'a': 'x', 'b': i % 5} for i in range(20)] +
+                               [{'a': 'y', 'b': 9}])
+        table = cast(data, ['a'], ['b'], Count())
+        assert table[0] == ['a', 0, 1, 2, 3, 4, 9, 'Count(all)']
+        assert CountingDataset.counted == []
+
+
 if __name__=='__main__':
     import doctest
     doctest.testmod()
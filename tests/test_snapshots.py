@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+from StringIO import StringIO
+import tempfile
+import unittest
+
+from dark.aggregates import Avg, Count, Median, NA, Sum, TopK
+from dark.memory import Dataset
+from dark.predicates import Where
+from dark.rendering import render
+from dark.shaping import CastPlan, cast
+from dark.snapshots import Snapshot, build, load, save
+
+
+ITEMS = [
+    {'country': u'Россия', 'city': 'Moscow', 'gender': 'f', 'age': 30},
+    {'country': u'Россия', 'city': 'Tver', 'gender': 'm', 'age': 25},
+    {'country': u'Россия', 'city': 'Tver', 'gender': 'm'},
+    {'country': 'USA', 'city': 'NYC', 'gender': 'f', 'age': 40},
+    {'city': 'Nowhere', 'age': 1.5},
+]
+
+
+class SnapshotTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'table.snapshot')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _render(self, table, format):
+        out = StringIO()
+        render(table, format, out)
+        return out.getvalue()
+
+    def test_save_and_load(self):
+        "A loaded table is rendered the same way as the original"
+        table = cast(Dataset(ITEMS), ['country', 'city'], ['gender'],
+                     Count(), Avg('age'), TopK('city', 1), rollup=True)
+        save(self.path, table)
+        snapshot = load(self.path)
+        try:
+            assert len(snapshot) == len(table)
+            assert snapshot.heading == table[0]
+            assert unicode(snapshot[4][1]) == 'Tver'
+            assert snapshot[-1][0].__unicode__() == '(total)'
+            for format in 'ascii', 'csv', 'jsonl':
+                assert self._render(snapshot, format) == \
+                       self._render(table, format)
+            # a snapshot can be saved again
+            save(self.path + '2', snapshot)
+            assert self._render(load(self.path + '2'), 'csv') == \
+                   self._render(table, 'csv')
+            assert snapshot.plan is None and snapshot.state is None
+        finally:
+            snapshot.close()
+
+    def test_empty_cells(self):
+        table = cast(Dataset(ITEMS), ['country'], [], Avg('name'),
+                     Sum('age', na_policy=NA.reject))
+        save(self.path, table)
+        snapshot = load(self.path)
+        assert snapshot[1][1] is NA()
+        assert snapshot[2][2] is None
+        snapshot.close()
+
+    def test_invalid_file(self):
+        f = open(self.path, 'wb')
+        f.write('x' * 100)
+        f.close()
+        self.assertRaises(ValueError, Snapshot, self.path)
+
+    def test_failed_save(self):
+        "A table that cannot be saved leaves no files"
+        self.assertRaises(Exception, save, self.path,
+                          [['x'], [lambda: None]])
+        assert os.listdir(self.dir) == []
+
+    def test_update(self):
+        "Updating the saved state gives the same table as casting everything"
+        plan = CastPlan(['country'], ['gender'],
+                        [Count(), Median('age', where=Where(age__gt=2))],
+                        rollup=True)
+        snapshot = build(self.path, plan, ITEMS[:2])
+        assert len(snapshot) == 3
+        old, snapshot = snapshot, snapshot.update(ITEMS[2:4])
+        self.assertRaises(ValueError, old.row, 0)    # closed
+        snapshot = snapshot.update(iter(ITEMS[4:]))
+        expected = plan.execute(Dataset(ITEMS))
+        assert self._render(snapshot, 'csv') == self._render(expected, 'csv')
+        snapshot.close()
+
+    def test_state(self):
+        "The state stays valid after a table is built from it"
+        plan = CastPlan(['city'], [], [Count(), Sum('age')])
+        state = plan.group(ITEMS)
+        first = self._render(plan.execute_state(state), 'csv')
+        assert first == self._render(plan.execute_state(state), 'csv')
+        assert first == self._render(plan.execute(Dataset(ITEMS)), 'csv')
+        self.assertRaises(ValueError, save, self.path, [['x']], None, state)
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+from datetime import date, datetime, timedelta
+import calendar
+import unittest
+
+from dark.aggregates import Count, CumSum, MovingAvg, MovingSum, Sum
+from dark.memory import Dataset
+from dark.shaping import cast
+from dark.timeseries import FixedOffset, TimeBucket
+
+
+START = datetime(2010, 3, 1, 22, 30)
+
+
+def as_text(table):
+    return [[unicode(c) for c in row] for row in table]
+
+
+class TimeBucketTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # an event every 5 hours
+        self.times = [START + timedelta(hours=5 * i) for i in range(10)]
+        self.data = Dataset([{'time': t, 'n': i}
+                             for i, t in enumerate(self.times)])
+
+    def _days(self, data, **kwargs):
+        table = cast(data, [TimeBucket('time', 'day', **kwargs)], [], Count())
+        return as_text(table)[1:]
+
+    def test_days(self):
+        assert self._days(self.data) == [
+            [u'2010-03-01', u'1'], [u'2010-03-02', u'5'], [u'2010-03-03', u'4']]
+
+    def test_time_zone(self):
+        assert self._days(self.data, tz=FixedOffset(180)) == [
+            [u'2010-03-02', u'5'], [u'2010-03-03', u'5']]
+
+    def test_timestamps(self):
+        "Numbers are treated as seconds since the epoch"
+        data = Dataset([{'time': calendar.timegm(t.utctimetuple())}
+                        for t in self.times])
+        assert self._days(data) == self._days(self.data)
+
+    def test_units(self):
+        factor = TimeBucket('time', 'week')
+        assert unicode(factor.truncate(START)) == u'2010-03-01'
+        factor = TimeBucket('time', 'minute')
+        assert unicode(factor.truncate(START)) == u'2010-03-01 22:30'
+        self.assertRaises(ValueError, TimeBucket, 'time', 'fortnight')
+
+    def test_scan(self):
+        factor = TimeBucket('time', 'hour', tz=FixedOffset(-90))
+        assert (as_text(cast(self.data, [factor], [], Sum('n'))) ==
+                as_text(cast(self.data, [factor], [], Sum('n'),
+                             strategy='scan')))
+
+    def test_dates(self):
+        "Dates are local calendar days, whatever the time zone"
+        data = Dataset([{'time': date(2020, 1, 1)}, {'time': date(2020, 1, 2)},
+                        {'time': date(2020, 1, 2)}])
+        for tz in None, FixedOffset(-300), FixedOffset(330):
+            for unit in 'day', 'hour', 'week':
+                factor = TimeBucket('time', unit, tz=tz)
+                levels = as_text(cast(data, [factor], [], Count(),
+                                      strategy='levels'))
+                scan = as_text(cast(data, [factor], [], Count(),
+                                    strategy='scan'))
+                assert levels == scan, (tz, unit)
+        assert self._days(data, tz=FixedOffset(-300)) == [
+            [u'2020-01-01', u'1'], [u'2020-01-02', u'2']]
+
+
+class WindowTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.data = Dataset([{'group': g, 'day': d, 'n': d * 10}
+                             for g in 'ab' for d in range(1, 5)] +
+                            [{'group': 'a', 'day': 2, 'n': None}])
+
+    def test_windows(self):
+        table = cast(self.data, ['group', 'day'], [], MovingAvg('n', 2),
+                     MovingSum('n', 3), CumSum('n'))
+        assert as_text(table) == [
+            [u'group', u'day', u'MovingAvg(n, 2)', u'MovingSum(n, 3)',
+             u'CumSum(n)'],
+            [u'a', u'1', u'10.00', u'10.00', u'10.00'],
+            [u'a', u'2', u'15.00', u'30.00', u'30.00'],
+            [u'a', u'3', u'25.00', u'60.00', u'60.00'],
+            [u'a', u'4', u'35.00', u'90.00', u'100.00'],
+            # windows restart in each group
+            [u'b', u'1', u'10.00', u'10.00', u'10.00'],
+            [u'b', u'2', u'15.00', u'30.00', u'30.00'],
+            [u'b', u'3', u'25.00', u'60.00', u'60.00'],
+            [u'b', u'4', u'35.00', u'90.00', u'100.00'],
+        ]
+
+    def test_rollup(self):
+        "Subtotals are aggregated over the whole group"
+        table = cast(self.data, ['group', 'day'], [], CumSum('n'),
+                     rollup=True)
+        assert as_text(table)[5] == [u'a', u'(total)', u'100.00']
+
+    def test_invalid_window(self):
+        self.assertRaises(ValueError, MovingAvg, 'n', 0)